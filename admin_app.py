@@ -1,309 +1,659 @@
-import streamlit as st
-from db_utils import get_db_connection
-import pandas as pd
-import random
-import string
-from datetime import datetime
-import io
-import mysql.connector
-
-# Page configuration
-st.set_page_config(
-    page_title="Hospital Stocktake - Admin",
-    page_icon="🏥",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
-
-# Departments
-DEPARTMENTS = [
-    "ER", "ADMISSION", "MARTENITY", "THEATRE", 
-    "LAB", "RADIOLOGY", "DENTIST"
-]
-
-def generate_access_code(length=8):
-    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
-
-def authenticate(username, password):
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute("SELECT * FROM users WHERE username = %s AND password = %s", (username, password))
-    user = cursor.fetchone()
-    conn.close()
-    return user["department"] if user else None
-
-def login_page():
-    st.title("Hospital Stocktake System - Admin Login")
-    
-    with st.form("login_form"):
-        username = st.text_input("Username")
-        password = st.text_input("Password", type="password")
-        submit_button = st.form_submit_button("Login")
-        
-        if submit_button:
-            department = authenticate(username, password)
-            if department:
-                st.session_state.authenticated = True
-                st.session_state.department = department
-                st.session_state.username = username
-                st.session_state.current_page = "Home"
-                st.success(f"Logged in successfully as {department} admin!")
-                st.rerun()
-            else:
-                st.error("Invalid username or password")
-
-def home_page():
-    st.title("🏥 Hospital Stocktake System - Admin Portal")
-    st.markdown("""
-    ### Welcome to the Admin Portal
-    
-    Use the sidebar to navigate through different sections:
-    - **Admin**: Manage stocktake tables and access codes
-    - **Data**: View and export stocktake data
-    - **Database**: Manage the master drug list
-    - **About**: Learn more about the system
-    """)
-    
-    st.info(f"Logged in as: {st.session_state.username} ({st.session_state.department} admin)")
-
-def admin_page():
-    st.title("📋 Stocktake Table Management")
-    
-    with st.expander("Create New Stocktake Table"):
-        with st.form("new_table_form", clear_on_submit=True):
-            table_name = st.text_input("Table Name")
-            department = st.selectbox("Department", DEPARTMENTS, 
-                                    index=DEPARTMENTS.index(st.session_state.department) 
-                                    if st.session_state.department in DEPARTMENTS else 0)
-            
-            col1, col2 = st.columns(2)
-            with col1:
-                access_code = st.text_input("Access Code", value=generate_access_code())
-            with col2:
-                st.markdown("###")
-                if st.form_submit_button("Generate New Code"):
-                    access_code = generate_access_code()
-                    st.session_state.new_access_code = access_code
-            
-            if 'new_access_code' in st.session_state:
-                access_code = st.session_state.new_access_code
-            
-            submit_button = st.form_submit_button("Create Table")
-            
-            if submit_button:
-                if not table_name or not department or not access_code:
-                    st.error("Please fill in all fields")
-                else:
-                    conn = get_db_connection()
-                    cursor = conn.cursor(dictionary=True)
-                    try:
-                        # Insert new stocktake table
-                        cursor.execute(
-                            "INSERT INTO stocktake_tables (table_name, department, access_code, created_by) VALUES (%s, %s, %s, %s)",
-                            (table_name, department, access_code, st.session_state.username)
-                        )
-                        conn.commit()
-                        
-                        # Get the newly created table ID
-                        table_id = cursor.lastrowid
-                        
-                        # Get all drugs from database
-                        cursor.execute("SELECT id FROM drugs")
-                        drug_ids = [row['id'] for row in cursor.fetchall()]
-                        
-                        # Insert records for all drugs
-                        for drug_id in drug_ids:
-                            cursor.execute(
-                                "INSERT INTO stocktake_records (table_id, drug_id) VALUES (%s, %s)",
-                                (table_id, drug_id)
-                            )
-                        conn.commit()
-                        
-                        st.success(f"Table '{table_name}' created with access code: {access_code}")
-                        if 'new_access_code' in st.session_state:
-                            del st.session_state.new_access_code
-                    except mysql.connector.Error as e:
-                        st.error(f"Database error: {e}")
-                    finally:
-                        cursor.close()
-                        conn.close()
-
-    # View existing tables code remains the same...
-
-    st.subheader("Existing Stocktake Tables")
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    cursor.execute(
-        "SELECT id, table_name, department, access_code, created_at FROM stocktake_tables ORDER BY created_at DESC"
-    )
-    tables = cursor.fetchall()
-    cursor.close()
-    conn.close()
-    
-    if not tables:
-        st.info("No tables created yet.")
-    else:
-        if st.session_state.department != "SUPER_ADMIN":
-            tables = [t for t in tables if t["department"] == st.session_state.department]
-        
-        if tables:
-            df = pd.DataFrame(tables)
-            df["Created At"] = pd.to_datetime(df["created_at"]).dt.strftime('%Y-%m-%d %H:%M')
-            st.dataframe(df.drop(columns=["id", "created_at"]), hide_index=True)
-
-def data_page():
-    st.title("📊 Stocktake Data")
-    
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    
-    cursor.execute(
-        "SELECT id, table_name, department, created_at FROM stocktake_tables ORDER BY created_at DESC"
-    )
-    tables = cursor.fetchall()
-    
-    if st.session_state.department != "SUPER_ADMIN":
-        tables = [t for t in tables if t["department"] == st.session_state.department]
-    
-    if not tables:
-        st.info("No tables available.")
-        cursor.close()
-        conn.close()
-        return
-    
-    table_options = {f"{t['table_name']} ({t['department']}, {t['created_at']})": t['id'] for t in tables}
-    selected_table = st.selectbox("Select Table", list(table_options.keys()))
-    
-    if selected_table:
-        table_id = table_options[selected_table]
-        
-        cursor.execute('''
-            SELECT d.drug_name, sr.packs, sr.singles, sr.expiry_date, sr.last_updated
-            FROM stocktake_records sr
-            JOIN drugs d ON sr.drug_id = d.id
-            WHERE sr.table_id = %s
-            ORDER BY d.drug_name
-        ''', (table_id,))
-        records = cursor.fetchall()
-        
-        if records:
-            df = pd.DataFrame(records)
-            df["Last Updated"] = pd.to_datetime(df["last_updated"]).dt.strftime('%Y-%m-%d %H:%M')
-            st.dataframe(df.drop(columns=["last_updated"]), hide_index=True)
-            
-            st.subheader("Export Data")
-            col1, col2, col3 = st.columns(3)
-            with col1:
-                csv = df.to_csv(index=False).encode('utf-8')
-                st.download_button("Export to CSV", data=csv, file_name="stocktake.csv", mime="text/csv")
-            with col2:
-                excel_buffer = io.BytesIO()
-                with pd.ExcelWriter(excel_buffer, engine='openpyxl') as writer:
-                    df.to_excel(writer, index=False)
-                st.download_button("Export to Excel", data=excel_buffer.getvalue(), 
-                                 file_name="stocktake.xlsx", 
-                                 mime="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
-            with col3:
-                if st.button("Delete Table"):
-                    if st.checkbox("Confirm deletion"):
-                        cursor.execute("DELETE FROM stocktake_records WHERE table_id = %s", (table_id,))
-                        cursor.execute("DELETE FROM stocktake_tables WHERE id = %s", (table_id,))
-                        conn.commit()
-                        st.success("Table deleted!")
-                        st.rerun()
-        else:
-            st.info("No records found.")
-    
-    cursor.close()
-    conn.close()
-
-def database_page():
-    st.title("💾 Drug Database")
-    
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    
-    cursor.execute("SELECT id, drug_name, department FROM drugs ORDER BY drug_name")
-    drugs = cursor.fetchall()
-    
-    search_term = st.text_input("Search Drugs")
-    if search_term:
-        drugs = [d for d in drugs if search_term.lower() in d["drug_name"].lower()]
-    
-    department_filter = st.selectbox("Filter Department", ["All"] + DEPARTMENTS)
-    if department_filter != "All":
-        drugs = [d for d in drugs if d["department"] == department_filter]
-    
-    if drugs:
-        df = pd.DataFrame(drugs)
-        st.dataframe(df.drop(columns=["id"]), hide_index=True)
-    else:
-        st.info("No drugs found.")
-    
-    with st.expander("Add New Drug"):
-        with st.form("add_drug_form", clear_on_submit=True):
-            drug_name = st.text_input("Drug Name")
-            department = st.selectbox("Department", ["None"] + DEPARTMENTS)
-            if st.form_submit_button("Add"):
-                if drug_name:
-                    try:
-                        cursor.execute(
-                            "INSERT INTO drugs (drug_name, department) VALUES (%s, %s)",
-                            (drug_name, department if department != "None" else None)
-                        )
-                        conn.commit()
-                        st.success("Drug added!")
-                        st.rerun()
-                    except mysql.connector.IntegrityError:
-                        st.error("Drug already exists")
-    
-    st.subheader("Export Drug List")
-    if drugs:
-        csv = pd.DataFrame(drugs).to_csv(index=False).encode('utf-8')
-        st.download_button("Export CSV", data=csv, file_name="drugs.csv", mime="text/csv")
-    
-    cursor.close()
-    conn.close()
-
-def about_page():
-    st.title("ℹ️ About")
-    st.markdown("""
-    ### Hospital Stocktake System
-    **Version:** 1.0  
-    **Developed by:** Corporate 24 Healthcare
-    """)
-
-def main():
-    if 'authenticated' not in st.session_state:
-        st.session_state.update({
-            'authenticated': False,
-            'department': None,
-            'username': None,
-            'current_page': "Home"
-        })
-
-    st.sidebar.title("Navigation")
-    if st.session_state.authenticated:
-        st.sidebar.success(f"Logged in as {st.session_state.username}")
-        
-        pages = {
-            "Home": home_page,
-            "Admin": admin_page,
-            "Data": data_page,
-            "Database": database_page,
-            "About": about_page
-        }
-        
-        selected_page = st.sidebar.radio("Go to", list(pages.keys()))
-        
-        st.sidebar.markdown("---")
-        if st.sidebar.button("Logout"):
-            st.session_state.authenticated = False
-            st.rerun()
-        
-        pages[selected_page]()
-    else:
-        login_page()
-
-if __name__ == "__main__":
+import streamlit as st
+from db_utils import (
+    db_cursor, find_user, create_stocktake_table, get_drugs, get_expiring_items,
+    get_stocktake_tables, get_table_records_page, table_cursor, record_cursor,
+    invalidate_cache, cache, POOL_SIZE, get_template, save_template, add_drugs_to_table, get_table_progress,
+    get_record_history, compaction_status, bump_catalog_version
+)
+from archive_utils import archive_table, delete_table_and_archive, get_archived_records_page
+from metrics_utils import metrics, SLOW_QUERY_MS
+from report_utils import (
+    compare_tables, variance_rollup, department_series, variance_workbook,
+    department_report, department_workbook
+)
+from ui_utils import page_size_selector, keyset_pager, count_upload_form
+from search_utils import search_drugs, invalidate_drug_index
+from export_utils import export_csv, export_excel, export_latest_workbook, export_file_name, latest_department_tables
+import pandas as pd
+import random
+import string
+import time
+import mysql.connector
+from functools import partial
+
+# Page configuration
+st.set_page_config(
+    page_title="Hospital Stocktake - Admin",
+    page_icon="🏥",
+    layout="wide",
+    initial_sidebar_state="expanded"
+)
+metrics.app = "admin"
+
+# Departments
+DEPARTMENTS = [
+    "ER", "ADMISSION", "MARTENITY", "THEATRE", 
+    "LAB", "RADIOLOGY", "DENTIST"
+]
+
+EXCEL_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# Most recent tables offered for comparison and shown in the series
+VARIANCE_TABLE_LIMIT = 52
+
+def department_scope():
+    # SUPER_ADMIN sees every department; other admins only their own
+    return None if st.session_state.department == "SUPER_ADMIN" else st.session_state.department
+
+def generate_access_code(length=8):
+    return ''.join(random.choices(string.ascii_uppercase + string.digits, k=length))
+
+def authenticate(username, password):
+    user = find_user(username, password)
+    return user["department"] if user else None
+
+def login_page():
+    st.title("Hospital Stocktake System - Admin Login")
+    
+    with st.form("login_form"):
+        username = st.text_input("Username")
+        password = st.text_input("Password", type="password")
+        submit_button = st.form_submit_button("Login")
+        
+        if submit_button:
+            department = authenticate(username, password)
+            if department:
+                st.session_state.authenticated = True
+                st.session_state.department = department
+                st.session_state.username = username
+                st.session_state.current_page = "Home"
+                st.success(f"Logged in successfully as {department} admin!")
+                st.rerun()
+            else:
+                st.error("Invalid username or password")
+
+def home_page():
+    st.title("🏥 Hospital Stocktake System - Admin Portal")
+    st.markdown("""
+    ### Welcome to the Admin Portal
+    
+    Use the sidebar to navigate through different sections:
+    - **Admin**: Manage stocktake tables and access codes
+    - **Progress**: How far each open count has got
+    - **Data**: View and export stocktake data
+    - **Variance**: Compare counts between stocktakes
+    - **Expiry**: Stock expiring soon across active stocktakes
+    - **Departments**: Latest count of every department side by side (SUPER_ADMIN)
+    - **Database**: Manage the master drug list
+    - **Templates**: Choose the drugs each department's new tables start with
+    - **Diagnostics**: Query, page and connection timings
+    - **About**: Learn more about the system
+    """)
+    
+    st.info(f"Logged in as: {st.session_state.username} ({st.session_state.department} admin)")
+
+def admin_page():
+    st.title("📋 Stocktake Table Management")
+    
+    with st.expander("Create New Stocktake Table"):
+        with st.form("new_table_form", clear_on_submit=True):
+            table_name = st.text_input("Table Name")
+            department = st.selectbox("Department", DEPARTMENTS, 
+                                    index=DEPARTMENTS.index(st.session_state.department) 
+                                    if st.session_state.department in DEPARTMENTS else 0)
+            
+            col1, col2 = st.columns(2)
+            with col1:
+                access_code = st.text_input("Access Code", value=generate_access_code())
+            with col2:
+                st.markdown("###")
+                if st.form_submit_button("Generate New Code"):
+                    access_code = generate_access_code()
+                    st.session_state.new_access_code = access_code
+            
+            if 'new_access_code' in st.session_state:
+                access_code = st.session_state.new_access_code
+            
+            submit_button = st.form_submit_button("Create Table")
+            
+            if submit_button:
+                if not table_name or not department or not access_code:
+                    st.error("Please fill in all fields")
+                else:
+                    try:
+                        with st.spinner("Creating table..."):
+                            table_id, row_count, elapsed = create_stocktake_table(
+                                table_name, department, access_code, st.session_state.username
+                            )
+                        
+                        st.success(f"Table '{table_name}' created with access code: {access_code}")
+                        source = f"the {department} template" if get_template(department) else "the whole catalog"
+                        st.caption(f"Seeded {row_count} drugs from {source} in {elapsed:.2f}s")
+                        if 'new_access_code' in st.session_state:
+                            del st.session_state.new_access_code
+                    except mysql.connector.Error as e:
+                        st.error(f"Database error: {e}")
+
+    # View existing tables code remains the same...
+
+    st.subheader("Existing Stocktake Tables")
+    scope = department_scope()
+    page_size = page_size_selector("admin_tables", 25, "Tables per page")
+    tables = keyset_pager(
+        f"admin_tables_{page_size}",
+        lambda cursor, limit: get_stocktake_tables(scope, limit, cursor),
+        table_cursor,
+        page_size
+    )
+    
+    if not tables:
+        st.info("No tables created yet.")
+    else:
+        df = pd.DataFrame(tables)
+        df["Created At"] = pd.to_datetime(df["created_at"]).dt.strftime('%Y-%m-%d %H:%M')
+        df["Status"] = "Active"
+        df.loc[~df["is_active"].astype(bool), "Status"] = "Closed"
+        df.loc[df["archived_at"].notna(), "Status"] = "Archived"
+        st.dataframe(df.drop(columns=["id", "created_at", "is_active", "archived_at"]), hide_index=True)
+
+def progress_page():
+    st.title("⏱️ Count Progress")
+    
+    tables = get_table_progress(department_scope())
+    if not tables:
+        st.info("No tables available.")
+        return
+    
+    df = pd.DataFrame(tables)
+    active = df[df["is_active"].astype(bool)]
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Open tables", len(active))
+    col2.metric("Lines counted", f"{int(active['touched_lines'].sum())} / {int(active['line_count'].sum())}")
+    col3.metric("Packs", int(active["total_packs"].sum()))
+    col4.metric("Singles", int(active["total_singles"].sum()))
+    
+    if not st.toggle("Include closed tables"):
+        df = active
+    df = df.assign(
+        untouched=df["line_count"] - df["touched_lines"],
+        done=(df["touched_lines"] / df["line_count"].where(df["line_count"] > 0)).fillna(0)
+    )
+    st.dataframe(
+        df[["table_name", "department", "created_at", "line_count", "touched_lines", "untouched", "done",
+            "total_packs", "total_singles", "last_activity_at", "last_activity_by"]],
+        column_config={
+            "table_name": "Table",
+            "department": "Department",
+            "created_at": st.column_config.DatetimeColumn("Created", format="YYYY-MM-DD HH:mm"),
+            "line_count": "Lines",
+            "touched_lines": "Counted",
+            "untouched": "Untouched",
+            "done": st.column_config.ProgressColumn("Done", min_value=0, max_value=1, format="percent"),
+            "total_packs": "Packs",
+            "total_singles": "Singles",
+            "last_activity_at": st.column_config.DatetimeColumn("Last activity", format="YYYY-MM-DD HH:mm"),
+            "last_activity_by": "By"
+        },
+        hide_index=True
+    )
+    st.caption("Updated with every save; refreshed here at most every few seconds.")
+
+def data_page():
+    st.title("📊 Stocktake Data")
+    
+    scope = department_scope()
+    col1, col2 = st.columns(2)
+    with col1:
+        table_page_size = page_size_selector("data_tables", 25, "Tables per page")
+    with col2:
+        record_page_size = page_size_selector("data_records", 100)
+    
+    tables = keyset_pager(
+        f"data_tables_{table_page_size}",
+        lambda cursor, limit: get_stocktake_tables(scope, limit, cursor),
+        table_cursor,
+        table_page_size
+    )
+    
+    if not tables:
+        st.info("No tables available.")
+        return
+    
+    table_options = {
+        f"{t['table_name']} ({t['department']}, {t['created_at']}){' - archived' if t['archived_at'] else ''}": t
+        for t in tables
+    }
+    selected_table = st.selectbox("Select Table", list(table_options.keys()))
+    
+    if selected_table:
+        table = table_options[selected_table]
+        table_id = table["id"]
+        archived = table["archived_at"] is not None
+        if archived:
+            st.caption(f"Archived {table['archived_at']:%Y-%m-%d %H:%M}; read-only.")
+        elif not table["is_active"]:
+            st.caption("Closed; archiving did not finish. Archive it again to complete it.")
+        load_page = get_archived_records_page if archived else get_table_records_page
+        records = keyset_pager(
+            f"data_records_{table_id}_{record_page_size}",
+            lambda cursor, limit: load_page(table_id, limit, cursor),
+            record_cursor,
+            record_page_size
+        )
+        
+        if records:
+            df = pd.DataFrame(records).drop(columns=["id", "drug_id"])
+            df["Last Updated"] = pd.to_datetime(df["last_updated"]).dt.strftime('%Y-%m-%d %H:%M')
+            st.dataframe(df.drop(columns=["last_updated"]), hide_index=True)
+            
+            st.subheader("Export Data")
+            col1, col2 = st.columns(2)
+            # Files are only generated when a download button is clicked
+            with col1:
+                st.download_button("Export to CSV", data=partial(export_csv, table_id),
+                                 file_name=export_file_name("stocktake", "csv"), mime="text/csv",
+                                 on_click="ignore")
+            with col2:
+                st.download_button("Export to Excel", data=partial(export_excel, table_id),
+                                 file_name=export_file_name("stocktake", "xlsx"),
+                                 mime=EXCEL_MIME, on_click="ignore")
+        else:
+            st.info("No records found.")
+        
+        if records and not archived:
+            with st.expander("Count history"):
+                drugs = {record["drug_name"]: record["id"] for record in records}
+                drug = st.selectbox("Drug", list(drugs.keys()), key=f"history_{table_id}")
+                history = get_record_history(drugs[drug])
+                if history:
+                    st.dataframe(pd.DataFrame([
+                        {"Counted At": event["counted_at"], "Counted By": event["counted_by"],
+                         "Packs": event["packs"], "Singles": event["singles"], "Expiry": event["expiry_date"],
+                         "Applied": bool(event["compacted"])}
+                        for event in history
+                    ]), hide_index=True)
+                else:
+                    st.info("No counts recorded for this line yet.")
+        
+        if table["is_active"]:
+            with st.expander("Upload counts from a spreadsheet"):
+                count_upload_form(table_id, st.session_state.username, key=f"admin_upload_{table_id}")
+        
+        with st.expander("Archive or delete this table"):
+            st.markdown(
+                "**Archive** closes the table to counting, writes its records to a compressed "
+                "Parquet file and removes them from the database. It stays viewable, exportable "
+                "and comparable here. **Delete** removes the table and any archive file for good."
+            )
+            confirmed = st.checkbox("I understand this cannot be undone", key=f"confirm_table_{table_id}")
+            col1, col2 = st.columns(2)
+            with col1:
+                if not archived and st.button("Archive Table", disabled=not confirmed):
+                    try:
+                        with st.spinner("Archiving table..."):
+                            summary = archive_table(table_id, st.session_state.username)
+                        st.success(f"Archived {summary['lines']} records "
+                                   f"({summary['file_bytes'] / 1024:.1f} KB) in {summary['seconds']:.2f}s")
+                        st.rerun()
+                    except (mysql.connector.Error, OSError) as e:
+                        st.error(f"Archiving failed: {e}")
+            with col2:
+                if st.button("Delete Table", disabled=not confirmed):
+                    try:
+                        with st.spinner("Deleting table..."):
+                            delete_table_and_archive(table_id)
+                        st.success("Table deleted!")
+                        st.rerun()
+                    except (mysql.connector.Error, OSError) as e:
+                        st.error(f"Deleting failed: {e}")
+    
+    if st.session_state.department == "SUPER_ADMIN":
+        st.subheader("All Departments")
+        st.download_button("Export latest count for every department", 
+                         data=partial(export_latest_workbook, DEPARTMENTS),
+                         file_name=export_file_name("stocktake_all_departments", "xlsx"),
+                         mime=EXCEL_MIME, on_click="ignore")
+
+def variance_page():
+    st.title("📈 Variance")
+    
+    scope = department_scope()
+    department = scope or st.selectbox("Department", DEPARTMENTS)
+    tables = get_stocktake_tables(department, VARIANCE_TABLE_LIMIT)
+    if len(tables) < 2:
+        st.info("At least two stocktake tables are needed for a comparison.")
+        return
+    
+    labels = {t["id"]: f"{t['table_name']} ({t['created_at']:%Y-%m-%d %H:%M})" for t in tables}
+    ids = list(labels)
+    col1, col2 = st.columns(2)
+    with col1:
+        base_id = st.selectbox("Base (earlier) count", ids, index=1, format_func=labels.get)
+    with col2:
+        current_id = st.selectbox("Current count", ids, index=0, format_func=labels.get)
+    
+    comparison = compare_tables(base_id, current_id)
+    rollup = variance_rollup(comparison)
+    
+    counts = comparison["status"].value_counts()
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Packs", int(comparison["current_packs"].sum()), int(comparison["packs_delta"].sum()))
+    col2.metric("Singles", int(comparison["current_singles"].sum()), int(comparison["singles_delta"].sum()))
+    col3.metric("Changed lines", int(counts.get("changed", 0)))
+    col4.metric("New / missing", f"{int(counts.get('new', 0))} / {int(counts.get('missing', 0))}")
+    
+    st.subheader("By department")
+    st.dataframe(rollup, hide_index=True)
+    
+    st.subheader("Lines")
+    statuses = st.multiselect("Status", ["changed", "new", "missing", "unchanged"], default=["changed", "new", "missing"])
+    st.dataframe(comparison[comparison["status"].isin(statuses)].drop(columns=["drug_id"]), hide_index=True)
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        st.download_button("Export lines to CSV", data=lambda: comparison.to_csv(index=False),
+                         file_name=export_file_name("variance", "csv"), mime="text/csv", on_click="ignore")
+    with col2:
+        st.download_button("Export to Excel", data=lambda: variance_workbook(comparison, rollup),
+                         file_name=export_file_name("variance", "xlsx"), mime=EXCEL_MIME, on_click="ignore")
+    
+    st.subheader(f"{department} series")
+    series = department_series([t["id"] for t in tables])
+    st.line_chart(series.set_index("created_at")[["total_packs", "total_singles"]])
+    st.dataframe(series.drop(columns=["table_id", "department"]), hide_index=True)
+
+def departments_page():
+    st.title("🏢 All Departments")
+    
+    latest = {table["department"]: table for table in latest_department_tables(DEPARTMENTS)}
+    if st.toggle("Choose a table per department"):
+        cols = st.columns(2)
+        for i, department in enumerate(DEPARTMENTS):
+            tables = get_stocktake_tables(department, VARIANCE_TABLE_LIMIT)
+            if not tables:
+                continue
+            with cols[i % 2]:
+                latest[department] = st.selectbox(
+                    department, tables,
+                    format_func=lambda t: f"{t['table_name']} ({t['created_at']:%Y-%m-%d %H:%M})"
+                )
+    if not latest:
+        st.info("No tables available.")
+        return
+    
+    started = time.perf_counter()
+    try:
+        summary, lines = department_report([latest[d] for d in DEPARTMENTS if d in latest])
+    except mysql.connector.Error as e:
+        st.error(f"Database error: {e}")
+        return
+    elapsed = time.perf_counter() - started
+    
+    total = summary.iloc[-1]
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Departments", len(summary) - 1)
+    col2.metric("Counted lines", f"{int(total['counted_lines'])} / {int(total['lines'])}")
+    col3.metric("Packs", int(total["total_packs"]))
+    col4.metric("Singles", int(total["total_singles"]))
+    st.caption(f"Fetched in {elapsed * 1000:.0f} ms; one department after another would take about "
+               f"{summary['fetch_ms'].sum():.0f} ms.")
+    
+    st.dataframe(summary, hide_index=True)
+    st.download_button("Export report to Excel", data=lambda: department_workbook(summary, lines),
+                     file_name=export_file_name("department_report", "xlsx"), mime=EXCEL_MIME, on_click="ignore")
+
+def expiry_page():
+    st.title("⏳ Expiring Stock")
+    
+    scope = department_scope()
+    col1, col2 = st.columns(2)
+    with col1:
+        days = st.slider("Expiring within (days)", min_value=7, max_value=365, value=90, step=7)
+    with col2:
+        department = scope or st.selectbox("Department", ["All"] + DEPARTMENTS)
+    
+    items = get_expiring_items(days, None if department == "All" else department)
+    if not items:
+        st.success(f"Nothing expires within {days} days.")
+        return
+    
+    df = pd.DataFrame(items)
+    expired = df["days_left"] < 0
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Lines", len(df))
+    col2.metric("Already expired", int(expired.sum()))
+    col3.metric("Departments", df["department"].nunique())
+    
+    st.dataframe(
+        df.groupby("department").agg(lines=("drug_name", "size"), packs=("packs", "sum"), singles=("singles", "sum"),
+                                     first_expiry=("expiry_date", "min")).reset_index(),
+        hide_index=True
+    )
+    st.dataframe(df, hide_index=True)
+    st.download_button("Export to CSV", data=lambda: df.to_csv(index=False),
+                     file_name=export_file_name(f"expiring_{days}d", "csv"), mime="text/csv", on_click="ignore")
+
+def database_page():
+    st.title("💾 Drug Database")
+    
+    search_term = st.text_input("Search Drugs")
+    department_filter = st.selectbox("Filter Department", ["All"] + DEPARTMENTS)
+    department = department_filter if department_filter != "All" else None
+    
+    matched_ids = search_drugs(search_term, department) if search_term else None
+    drugs = get_drugs(department, matched_ids)
+    
+    if matched_ids:
+        # Keep the search ranking: exact, prefix, substring, then fuzzy
+        rank = {drug_id: position for position, drug_id in enumerate(matched_ids)}
+        drugs = sorted(drugs, key=lambda d: rank[d["id"]])
+    
+    if drugs:
+        df = pd.DataFrame(drugs)
+        st.dataframe(df.drop(columns=["id"]), hide_index=True)
+    else:
+        st.info("No drugs found.")
+    
+    with st.expander("Add New Drug"):
+        with st.form("add_drug_form", clear_on_submit=True):
+            drug_name = st.text_input("Drug Name")
+            department = st.selectbox("Department", ["None"] + DEPARTMENTS)
+            if st.form_submit_button("Add"):
+                if drug_name:
+                    try:
+                        with db_cursor() as (conn, cursor):
+                            cursor.execute(
+                                "INSERT INTO drugs (drug_name, department) VALUES (%s, %s)",
+                                (drug_name, department if department != "None" else None)
+                            )
+                            bump_catalog_version(cursor)
+                            conn.commit()
+                        invalidate_cache("drugs")
+                        invalidate_drug_index()
+                        st.success("Drug added!")
+                        st.rerun()
+                    except mysql.connector.IntegrityError:
+                        st.error("Drug already exists")
+
+    st.subheader("Export Drug List")
+    if drugs:
+        st.download_button("Export CSV", data=lambda: pd.DataFrame(drugs).to_csv(index=False),
+                         file_name="drugs.csv", mime="text/csv", on_click="ignore")
+
+def templates_page():
+    st.title("🧾 Department Templates")
+    st.caption("New tables are seeded with their department's template. "
+               "Departments without one get every drug in the catalog.")
+    
+    department = department_scope() or st.selectbox("Department", DEPARTMENTS)
+    template = get_template(department)
+    template_ids = [row["drug_id"] for row in template]
+    
+    col1, col2, col3 = st.columns(3)
+    col1.metric("Drugs in template", len(template))
+    col2.metric(f"Drugs tagged {department}", len(get_drugs(department)))
+    col3.metric("Drugs in catalog", len(get_drugs()))
+    
+    if template:
+        df = pd.DataFrame(template)[["position", "drug_name", "department", "drug_id"]].assign(remove=False)
+        edited = st.data_editor(
+            # Keyed on the saved template so edits are not replayed onto reordered rows
+            df, hide_index=True, key=f"template_editor_{department}_{hash(tuple(template_ids))}",
+            disabled=["drug_name", "department"],
+            column_config={"drug_id": None, "position": st.column_config.NumberColumn("Position", min_value=1, step=1)}
+        )
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("Save order and removals"):
+                kept = edited[~edited["remove"]].sort_values(["position", "drug_name"], kind="stable")
+                save_template(department, kept["drug_id"].tolist())
+                st.success("Template saved!")
+                st.rerun()
+        with col2:
+            if st.button("Clear template"):
+                save_template(department, [])
+                st.rerun()
+    else:
+        st.info(f"{department} has no template yet.")
+        if st.button(f"Start from the drugs tagged {department}"):
+            save_template(department, [drug["id"] for drug in get_drugs(department)])
+            st.rerun()
+    
+    st.subheader("Add drugs")
+    search_term = st.text_input("Search the catalog")
+    matched_ids = search_drugs(search_term)[:50] if search_term else []
+    rank = {drug_id: position for position, drug_id in enumerate(matched_ids)}
+    candidates = sorted(get_drugs(None, matched_ids), key=lambda d: rank[d["id"]]) if matched_ids else []
+    chosen = st.multiselect(
+        "Drugs", candidates,
+        format_func=lambda d: f"{d['drug_name']} ({d['department'] or 'no department'})"
+    )
+    chosen_ids = [drug["id"] for drug in chosen]
+    
+    col1, col2 = st.columns(2)
+    with col1:
+        if st.button("Add to template", disabled=not chosen):
+            save_template(department, template_ids + chosen_ids)
+            st.success(f"Added {len(set(chosen_ids) - set(template_ids))} drugs to the template")
+            st.rerun()
+    with col2:
+        # Late drugs go into tables already being counted without reseeding them
+        tables = [t for t in get_stocktake_tables(department, VARIANCE_TABLE_LIMIT) if t["is_active"]]
+        table = st.selectbox("Active table", tables, format_func=lambda t: f"{t['table_name']} ({t['created_at']:%Y-%m-%d %H:%M})")
+        if st.button("Add to table", disabled=not (chosen and table)):
+            try:
+                added = add_drugs_to_table(table["id"], chosen_ids)
+                st.success(f"Added {added} drugs to {table['table_name']}"
+                           + (f"; {len(chosen_ids) - added} were already in it" if added < len(chosen_ids) else ""))
+            except mysql.connector.Error as e:
+                st.error(f"Database error: {e}")
+
+def diagnostics_page():
+    st.title("🩺 Diagnostics")
+    st.caption("Timings for this app process since it started or was last reset. The user app keeps its own.")
+    
+    connections = metrics.connection_stats()
+    col1, col2, col3, col4, col5 = st.columns(5)
+    col1.metric("Connections in use", f"{connections['in_use']} / {POOL_SIZE}")
+    col2.metric("Peak in use", connections["peak_in_use"])
+    col3.metric("Checkouts", connections["checkouts"])
+    col4.metric("Waited for pool", connections["waits"])
+    col5.metric("Connection errors", connections["errors"])
+    
+    compaction = compaction_status()
+    col1, col2 = st.columns(2)
+    col1.metric("Count events waiting", compaction["pending"])
+    col2.metric("Last compaction", f"{compaction['compacted_at']:%H:%M:%S}" if compaction["compacted_at"] else "Never")
+    
+    st.subheader("Page renders")
+    pages = metrics.page_percentiles()
+    if pages:
+        st.dataframe(pd.DataFrame(pages), hide_index=True)
+    else:
+        st.info("No pages timed yet.")
+    
+    st.subheader("Top queries")
+    orders = {"Total time": "total_seconds", "Calls": "calls", "p95": "p95", "Slowest": "max_seconds"}
+    order = st.selectbox("Order by", list(orders.keys()))
+    queries = metrics.top_queries(limit=25, by=orders[order])
+    if queries:
+        st.dataframe(pd.DataFrame(queries), hide_index=True)
+    
+    st.subheader(f"Slow queries (over {SLOW_QUERY_MS:.0f} ms)")
+    if metrics.slow_queries:
+        st.dataframe(pd.DataFrame(list(metrics.slow_queries)[::-1]), hide_index=True)
+    else:
+        st.success("No slow queries recorded.")
+    
+    with st.expander("Cache statistics"):
+        stats = cache.stats()
+        col1, col2, col3, col4 = st.columns(4)
+        col1.metric("Hits", stats["hits"])
+        col2.metric("Misses", stats["misses"])
+        col3.metric("Entries", f"{stats['entries']} / {stats['max_entries']}")
+        col4.metric("Evictions", stats["evictions"])
+        if stats["namespaces"]:
+            st.dataframe(pd.DataFrame(stats["namespaces"]), hide_index=True)
+    
+    with st.expander("Metrics text dump"):
+        dump = metrics.text_dump()
+        st.code(dump, language="text")
+        st.download_button("Download metrics", data=dump, file_name="stocktake_admin.prom",
+                         mime="text/plain", on_click="ignore")
+    
+    if st.button("Reset metrics"):
+        metrics.reset()
+        st.rerun()
+
+def about_page():
+    st.title("ℹ️ About")
+    st.markdown("""
+    ### Hospital Stocktake System
+    **Version:** 1.0  
+    **Developed by:** Corporate 24 Healthcare
+    """)
+
+def main():
+    if 'authenticated' not in st.session_state:
+        st.session_state.update({
+            'authenticated': False,
+            'department': None,
+            'username': None,
+            'current_page': "Home"
+        })
+
+    st.sidebar.title("Navigation")
+    if st.session_state.authenticated:
+        st.sidebar.success(f"Logged in as {st.session_state.username}")
+        
+        pages = {
+            "Home": home_page,
+            "Admin": admin_page,
+            "Progress": progress_page,
+            "Data": data_page,
+            "Variance": variance_page,
+            "Expiry": expiry_page,
+            "Departments": departments_page,
+            "Database": database_page,
+            "Templates": templates_page,
+            "Diagnostics": diagnostics_page,
+            "About": about_page
+        }
+        
+        if st.session_state.department != "SUPER_ADMIN":
+            del pages["Departments"]
+        
+        selected_page = st.sidebar.radio("Go to", list(pages.keys()))
+        
+        st.sidebar.markdown("---")
+        if st.sidebar.button("Logout"):
+            st.session_state.authenticated = False
+            st.rerun()
+        
+        with metrics.page_timer(selected_page):
+            pages[selected_page]()
+    else:
+        with metrics.page_timer("Login"):
+            login_page()
+
+if __name__ == "__main__":
     main()
\ No newline at end of file
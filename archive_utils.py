@@ -0,0 +1,235 @@
+import hashlib
+import json
+import os
+import re
+import time
+from pathlib import Path
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+from db_utils import (
+    db_cursor, fetch_all, cache, invalidate_cache, delete_table_records, delete_stocktake_table, compact_events,
+    is_counted
+)
+
+# Archived tables are stored here as one Parquet file per table
+ARCHIVE_DIR = Path(os.getenv('ARCHIVE_DIR', 'archive'))
+ARCHIVE_COMPRESSION = "zstd"
+# Archive files never change once written
+ARCHIVE_TTL = 3600
+
+ARCHIVE_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("drug_id", pa.int64()),
+    ("drug_name", pa.string()),
+    ("department", pa.string()),
+    ("packs", pa.int64()),
+    ("singles", pa.int64()),
+    ("expiry_date", pa.date32()),
+    ("last_updated", pa.timestamp("s")),
+    ("updated_by", pa.string()),
+])
+
+def archive_path(table):
+    department = re.sub(r"[^A-Za-z0-9_-]+", "_", table["department"])
+    return f"{department}/stocktake_{table['id']}.parquet"
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+def get_archive(table_id):
+    """table_archives row for a table, or None while its records are live."""
+    rows = fetch_all("SELECT * FROM table_archives WHERE table_id = %s", (table_id,))
+    return rows[0] if rows else None
+
+def list_archives(department=None):
+    department_filter, params = "", []
+    if department:
+        department_filter = "WHERE t.department = %s"
+        params.append(department)
+    return fetch_all(f'''
+        SELECT a.*, t.table_name, t.department, t.created_at
+        FROM table_archives a
+        JOIN stocktake_tables t ON t.id = a.table_id
+        {department_filter}
+        ORDER BY a.archived_at DESC
+    ''', params)
+
+def write_archive(table, rows):
+    """Write record rows to a Parquet file with the table's details in its metadata.
+
+    The file is written under a temporary name and renamed, so a crash
+    never leaves a partial file at the final path. Returns the path
+    relative to ARCHIVE_DIR.
+    """
+    relative = archive_path(table)
+    path = ARCHIVE_DIR / relative
+    path.parent.mkdir(parents=True, exist_ok=True)
+    details = {key: None if value is None else str(value) for key, value in table.items()}
+    frame = pa.Table.from_pylist(rows, schema=ARCHIVE_SCHEMA).replace_schema_metadata(
+        {"stocktake_table": json.dumps(details)}
+    )
+    temporary = path.with_suffix(".tmp")
+    pq.write_table(frame, temporary, compression=ARCHIVE_COMPRESSION)
+    temporary.replace(path)
+    return relative
+
+def archive_table(table_id, archived_by=None):
+    """Close a stocktake table and move its records to a Parquet file.
+
+    The file is written, read back and recorded in table_archives before
+    any record is deleted; the records then go in DELETE_BATCH_SIZE
+    batches. Re-running on a half-finished archive only finishes the
+    deletes. Returns a summary dict.
+    """
+    started = time.perf_counter()
+    with db_cursor() as (conn, cursor):
+        cursor.execute(
+            "SELECT id, table_name, department, access_code, created_at, created_by FROM stocktake_tables WHERE id = %s",
+            (table_id,)
+        )
+        table = cursor.fetchone()
+        if table is None:
+            raise ValueError(f"Stocktake table {table_id} does not exist")
+        # Closed tables take no more counts and drop out of the expiry report
+        cursor.execute("UPDATE stocktake_tables SET is_active = FALSE WHERE id = %s", (table_id,))
+        cursor.execute("DELETE FROM expiry_watch WHERE table_id = %s", (table_id,))
+        conn.commit()
+    invalidate_cache("tables")
+    invalidate_cache("progress")
+    # Counts saved before the table closed may still be waiting in the event log
+    compact_events()
+
+    archive = get_archive(table_id)
+    if archive is None:
+        rows = fetch_all('''
+            SELECT sr.id, sr.drug_id, d.drug_name, d.department, sr.packs, sr.singles,
+                   sr.expiry_date, sr.last_updated, sr.updated_by
+            FROM stocktake_records sr
+            JOIN drugs d ON sr.drug_id = d.id
+            WHERE sr.table_id = %s
+            ORDER BY d.drug_name, sr.id
+        ''', (table_id,))
+        relative = write_archive(table, rows)
+        path = ARCHIVE_DIR / relative
+        written = pq.read_metadata(path).num_rows
+        if written != len(rows):
+            raise IOError(f"Archive {path} has {written} rows, expected {len(rows)}")
+        archive = {
+            "table_id": table_id,
+            "file_path": relative,
+            "file_bytes": path.stat().st_size,
+            "sha256": file_sha256(path),
+            "line_count": len(rows),
+            "counted_lines": sum(is_counted(row["updated_by"]) for row in rows),
+            "total_packs": sum(row["packs"] or 0 for row in rows),
+            "total_singles": sum(row["singles"] or 0 for row in rows),
+            "archived_by": archived_by
+        }
+        columns = list(archive)
+        with db_cursor() as (conn, cursor):
+            cursor.execute(
+                f"INSERT INTO table_archives ({', '.join(columns)}) VALUES ({', '.join(['%s'] * len(columns))})",
+                [archive[column] for column in columns]
+            )
+            conn.commit()
+        invalidate_cache("tables")
+        invalidate_cache("progress")
+
+    deleted = delete_table_records(table_id)
+    elapsed = time.perf_counter() - started
+    print(f"✅ Archived stocktake table {table_id}: {archive['line_count']} records, "
+          f"{archive['file_bytes'] / 1024:.1f} KB at {archive['file_path']} ({deleted} deleted, {elapsed:.2f}s)")
+    return {
+        "table_id": table_id,
+        "file_path": archive["file_path"],
+        "lines": archive["line_count"],
+        "file_bytes": archive["file_bytes"],
+        "deleted": deleted,
+        "seconds": elapsed
+    }
+
+def read_archive(table_id):
+    """An archived table's records as a DataFrame ordered by (drug_name, id), or None.
+
+    The frame is cached and shared: callers must copy before modifying it.
+    """
+    archive = get_archive(table_id)
+    if archive is None:
+        return None
+    def load():
+        path = ARCHIVE_DIR / archive["file_path"]
+        if file_sha256(path) != archive["sha256"]:
+            raise IOError(f"Archive {path} does not match its recorded checksum")
+        return pq.read_table(path).to_pandas()
+    return cache.get_or_load(("archive", table_id), load, ARCHIVE_TTL)
+
+def get_archived_records_page(table_id, limit, after=None):
+    """One keyset page of an archived table, shaped like get_table_records_page()."""
+    records = read_archive(table_id)
+    if records is None:
+        return []
+    start = 0
+    if after:
+        # The file is already sorted by (drug_name, id), so seek to the row after the cursor
+        start = int(np.flatnonzero(records["id"].to_numpy() == after[1])[0]) + 1
+    page = records.iloc[start:start + limit]
+    return page[["id", "drug_id", "drug_name", "packs", "singles", "expiry_date", "last_updated"]].to_dict("records")
+
+def delete_table_and_archive(table_id):
+    """Delete a table and, once the database no longer points at it, its archive file."""
+    archive = get_archive(table_id)
+    deleted = delete_stocktake_table(table_id)
+    if archive is not None:
+        invalidate_cache("archive", table_id)
+        try:
+            (ARCHIVE_DIR / archive["file_path"]).unlink()
+        except FileNotFoundError:
+            pass
+    return deleted
+
+def stale_tables(days, department=None):
+    """Unarchived tables older than days, except the newest table of each department."""
+    department_filter, params = "", [days]
+    if department:
+        department_filter = "AND t.department = %s"
+        params.append(department)
+    return fetch_all(f'''
+        SELECT t.id, t.table_name, t.department, t.created_at
+        FROM stocktake_tables t
+        LEFT JOIN table_archives a ON a.table_id = t.id
+        WHERE a.table_id IS NULL AND t.created_at < CURDATE() - INTERVAL %s DAY {department_filter}
+          AND t.created_at < (
+              SELECT MAX(newest.created_at) FROM stocktake_tables newest
+              WHERE newest.department = t.department
+          )
+        ORDER BY t.created_at, t.id
+    ''', params)
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Archive old stocktake tables to Parquet")
+    parser.add_argument("--older-than", type=int, default=180, help="Days since the table was created")
+    parser.add_argument("--department")
+    parser.add_argument("--dry-run", action="store_true", help="List the tables without archiving them")
+    args = parser.parse_args()
+
+    tables = stale_tables(args.older_than, args.department)
+    if not tables:
+        print("✅ Nothing to archive.")
+    for table in tables:
+        if args.dry_run:
+            print(f"{table['id']}\t{table['department']}\t{table['created_at']}\t{table['table_name']}")
+            continue
+        try:
+            archive_table(table["id"], archived_by="archive_utils")
+        except Exception as e:
+            print(f"❌ Error archiving table {table['id']}: {e}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,151 @@
+import os
+import random
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+import mysql.connector
+import db_utils
+from db_utils import (
+    get_db_config, db_cursor, chunked, create_tables, run_migrations, refresh_expiry_watch,
+    refresh_table_progress, invalidate_cache
+)
+
+BENCH_DB_NAME = os.getenv('BENCH_DB_NAME', 'stocktake_bench')
+# Where SQLite benchmark databases live; kept between runs so --reuse works
+BENCH_DIR = Path(os.getenv('BENCH_DIR', tempfile.gettempdir()))
+
+DEPARTMENTS = ["ER", "ADMISSION", "MARTENITY", "THEATRE", "LAB", "RADIOLOGY", "DENTIST"]
+BENCH_USERS = [(f"{department.lower()}_bench", "bench_password", department) for department in DEPARTMENTS]
+
+SYLLABLES = ["am", "ox", "ci", "lin", "met", "for", "pra", "zol", "ce", "fa", "dox", "ry", "val", "sar", "tan",
+             "nif", "ed", "pine", "cef", "tri", "ax", "one", "hy", "dro", "chlo", "ro", "thi", "azi", "de", "mol"]
+STRENGTHS = ["5mg", "10mg", "20mg", "25mg", "50mg", "100mg", "250mg", "500mg", "1g", "2mg/ml", "125mg/5ml"]
+FORMS = ["Tablets", "Capsules", "Syrup", "Injection", "Suspension", "Cream", "Drops", "Inhaler"]
+
+def use_database(name=BENCH_DB_NAME, fresh=False):
+    """Point db_utils at a scratch database, creating it (or recreating it when fresh).
+
+    On SQLite the database is the file name.db in BENCH_DIR. Must run
+    before the first pooled connection, since the pool reads its settings once.
+    """
+    if db_utils.DB_BACKEND == "sqlite":
+        path = BENCH_DIR / f"{name}.db"
+        if fresh:
+            for stale in (path, Path(f"{path}-wal"), Path(f"{path}-shm")):
+                stale.unlink(missing_ok=True)
+        db_utils.SQLITE_PATH = str(path)
+        return str(path)
+    config = get_db_config()
+    config.pop('database')
+    conn = mysql.connector.connect(**config)
+    try:
+        cursor = conn.cursor()
+        if fresh:
+            cursor.execute(f"DROP DATABASE IF EXISTS `{name}`")
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{name}`")
+    finally:
+        conn.close()
+    os.environ['DB_NAME'] = name
+    return name
+
+def drug_names(count, rng):
+    names = set()
+    while len(names) < count:
+        stem = "".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))).capitalize()
+        names.add(f"{stem} {rng.choice(STRENGTHS)} {rng.choice(FORMS)}")
+    return sorted(names)
+
+def generate(drugs=10000, tables=500, seed=42):
+    """Fill the current database with a synthetic catalog and stocktake history.
+
+    Drugs are spread over DEPARTMENTS (a tenth with no department), and
+    tables are dated weekly back from today, round-robin over departments,
+    each holding a record for every drug with random counts and expiries.
+    Only the newest table per department stays active. Values are drawn
+    from one seeded generator in Python, so both backends get the same
+    data. Returns a summary dict.
+    """
+    started = time.perf_counter()
+    rng = random.Random(seed)
+
+    with db_cursor() as (conn, cursor):
+        create_tables(cursor)
+        conn.commit()
+    run_migrations()
+
+    with db_cursor() as (conn, cursor):
+        cursor.execute("SELECT COUNT(*) AS n FROM stocktake_tables")
+        if cursor.fetchone()["n"]:
+            raise RuntimeError("Benchmark database already has data; generate with fresh=True")
+
+        catalog = [(name, rng.choice(DEPARTMENTS) if rng.random() > 0.1 else None) for name in drug_names(drugs, rng)]
+        for batch in chunked(catalog, 1000):
+            cursor.executemany("INSERT INTO drugs (drug_name, department) VALUES (%s, %s)", batch)
+        cursor.executemany(
+            "INSERT INTO users (username, password, department, is_admin) VALUES (%s, %s, %s, TRUE)",
+            BENCH_USERS
+        )
+        cursor.execute("SELECT id FROM drugs ORDER BY id")
+        drug_ids = [row["id"] for row in cursor.fetchall()]
+        conn.commit()
+
+        now, today = datetime.now(), date.today()
+        weeks = -(-tables // len(DEPARTMENTS))
+        for number in range(tables):
+            department = DEPARTMENTS[number % len(DEPARTMENTS)]
+            weeks_ago = weeks - number // len(DEPARTMENTS)
+            cursor.execute(
+                "INSERT INTO stocktake_tables (table_name, department, access_code, created_at, created_by, is_active) "
+                "VALUES (%s, %s, %s, %s, 'bench', FALSE)",
+                (f"{department} week -{weeks_ago}", department, f"BENCH{number:05d}", now - timedelta(weeks=weeks_ago))
+            )
+            table_id = cursor.lastrowid
+            # Counts for roughly two thirds of the lines, expiries for a third
+            records = [
+                (table_id, drug_id,
+                 rng.randrange(40) if rng.random() < 0.66 else 0,
+                 rng.randrange(12),
+                 today + timedelta(days=rng.randrange(720) - 60) if rng.random() < 0.33 else None)
+                for drug_id in drug_ids
+            ]
+            for batch in chunked(records, 1000):
+                cursor.executemany(
+                    "INSERT INTO stocktake_records (table_id, drug_id, packs, singles, expiry_date, updated_by) "
+                    "VALUES (%s, %s, %s, %s, %s, 'bench')",
+                    batch
+                )
+            if number % 10 == 9:
+                conn.commit()
+
+        cursor.execute('''
+            UPDATE stocktake_tables t
+            JOIN (SELECT MAX(id) AS id FROM stocktake_tables GROUP BY department) latest ON latest.id = t.id
+            SET t.is_active = TRUE
+        ''')
+        refresh_expiry_watch(cursor)
+        refresh_table_progress(cursor)
+        conn.commit()
+
+    invalidate_cache()
+    elapsed = time.perf_counter() - started
+    print(f"✅ Generated {drugs} drugs and {tables} tables ({drugs * tables:,} records) in {elapsed:.1f}s")
+    return {"drugs": drugs, "tables": tables, "records": drugs * tables, "seed": seed, "seconds": elapsed}
+
+def sample_ids(seed=42):
+    """Ids the benchmarks pick from: tables, access codes and one active table's record ids."""
+    with db_cursor() as (conn, cursor):
+        cursor.execute("SELECT id, access_code FROM stocktake_tables WHERE created_by = 'bench' ORDER BY id")
+        tables = cursor.fetchall()
+        cursor.execute("SELECT id FROM stocktake_tables WHERE is_active AND created_by = 'bench' ORDER BY id LIMIT 1")
+        active_id = cursor.fetchone()["id"]
+        cursor.execute("SELECT id FROM stocktake_records WHERE table_id = %s", (active_id,))
+        record_ids = [row["id"] for row in cursor.fetchall()]
+    rng = random.Random(seed)
+    rng.shuffle(record_ids)
+    return {
+        "table_ids": [row["id"] for row in tables],
+        "access_codes": [row["access_code"] for row in tables],
+        "active_table_id": active_id,
+        "record_ids": record_ids
+    }
@@ -0,0 +1,402 @@
+"""Simulate concurrent counters and admins against both apps and report capacity numbers as JSON.
+
+    python -m benchmarks.load --counters 20 --admins 2 --duration 120
+    DB_BACKEND=mysql python -m benchmarks.load --counters 50 --processes 8 --out load.json
+
+Each simulated user is a headless session of user_app.py or admin_app.py
+driven through Streamlit's AppTest. Counters log in, search, count a line
+and let auto-save write it, and page through their table; admins view
+the Progress, Data and Departments pages and export tables. Sessions are
+spread over worker processes that all hit the same database. By default
+a SQLite file in a scratch directory stands in for MySQL; with
+DB_BACKEND=mysql the run uses the scratch database BENCH_DB_NAME, never
+the ward database.
+"""
+import argparse
+import heapq
+import json
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import redirect_stdout
+from datetime import datetime
+from pathlib import Path
+
+# Must be set before db_utils is imported: it reads the backend and paths once.
+# Workers inherit LOAD_DIR, so they open the same scratch files.
+LOAD_DIR = Path(os.getenv('LOAD_DIR') or tempfile.mkdtemp(prefix="stocktake_load_"))
+os.environ['LOAD_DIR'] = str(LOAD_DIR)
+os.environ.setdefault('DB_BACKEND', 'sqlite')
+os.environ['SQLITE_PATH'] = str(LOAD_DIR / "stocktake.db")
+os.environ['OFFLINE_STORE'] = str(LOAD_DIR / "ward_store.db")
+os.environ['ARCHIVE_DIR'] = str(LOAD_DIR / "archive")
+
+from streamlit.testing.v1 import AppTest
+from benchmarks import dataset
+from benchmarks.run import summarize, git_commit
+import db_utils
+from db_utils import db_cursor, chunked, create_tables, run_migrations, create_stocktake_table, invalidate_cache
+from export_utils import export_csv, export_excel
+from metrics_utils import metrics
+
+ROOT = Path(__file__).resolve().parent.parent
+LOAD_ADMIN = ("load_admin", "load_password", "SUPER_ADMIN")
+# A single run can load a whole table on first open, so allow for slow runs under load
+RUN_TIMEOUT = 120
+ADMIN_PAGES = ["Progress", "Data", "Departments"]
+# Head start for workers to import Streamlit before the clock starts
+WORKER_STARTUP_SECONDS = 5
+
+class Recorder:
+    """Latency samples and error counts per action for the sessions of one worker."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = {}
+        self.errors = {}
+        self.counts = {"saved_rows": 0, "conflicts": 0, "failed_rows": 0}
+
+    def add(self, action, seconds, error=None):
+        with self._lock:
+            self.samples.setdefault(action, []).append(seconds)
+            if error:
+                self.errors.setdefault(action, []).append(error)
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counts[name] += value
+
+    def run(self, action, at):
+        """Rerun the app and record how long the whole script run took."""
+        started = time.perf_counter()
+        try:
+            at.run(timeout=RUN_TIMEOUT)
+        except Exception as e:
+            self.add(action, time.perf_counter() - started, f"{type(e).__name__}: {e}")
+            raise
+        self.add(action, time.perf_counter() - started, at.exception[0].message if at.exception else None)
+        return at
+
+    def call(self, action, function, *args):
+        started = time.perf_counter()
+        try:
+            function(*args)
+        except Exception as e:
+            self.add(action, time.perf_counter() - started, f"{type(e).__name__}: {e}")
+        else:
+            self.add(action, time.perf_counter() - started)
+
+    def operations(self):
+        with self._lock:
+            return {
+                action: {**summarize(samples), "errors": len(self.errors.get(action, []))}
+                for action, samples in sorted(self.samples.items())
+            }
+
+    def error_samples(self, limit=5):
+        with self._lock:
+            return {action: errors[:limit] for action, errors in sorted(self.errors.items())}
+
+def seed(drugs, seed_value):
+    """Fill the current database with a catalog, one admin and one active table per department.
+
+    Uses only statements both backends accept, so it runs on SQLite
+    as well as MySQL. Returns the tables as id/department/access_code dicts.
+    """
+    rng = random.Random(seed_value)
+    with db_cursor() as (conn, cursor):
+        create_tables(cursor)
+        conn.commit()
+    run_migrations()
+
+    with db_cursor() as (conn, cursor):
+        cursor.execute("SELECT COUNT(*) AS n FROM stocktake_tables")
+        if cursor.fetchone()["n"]:
+            raise RuntimeError("Load test database already has data; point it at an empty database")
+        catalog = [(name, rng.choice(dataset.DEPARTMENTS)) for name in dataset.drug_names(drugs, rng)]
+        for batch in chunked(catalog, 1000):
+            cursor.executemany("INSERT INTO drugs (drug_name, department) VALUES (%s, %s)", batch)
+        cursor.execute(
+            "INSERT INTO users (username, password, department, is_admin) VALUES (%s, %s, %s, TRUE)",
+            LOAD_ADMIN
+        )
+        conn.commit()
+    invalidate_cache()
+
+    tables = []
+    for number, department in enumerate(dataset.DEPARTMENTS):
+        access_code = f"LOAD{number:04d}"
+        table_id, rows, _ = create_stocktake_table(f"{department} load test", department, access_code, "load")
+        tables.append({"id": table_id, "department": department, "access_code": access_code, "lines": rows})
+    print(f"✅ Seeded {drugs} drugs and {len(tables)} tables of {tables[0]['lines']} lines in {LOAD_DIR}")
+    return tables
+
+def drug_names_in_db():
+    with db_cursor() as (conn, cursor):
+        cursor.execute("SELECT drug_name FROM drugs")
+        return [row["drug_name"] for row in cursor.fetchall()]
+
+def widget(widgets, label):
+    return next(w for w in widgets if w.label == label)
+
+def think_time(rng, think):
+    return rng.uniform(0, 2 * think)
+
+def counter_session(number, table, names, recorder, think):
+    """One counter: log in, then search, count, save and browse.
+
+    A generator that yields the think time after each action, so one
+    worker can interleave many sessions.
+    """
+    rng = random.Random(number)
+    at = AppTest.from_file(str(ROOT / "user_app.py"), default_timeout=RUN_TIMEOUT)
+    recorder.run("counter_start", at)
+    at.sidebar.selectbox[0].set_value(table["department"])
+    at.sidebar.text_input[0].set_value(table["access_code"])
+    at.sidebar.text_input[1].set_value(f"counter {number}")
+    at.sidebar.button[0].click()
+    recorder.run("counter_login", at)
+    at.sidebar.radio[0].set_value("Stocktake")
+    recorder.run("stocktake_open", at)
+    next_key = f"stocktake_{table['id']}_100_next"
+    yield think_time(rng, think)
+
+    while True:
+        # A full name usually matches one line, which opens in the per-row form
+        widget(at.text_input, "Search Drugs").set_value(rng.choice(names))
+        recorder.run("search", at)
+        yield think_time(rng, think)
+
+        packs = [w for w in at.number_input if w.key and w.key.startswith("packs_")]
+        if packs:
+            record_id = packs[0].key.split("_", 1)[1]
+            packs[0].set_value(rng.randint(0, 40))
+            at.button(key=f"update_{record_id}").click()
+            recorder.run("queue_update", at)
+            # Save as the auto-save fragment does once its interval has passed
+            at.session_state["pending_since"] = float("-inf")
+            recorder.run("save", at)
+            report = at.session_state["flush_report"] or {}
+            recorder.count("saved_rows", report.get("updated", 0))
+            recorder.count("failed_rows", len(report.get("failed", [])))
+            if at.session_state["conflicts"]:
+                recorder.count("conflicts", len(at.session_state["conflicts"]))
+                at.session_state["conflicts"] = {}
+            yield think_time(rng, think)
+
+        widget(at.text_input, "Search Drugs").set_value("")
+        recorder.run("browse", at)
+        next_buttons = [w for w in at.button if w.key == next_key and not w.disabled]
+        if next_buttons:
+            next_buttons[0].click()
+            recorder.run("next_page", at)
+        yield think_time(rng, think)
+
+def admin_session(number, tables, recorder, think):
+    """One SUPER_ADMIN: log in, then view pages and export tables."""
+    rng = random.Random(10000 + number)
+    at = AppTest.from_file(str(ROOT / "admin_app.py"), default_timeout=RUN_TIMEOUT)
+    recorder.run("admin_start", at)
+    at.text_input[0].set_value(LOAD_ADMIN[0])
+    at.text_input[1].set_value(LOAD_ADMIN[1])
+    at.button[0].click()
+    recorder.run("admin_login", at)
+    yield think_time(rng, think)
+
+    while True:
+        page = rng.choice(ADMIN_PAGES)
+        at.sidebar.radio[0].set_value(page)
+        recorder.run(f"admin_{page.lower()}", at)
+        yield think_time(rng, think)
+        # The download buttons call these when clicked, which AppTest cannot do
+        table_id = rng.choice(tables)["id"]
+        if rng.random() < 0.5:
+            recorder.call("export_csv", export_csv, table_id)
+        else:
+            recorder.call("export_excel", export_excel, table_id)
+        yield think_time(rng, think)
+
+def locking_statement(sql):
+    return (sql.startswith(("INSERT", "UPDATE", "DELETE")) or "FOR UPDATE" in sql
+            or "LOCK IN SHARE MODE" in sql)
+
+def worker(sessions, tables, names, start_at, ramp, deadline, think):
+    """Drive a share of the sessions in this process until the deadline; returns raw samples.
+
+    AppTest swaps process-wide Streamlit state on every run, so runs in
+    one process cannot overlap: the sessions take turns, each resuming
+    when its think time is up. Concurrency comes from running several
+    workers, which share the database but not the pool or caches.
+    """
+    # Anything the apps print goes to stderr, like the parent's, to keep stdout valid JSON
+    with redirect_stdout(sys.stderr):
+        return drive(sessions, tables, names, start_at, ramp, deadline, think)
+
+def drive(sessions, tables, names, start_at, ramp, deadline, think):
+    recorder = Recorder()
+    metrics.reset()
+    queue = []
+    for position, (kind, number, spread) in enumerate(sessions):
+        if kind == "counter":
+            generator = counter_session(number, tables[number % len(tables)], names, recorder, think)
+        else:
+            generator = admin_session(number, tables, recorder, think)
+        heapq.heappush(queue, (start_at + ramp * spread, position, generator))
+
+    while queue:
+        ready_at, position, generator = heapq.heappop(queue)
+        if ready_at >= deadline:
+            continue
+        time.sleep(max(0.0, ready_at - time.time()))
+        try:
+            delay = next(generator)
+        except Exception as e:
+            # A session that crashes is counted, and the others carry on
+            recorder.add("session_crash", 0.0, f"{type(e).__name__}: {e}")
+            continue
+        heapq.heappush(queue, (time.time() + delay, position, generator))
+
+    with metrics._lock:
+        pages = {page: list(stats["samples"]) for page, stats in metrics.pages.items()}
+        locks = {sql: list(stats["samples"]) for sql, stats in metrics.queries.items() if locking_statement(sql)}
+    return {
+        "samples": recorder.samples,
+        "errors": recorder.errors,
+        "counts": recorder.counts,
+        "pages": pages,
+        "locks": locks,
+        "connections": metrics.connection_stats(),
+        "finished_at": time.time()
+    }
+
+def server_status():
+    """InnoDB row lock and connection counters on MySQL; SQLite does not keep any."""
+    if db_utils.DB_BACKEND != "mysql":
+        return {}
+    with db_cursor() as (conn, cursor):
+        cursor.execute("SHOW GLOBAL STATUS WHERE Variable_name IN "
+                       "('Innodb_row_lock_waits', 'Innodb_row_lock_time', 'Innodb_row_lock_time_max', "
+                       "'Threads_connected', 'Max_used_connections')")
+        return {row["Variable_name"]: float(row["Value"]) for row in cursor.fetchall()}
+
+def merge(parts):
+    merged = {}
+    for part in parts:
+        for key, values in part.items():
+            merged.setdefault(key, []).extend(values)
+    return merged
+
+def run_load(tables, names, counters, admins, duration, think, ramp, processes):
+    """Spread the sessions over worker processes, wait for them and combine their results."""
+    sessions = [("counter", number) for number in range(counters)] + [("admin", number) for number in range(admins)]
+    # Every session gets its own start offset within the ramp, whichever worker it lands on
+    sessions = [(kind, number, position / len(sessions)) for position, (kind, number) in enumerate(sessions)]
+    processes = max(1, min(processes, len(sessions)))
+    before = server_status()
+    start_at = time.time() + WORKER_STARTUP_SECONDS
+    deadline = start_at + ramp + duration
+
+    with ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn")) as pool:
+        futures = [
+            pool.submit(worker, sessions[index::processes], tables, names, start_at, ramp, deadline, think)
+            for index in range(processes)
+        ]
+        parts = [future.result() for future in futures]
+    after = server_status()
+    elapsed = max(part["finished_at"] for part in parts) - start_at
+
+    recorder = Recorder()
+    recorder.samples = merge(part["samples"] for part in parts)
+    recorder.errors = merge(part["errors"] for part in parts)
+    for part in parts:
+        for name, value in part["counts"].items():
+            recorder.count(name, value)
+    operations = recorder.operations()
+    actions = sum(stats["n"] for name, stats in operations.items() if name != "session_crash")
+    print(f"✅ {len(sessions)} sessions in {processes} workers ran {actions} actions in {elapsed:.1f}s")
+
+    connections = {
+        name: sum(part["connections"][name] for part in parts)
+        for name in ("checkouts", "waits", "wait_seconds", "errors")
+    }
+    # Each worker has its own pool, so the per-worker peaks add up to an upper bound
+    connections["peak_in_use"] = sum(part["connections"]["peak_in_use"] for part in parts)
+    connections["workers"] = processes
+    locks = {"statements": sorted(
+        ({"sql": sql[:160], **summarize(samples)} for sql, samples in merge(part["locks"] for part in parts).items()),
+        key=lambda row: row["p95_ms"], reverse=True
+    )}
+    if before:
+        locks["innodb_row_lock_waits"] = after["Innodb_row_lock_waits"] - before["Innodb_row_lock_waits"]
+        locks["innodb_row_lock_time_ms"] = after["Innodb_row_lock_time"] - before["Innodb_row_lock_time"]
+        locks["innodb_row_lock_time_max_ms"] = after["Innodb_row_lock_time_max"]
+        connections["server_threads_connected"] = after["Threads_connected"]
+        connections["server_max_used_connections"] = after["Max_used_connections"]
+
+    return {
+        "seconds": round(elapsed, 1),
+        "throughput": {
+            "actions_per_second": round(actions / elapsed, 2),
+            "saves_per_second": round(operations.get("save", {}).get("n", 0) / elapsed, 2),
+            **recorder.counts
+        },
+        "operations": operations,
+        "errors": recorder.error_samples(),
+        "pages": {page: summarize(samples) for page, samples in sorted(merge(part["pages"] for part in parts).items())},
+        "connections": connections,
+        "locks": locks
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test both Streamlit apps with simulated concurrent users")
+    parser.add_argument("--counters", type=int, default=10, help="Simulated counters, spread over the departments")
+    parser.add_argument("--admins", type=int, default=1)
+    parser.add_argument("--duration", type=float, default=60, help="Seconds to run after the last session starts")
+    parser.add_argument("--ramp", type=float, default=5, help="Seconds over which sessions start")
+    parser.add_argument("--think", type=float, default=0.5, help="Mean seconds a user pauses between actions")
+    parser.add_argument("--processes", type=int, default=os.cpu_count(), help="Worker processes the sessions are spread over")
+    parser.add_argument("--drugs", type=int, default=2000)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--database", default=dataset.BENCH_DB_NAME, help="Scratch MySQL database (dropped first)")
+    parser.add_argument("--out", help="Write the JSON results here as well as to stdout")
+    args = parser.parse_args()
+
+    if db_utils.DB_BACKEND == "mysql" and args.database == os.getenv('DB_NAME'):
+        sys.exit(f"❌ Refusing to load test against the configured database '{args.database}'")
+
+    # Progress messages go to stderr so stdout stays valid JSON
+    with redirect_stdout(sys.stderr):
+        if db_utils.DB_BACKEND == "mysql":
+            dataset.use_database(args.database, fresh=True)
+        tables = seed(args.drugs, args.seed)
+        results = run_load(tables, drug_names_in_db(), args.counters, args.admins, args.duration, args.think,
+                           args.ramp, args.processes)
+
+    results["meta"] = {
+        "commit": git_commit(),
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "backend": db_utils.DB_BACKEND,
+        "database": args.database if db_utils.DB_BACKEND == "mysql" else os.environ['SQLITE_PATH'],
+        "counters": args.counters,
+        "admins": args.admins,
+        "duration": args.duration,
+        "think": args.think,
+        "processes": results["connections"]["workers"],
+        "drugs": args.drugs,
+        "lines_per_table": tables[0]["lines"],
+        "pool_size": db_utils.POOL_SIZE,
+        "seed": args.seed
+    }
+    output = json.dumps(results, indent=2, default=str)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as handle:
+            handle.write(output)
+
+if __name__ == "__main__":
+    main()
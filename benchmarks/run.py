@@ -0,0 +1,244 @@
+"""Time the hot paths against a synthetic dataset and report p50/p95 as JSON.
+
+    python -m benchmarks.run --out results.json
+    python -m benchmarks.run --reuse --compare results.json
+
+Runs against a scratch database (BENCH_DB_NAME, default stocktake_bench),
+never the ward database. By default that is a SQLite file in BENCH_DIR;
+with DB_BACKEND=mysql it is a database on the server configured in .env.
+"""
+import argparse
+import gc
+import io
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from contextlib import redirect_stdout
+from datetime import datetime, date
+
+# Must be set before db_utils is imported: it reads the backend once
+os.environ.setdefault('DB_BACKEND', 'sqlite')
+
+from benchmarks import dataset
+import db_utils
+from db_utils import (
+    create_stocktake_table, get_table_records, get_table_records_page, record_cursor,
+    find_table_by_access_code, find_user, update_stocktake_records, compact_events, invalidate_cache,
+    get_changed_records, fetch_all
+)
+from catalog_utils import get_catalog, invalidate_catalog
+from export_utils import write_csv, write_workbook
+from search_utils import get_drug_index, invalidate_drug_index, search_drugs
+
+# Full-table load as it was before records were fetched as compact rows
+JOINED_RECORDS_SQL = '''
+    SELECT sr.id, sr.drug_id, d.drug_name, sr.packs, sr.singles, sr.expiry_date, sr.last_updated, sr.updated_by
+    FROM stocktake_records sr
+    JOIN drugs d ON sr.drug_id = d.id
+    WHERE sr.table_id = %s
+    ORDER BY d.drug_name, sr.id
+'''
+
+SEARCH_QUERIES = ["am", "amox", "cef 500", "500mg caps", "tablets", "syrup", "oxlin", "metfor", "amoxcilin", "zzzz", "dro 10mg"]
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+def summarize(samples):
+    return {
+        "n": len(samples),
+        "p50_ms": round(percentile(samples, 0.5) * 1000, 3),
+        "p95_ms": round(percentile(samples, 0.95) * 1000, 3),
+        "mean_ms": round(sum(samples) / len(samples) * 1000, 3),
+        "min_ms": round(min(samples) * 1000, 3),
+        "max_ms": round(max(samples) * 1000, 3)
+    }
+
+def measure(operation, repeat, setup=None):
+    """Call operation(i) repeat times (after setup(i), untimed) and summarize the timings."""
+    samples = []
+    for i in range(repeat):
+        if setup:
+            setup(i)
+        started = time.perf_counter()
+        operation(i)
+        samples.append(time.perf_counter() - started)
+    return summarize(samples)
+
+def cold(i):
+    invalidate_cache()
+
+def retained_bytes(load):
+    """Call load() and return (result, bytes still allocated for it afterwards)."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = load()
+        gc.collect()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return result, after - before
+
+def payload_bytes(rows):
+    # Rough size of the rows in MySQL's text protocol: each value as text plus a length byte
+    values = (row.values() if isinstance(row, dict) else row for row in rows)
+    return sum(len(str(value)) + 1 if value is not None else 1 for row in values for value in row)
+
+def footprint(table_id):
+    """Memory held by one session's full copy of a table: joined dict rows vs compact rows.
+
+    The shared catalog is reported separately, since one copy serves
+    every session in the process.
+    """
+    joined, joined_bytes = retained_bytes(lambda: fetch_all(JOINED_RECORDS_SQL, (table_id,)))
+    compact, compact_bytes = retained_bytes(lambda: get_changed_records(table_id))
+    invalidate_catalog()
+    catalog, catalog_bytes = retained_bytes(get_catalog)
+    return {
+        "records": len(compact),
+        "joined_dicts": {"bytes_held": joined_bytes, "payload_bytes": payload_bytes(joined)},
+        "compact_rows": {"bytes_held": compact_bytes, "payload_bytes": payload_bytes(compact)},
+        "shared_catalog": {"drugs": len(catalog), "bytes_held": catalog_bytes}
+    }
+
+def run_benchmarks(ids, repeat, seed=42):
+    rng = random.Random(seed)
+    table_ids = ids["table_ids"]
+    picks = [rng.choice(table_ids) for _ in range(repeat * 10)]
+    active_id = ids["active_table_id"]
+    middle = get_table_records(active_id)[len(ids["record_ids"]) // 2]
+    results = {}
+    # Saves only append count events. Folding them in is timed on its own below,
+    # rather than left to the background compactor to overlap later timings.
+    db_utils.BACKGROUND_COMPACTION = False
+
+    def create_table(i):
+        create_stocktake_table(f"Bench create {i}", "ER", f"BENCHNEW{time.time_ns()}", "bench-create")
+    results["create_stocktake_table"] = measure(create_table, max(3, repeat // 4))
+
+    results["record_page_first_cold"] = measure(lambda i: get_table_records_page(picks[i], 50), repeat, setup=cold)
+    results["record_page_deep_cold"] = measure(
+        lambda i: get_table_records_page(active_id, 50, after=record_cursor(middle)), repeat, setup=cold
+    )
+    results["record_page_cached"] = measure(lambda i: get_table_records_page(active_id, 50), repeat * 10)
+    results["table_records_full_cold"] = measure(lambda i: get_table_records(picks[i]), max(3, repeat // 2), setup=cold)
+    results["snapshot_load_joined"] = measure(lambda i: fetch_all(JOINED_RECORDS_SQL, (picks[i],)), max(3, repeat // 2))
+    results["snapshot_load_compact"] = measure(lambda i: get_changed_records(picks[i]), max(3, repeat // 2))
+
+    results["search_index_build"] = measure(lambda i: get_drug_index(), 3, setup=lambda i: invalidate_drug_index())
+    results["search"] = measure(lambda i: search_drugs(SEARCH_QUERIES[i % len(SEARCH_QUERIES)]), repeat * 10)
+    results["search_department"] = measure(
+        lambda i: search_drugs(SEARCH_QUERIES[i % len(SEARCH_QUERIES)], department="ER"), repeat * 10
+    )
+
+    results["export_csv"] = measure(lambda i: write_csv(picks[i], io.BytesIO()), max(3, repeat // 4))
+    results["export_xlsx"] = measure(lambda i: write_workbook([("Bench", picks[i])], io.BytesIO()), 3)
+
+    results["login_access_code"] = measure(lambda i: find_table_by_access_code(rng.choice(ids["access_codes"])), repeat * 4)
+    results["login_admin"] = measure(lambda i: find_user(*rng.choice(dataset.BENCH_USERS)[:2]), repeat * 4)
+
+    def update_counts(i):
+        batch = ids["record_ids"][(i * 300) % len(ids["record_ids"]):][:300]
+        rows = [
+            {"id": record_id, "packs": rng.randint(0, 40), "singles": rng.randint(0, 11),
+             "expiry_date": date.today().replace(day=1).isoformat() if record_id % 3 == 0 else None}
+            for record_id in batch
+        ]
+        update_stocktake_records(active_id, rows, updated_by="bench")
+    results["update_300_counts"] = measure(update_counts, max(3, repeat // 2))
+    compact_events()
+    results["compact_300_counts"] = measure(lambda i: compact_events(), max(3, repeat // 2), setup=update_counts)
+    return results
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare(results, baseline, tolerance):
+    """Operations whose p95 grew more than tolerance percent (and over 1 ms) against baseline."""
+    regressions = []
+    for operation, stats in results["operations"].items():
+        before = baseline.get("operations", {}).get(operation)
+        if not before:
+            continue
+        limit = before["p95_ms"] * (1 + tolerance / 100)
+        if stats["p95_ms"] > limit and stats["p95_ms"] - before["p95_ms"] > 1:
+            regressions.append((operation, before["p95_ms"], stats["p95_ms"]))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the stocktake hot paths on synthetic data")
+    parser.add_argument("--database", default=dataset.BENCH_DB_NAME, help="Scratch database (dropped unless --reuse)")
+    parser.add_argument("--drugs", type=int, default=10000)
+    parser.add_argument("--tables", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--repeat", type=int, default=20, help="Base repetitions per operation")
+    parser.add_argument("--reuse", action="store_true", help="Keep the existing benchmark data instead of regenerating")
+    parser.add_argument("--out", help="Write the JSON results here as well as to stdout")
+    parser.add_argument("--compare", help="Baseline JSON to check for p95 regressions")
+    parser.add_argument("--tolerance", type=float, default=20, help="Allowed p95 growth in percent")
+    args = parser.parse_args()
+
+    if db_utils.DB_BACKEND == "mysql" and args.database == os.getenv('DB_NAME'):
+        sys.exit(f"❌ Refusing to benchmark against the configured database '{args.database}'")
+
+    # Progress messages go to stderr so stdout stays valid JSON
+    with redirect_stdout(sys.stderr):
+        database = dataset.use_database(args.database, fresh=not args.reuse)
+        generated = None if args.reuse else dataset.generate(args.drugs, args.tables, args.seed)
+        ids = dataset.sample_ids(args.seed)
+        operations = run_benchmarks(ids, args.repeat, args.seed)
+        memory = footprint(ids["active_table_id"])
+
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "backend": db_utils.DB_BACKEND,
+            "database": database,
+            "drugs": args.drugs,
+            "tables": len(ids["table_ids"]),
+            "records_per_table": len(ids["record_ids"]),
+            "repeat": args.repeat,
+            "seed": args.seed,
+            "pool_size": db_utils.POOL_SIZE,
+            "generated": generated
+        },
+        "operations": operations,
+        "memory": memory
+    }
+
+    output = json.dumps(results, indent=2, default=str)
+    print(output)
+    if args.out:
+        with open(args.out, "w") as handle:
+            handle.write(output)
+
+    if args.compare:
+        with open(args.compare) as handle:
+            baseline = json.load(handle)
+        regressions = compare(results, baseline, args.tolerance)
+        for operation, before, after in regressions:
+            print(f"❌ {operation}: p95 {before:.1f} ms -> {after:.1f} ms", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print(f"✅ No p95 regressions over {args.tolerance:.0f}% against {args.compare}", file=sys.stderr)
+
+if __name__ == "__main__":
+    main()
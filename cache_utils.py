@@ -0,0 +1,77 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+
+class TTLCache:
+    """Thread-safe LRU cache with per-entry expiry, shared by every session in the process.
+
+    Keys are tuples whose first item is a namespace such as "drugs" or
+    "records"; invalidate() drops every key that starts with a prefix.
+    """
+
+    def __init__(self, max_entries=512, default_ttl=60):
+        self.max_entries = max_entries
+        self.default_ttl = default_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = Counter()
+        self.misses = Counter()
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get_or_load(self, key, loader, ttl=None):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.hits[key[0]] += 1
+                return entry[1]
+            self.misses[key[0]] += 1
+            generation = self._generation
+
+        value = loader()
+
+        with self._lock:
+            # A write that invalidated while we were loading makes this value stale
+            if generation == self._generation:
+                self._entries[key] = (time.monotonic() + (ttl or self.default_ttl), value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self.evictions += 1
+        return value
+
+    def invalidate(self, *prefix):
+        with self._lock:
+            self._generation += 1
+            stale = [key for key in self._entries if key[:len(prefix)] == prefix]
+            for key in stale:
+                del self._entries[key]
+            self.invalidations += len(stale)
+
+    def clear(self):
+        self.invalidate()
+
+    def stats(self):
+        with self._lock:
+            namespaces = sorted(set(self.hits) | set(self.misses))
+            by_namespace = [
+                {
+                    "namespace": namespace,
+                    "hits": self.hits[namespace],
+                    "misses": self.misses[namespace],
+                    "hit_ratio": round(self.hits[namespace] / max(1, self.hits[namespace] + self.misses[namespace]), 3)
+                }
+                for namespace in namespaces
+            ]
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": sum(self.hits.values()),
+                "misses": sum(self.misses.values()),
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "namespaces": by_namespace
+            }
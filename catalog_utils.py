@@ -0,0 +1,106 @@
+import sys
+import threading
+import time
+from array import array
+from bisect import bisect_left
+from db_utils import db_cursor
+
+# How often to ask the database whether the drug list changed
+REFRESH_CHECK_SECONDS = 30
+
+class DrugCatalog:
+    """Read-only id -> (name, department) map shared by every session.
+
+    Ids sit in a sorted array and names in a parallel tuple of interned
+    strings, so the catalog costs one string per drug for the whole
+    process instead of one per record per session.
+    """
+
+    __slots__ = ("signature", "ids", "names", "departments")
+
+    def __init__(self, rows, signature=None):
+        # rows are (id, drug_name, department) tuples ordered by id
+        self.signature = signature
+        self.ids = array("q", (row[0] for row in rows))
+        self.names = tuple(sys.intern(row[1]) for row in rows)
+        self.departments = tuple(sys.intern(row[2]) if row[2] else None for row in rows)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, drug_id):
+        position = bisect_left(self.ids, drug_id)
+        return position < len(self.ids) and self.ids[position] == drug_id
+
+    def _position(self, drug_id):
+        position = bisect_left(self.ids, drug_id)
+        if position == len(self.ids) or self.ids[position] != drug_id:
+            raise KeyError(drug_id)
+        return position
+
+    def name(self, drug_id):
+        return self.names[self._position(drug_id)]
+
+    def department(self, drug_id):
+        return self.departments[self._position(drug_id)]
+
+    def drugs(self):
+        """The catalog as id/drug_name/department dicts, e.g. for DrugIndex."""
+        return [
+            {"id": drug_id, "drug_name": name, "department": department}
+            for drug_id, name, department in zip(self.ids, self.names, self.departments)
+        ]
+
+_catalog = None
+_checked_at = 0.0
+_catalog_lock = threading.Lock()
+
+def catalog_signature(cursor):
+    # Count and max id catch inserts made outside the app; the version catches updates
+    cursor.execute('''
+        SELECT COUNT(*) AS drug_count, MAX(id) AS max_id,
+               (SELECT version FROM catalog_version WHERE id = 1) AS version
+        FROM drugs
+    ''')
+    row = cursor.fetchone()
+    return (row["drug_count"], row["max_id"], row["version"])
+
+def is_current(catalog, drug_ids):
+    return (catalog is not None and time.monotonic() - _checked_at < REFRESH_CHECK_SECONDS
+            and all(drug_id in catalog for drug_id in drug_ids))
+
+def get_catalog(drug_ids=()):
+    """Process-wide catalog, reloaded when the drugs table changes.
+
+    Also checks again straight away if any of drug_ids is unknown, e.g.
+    a drug added by the admin app since the last check.
+    """
+    global _catalog, _checked_at
+    if is_current(_catalog, drug_ids):
+        return _catalog
+
+    with _catalog_lock:
+        if is_current(_catalog, drug_ids):
+            return _catalog
+        with db_cursor() as (conn, cursor):
+            signature = catalog_signature(cursor)
+            if _catalog is None or _catalog.signature != signature:
+                rows = conn.cursor()
+                try:
+                    rows.execute("SELECT id, drug_name, department FROM drugs ORDER BY id")
+                    _catalog = DrugCatalog(rows.fetchall(), signature)
+                finally:
+                    rows.close()
+        _checked_at = time.monotonic()
+    return _catalog
+
+def invalidate_catalog():
+    # Called after writes to drugs so the next lookup reloads immediately
+    global _catalog
+    with _catalog_lock:
+        _catalog = None
+
+def with_names(records):
+    """Record rows as dicts with drug_name filled in from the catalog."""
+    catalog = get_catalog({record.drug_id for record in records})
+    return [{**record._asdict(), "drug_name": catalog.name(record.drug_id)} for record in records]
@@ -1,119 +1,1346 @@
-import mysql.connector
-import pandas as pd
-import os
-from dotenv import load_dotenv
-from pathlib import Path
-
-load_dotenv()
-
-def get_db_connection():
-    return mysql.connector.connect(
-        host=os.getenv('DB_HOST'),
-        user=os.getenv('DB_USER'),
-        password=os.getenv('DB_PASSWORD'),
-        database=os.getenv('DB_NAME'),
-        port=os.getenv('DB_PORT', '3306')
-    )
-
-def initialize_database():
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    
-    try:
-        # Create tables
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS drugs (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            drug_name VARCHAR(255) UNIQUE NOT NULL,
-            department VARCHAR(50),
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS stocktake_tables (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            table_name VARCHAR(255) NOT NULL,
-            department VARCHAR(50) NOT NULL,
-            access_code VARCHAR(50) UNIQUE NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            created_by VARCHAR(100),
-            is_active BOOLEAN DEFAULT TRUE
-        )
-        ''')
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS stocktake_records (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            table_id INT NOT NULL,
-            drug_id INT NOT NULL,
-            packs INT DEFAULT 0,
-            singles INT DEFAULT 0,
-            expiry_date DATE,
-            last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            updated_by VARCHAR(100),
-            FOREIGN KEY (table_id) REFERENCES stocktake_tables(id),
-            FOREIGN KEY (drug_id) REFERENCES drugs(id)
-        )
-        ''')
-        
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            id INT AUTO_INCREMENT PRIMARY KEY,
-            username VARCHAR(100) UNIQUE NOT NULL,
-            password VARCHAR(255) NOT NULL,
-            department VARCHAR(50) NOT NULL,
-            is_admin BOOLEAN DEFAULT FALSE,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-        )
-        ''')
-        
-        # Insert admin users
-        admins = [
-            ("er_admin", "er_password123", "ER"),
-            ("admission_admin", "admission_password123", "ADMISSION"),
-            ("martenity_admin", "martenity_password123", "MARTENITY"),
-            ("theatre_admin", "theatre_password123", "THEATRE"),
-            ("lab_admin", "lab_password123", "LAB"),
-            ("radiology_admin", "radiology_password123", "RADIOLOGY"),
-            ("dentist_admin", "dentist_password123", "DENTIST"),
-            ("super_admin", "super_password123", "SUPER_ADMIN")
-        ]
-        
-        for username, password, department in admins:
-            try:
-                cursor.execute(
-                    "INSERT INTO users (username, password, department, is_admin) VALUES (%s, %s, %s, TRUE)",
-                    (username, password, department)
-                )
-            except mysql.connector.IntegrityError:
-                conn.rollback()
-        
-        # Import drug names from Excel
-        cursor.execute("SELECT COUNT(*) FROM drugs")
-        if cursor.fetchone()['COUNT(*)'] == 0:
-            try:
-                df = pd.read_excel('STOCK TAKE FILE.xlsx')
-                drug_names = df['DRUG NAME'].dropna().unique()
-                
-                for drug in drug_names:
-                    try:
-                        cursor.execute("INSERT INTO drugs (drug_name) VALUES (%s)", (drug,))
-                    except mysql.connector.IntegrityError:
-                        conn.rollback()
-                
-                conn.commit()
-                print(f"✅ Inserted {len(drug_names)} drug names into database.")
-            except Exception as e:
-                print(f"❌ Error importing drug names: {e}")
-                conn.rollback()
-        
-        conn.commit()
-        print("✅ Database initialized successfully.")
-        
-    finally:
-        cursor.close()
-        conn.close()
-
-if __name__ == "__main__":
-    initialize_database()
\ No newline at end of file
+import mysql.connector
+from mysql.connector import pooling
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta
+from dotenv import load_dotenv
+from cache_utils import TTLCache
+from metrics_utils import metrics
+from sqlite_utils import SqliteDatabase
+
+load_dotenv()
+
+# "mysql" for the central server, "sqlite" to run everything on a local file (tests, demos)
+DB_BACKEND = os.getenv('DB_BACKEND', 'mysql').lower()
+SQLITE_PATH = os.getenv('SQLITE_PATH', 'stocktake.db')
+
+# Connection pool settings (mysql-connector caps pool_size at 32)
+POOL_NAME = "stocktake_pool"
+POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', '10'))
+
+# Rows per multi-row statement for batched writes
+UPDATE_BATCH_SIZE = 500
+# Rows removed per transaction when a table's records are deleted
+DELETE_BATCH_SIZE = 1000
+# Count events folded into stocktake_records per compaction transaction
+COMPACT_BATCH_SIZE = 1000
+# The background compactor also runs this often when no save has woken it
+COMPACT_INTERVAL = 5
+# When False, events are only folded in by explicit compact_events() calls
+BACKGROUND_COMPACTION = True
+
+# Reason given for rows another session changed after they were loaded
+CONFLICT_REASON = "Changed by someone else since it was loaded"
+CLOSED_REASON = "This stocktake has been closed"
+# Prefix of the reason given when the save itself failed; the rows can be sent again
+DATABASE_ERROR_REASON = "Database error"
+# Stands in for a field a count row leaves out, whose stored value is kept
+KEEP = object()
+
+# Accepted expiry dates run from EXPIRY_MIN to EXPIRY_MAX_YEARS from today
+EXPIRY_MIN = date(2000, 1, 1)
+EXPIRY_MAX_YEARS = 30
+
+# Read-through cache for listings; writes through the app invalidate it
+CACHE_MAX_ENTRIES = int(os.getenv('CACHE_MAX_ENTRIES', '512'))
+DRUGS_TTL = 300
+TABLES_TTL = 60
+RECORDS_TTL = 15
+
+# Writes stamp last_updated before they commit, so incremental refreshes
+# re-read this much before the newest change a client has already seen
+REFRESH_OVERLAP = timedelta(seconds=10)
+
+cache = TTLCache(CACHE_MAX_ENTRIES)
+
+def counted_sql(alias=None):
+    """SQL condition for a counted stocktake_records line: one a count was saved for, even 0."""
+    return f"{alias + '.' if alias else ''}updated_by IS NOT NULL"
+
+def is_counted(updated_by):
+    """counted_sql for a row already read, given its updated_by."""
+    return updated_by is not None
+
+def cache_metrics():
+    stats = cache.stats()
+    return {
+        "pool_size": POOL_SIZE,
+        "cache_hits_total": stats["hits"],
+        "cache_misses_total": stats["misses"],
+        "cache_evictions_total": stats["evictions"],
+        "cache_entries": stats["entries"]
+    }
+
+metrics.add_collector(cache_metrics)
+
+_pool = None
+_pool_lock = threading.Lock()
+
+_compactor = None
+_compactor_lock = threading.Lock()
+_compactor_wakeup = threading.Event()
+
+def get_db_config():
+    return {
+        'host': os.getenv('DB_HOST'),
+        'user': os.getenv('DB_USER'),
+        'password': os.getenv('DB_PASSWORD'),
+        'database': os.getenv('DB_NAME'),
+        'port': os.getenv('DB_PORT', '3306')
+    }
+
+def get_pool():
+    # One pool per process: Streamlit reruns re-execute the app script but
+    # keep imported modules, so every session shares these connections.
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None and DB_BACKEND == "sqlite":
+                _pool = SqliteDatabase(SQLITE_PATH)
+            elif _pool is None:
+                _pool = pooling.MySQLConnectionPool(
+                    pool_name=POOL_NAME,
+                    pool_size=POOL_SIZE,
+                    pool_reset_session=True,
+                    **get_db_config()
+                )
+    return _pool
+
+class InstrumentedCursor:
+    """Cursor proxy that reports each statement's latency and row count to metrics.
+
+    A statement's time includes fetching its rows, so it is recorded on
+    the next execute() or on close().
+    """
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._pending = None
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    def _record(self):
+        if self._pending is not None:
+            metrics.record_query(*self._pending)
+            self._pending = None
+
+    def _run(self, method, operation, *args, **kwargs):
+        self._record()
+        started = time.perf_counter()
+        try:
+            return method(operation, *args, **kwargs)
+        finally:
+            # Writes report affected rows now; SELECT rows are counted as they are fetched
+            rows = 0 if self._cursor.with_rows else max(self._cursor.rowcount, 0)
+            self._pending = [operation, time.perf_counter() - started, rows]
+
+    def execute(self, operation, *args, **kwargs):
+        return self._run(self._cursor.execute, operation, *args, **kwargs)
+
+    def executemany(self, operation, *args, **kwargs):
+        return self._run(self._cursor.executemany, operation, *args, **kwargs)
+
+    def _fetch(self, method, *args):
+        started = time.perf_counter()
+        result = method(*args)
+        if self._pending is not None:
+            self._pending[1] += time.perf_counter() - started
+            self._pending[2] += len(result) if isinstance(result, list) else int(result is not None)
+        return result
+
+    def fetchone(self):
+        return self._fetch(self._cursor.fetchone)
+
+    def fetchmany(self, *args):
+        return self._fetch(self._cursor.fetchmany, *args)
+
+    def fetchall(self):
+        return self._fetch(self._cursor.fetchall)
+
+    def close(self):
+        self._record()
+        return self._cursor.close()
+
+class InstrumentedConnection:
+    """Pooled connection proxy whose cursors are instrumented and whose close() is counted."""
+
+    def __init__(self, conn):
+        self._conn = conn
+        self._returned = False
+
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+
+    def cursor(self, *args, **kwargs):
+        return InstrumentedCursor(self._conn.cursor(*args, **kwargs))
+
+    def close(self):
+        if not self._returned:
+            self._returned = True
+            metrics.record_checkin()
+        self._conn.close()
+
+def get_db_connection():
+    """Borrow a connection from the pool; close() hands it back."""
+    started = time.monotonic()
+    deadline = started + POOL_TIMEOUT
+    waited = False
+    while True:
+        try:
+            conn = get_pool().get_connection()
+            break
+        except mysql.connector.PoolError:
+            # Pool exhausted: wait for another session to return a connection
+            waited = True
+            if time.monotonic() >= deadline:
+                metrics.record_connection_error()
+                raise
+            time.sleep(0.05)
+    
+    # Health check: revive connections dropped by wait_timeout or a server restart
+    try:
+        conn.ping(reconnect=True, attempts=3, delay=1)
+    except mysql.connector.Error:
+        metrics.record_connection_error()
+        conn.close()
+        raise
+    metrics.record_checkout(time.monotonic() - started, waited)
+    return InstrumentedConnection(conn)
+
+@contextmanager
+def db_connection():
+    """Pooled connection that is rolled back on error and always returned."""
+    conn = get_db_connection()
+    try:
+        yield conn
+    except Exception:
+        try:
+            conn.rollback()
+        except mysql.connector.Error:
+            pass
+        raise
+    finally:
+        conn.close()
+
+@contextmanager
+def db_cursor(dictionary=True):
+    """Yield (conn, cursor) from the pool, closing both when the block exits."""
+    with db_connection() as conn:
+        cursor = conn.cursor(dictionary=dictionary)
+        try:
+            yield conn, cursor
+        finally:
+            cursor.close()
+
+def invalidate_cache(*prefix):
+    """Drop cached reads whose key starts with prefix, e.g. ("records", table_id)."""
+    cache.invalidate(*prefix)
+
+def fetch_all(sql, params=()):
+    with db_cursor() as (conn, cursor):
+        cursor.execute(sql, params)
+        return cursor.fetchall()
+
+def id_filter(column, ids):
+    # IN () is invalid SQL; IN (NULL) matches nothing
+    return f"{column} IN ({', '.join(['%s'] * len(ids)) or 'NULL'})"
+
+# Cached reads return shared lists: callers must copy before modifying rows
+
+def get_drugs(department=None, drug_ids=None):
+    """Drug catalog ordered by name, optionally limited to a department and ids."""
+    conditions, params = [], []
+    if department:
+        conditions.append("department = %s")
+        params.append(department)
+    if drug_ids is not None:
+        conditions.append(id_filter("id", drug_ids))
+        params.extend(drug_ids)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    key = ("drugs", department, tuple(drug_ids) if drug_ids is not None else None)
+    return cache.get_or_load(
+        key,
+        lambda: fetch_all(f"SELECT id, drug_name, department FROM drugs {where} ORDER BY drug_name", params),
+        DRUGS_TTL
+    )
+
+def get_stocktake_tables(department=None, limit=None, before=None):
+    """Stocktake tables, newest first; all departments when department is None.
+
+    With limit, returns one keyset page: before is the (created_at, id) of
+    the last row of the previous page.
+    """
+    conditions, params = [], []
+    if department:
+        conditions.append("t.department = %s")
+        params.append(department)
+    if before:
+        conditions.append("(t.created_at < %s OR (t.created_at = %s AND t.id < %s))")
+        params.extend([before[0], before[0], before[1]])
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    limit_clause = ""
+    if limit:
+        limit_clause = "LIMIT %s"
+        params.append(limit)
+    return cache.get_or_load(
+        ("tables", department, before, limit),
+        lambda: fetch_all(
+            f"SELECT t.id, t.table_name, t.department, t.access_code, t.created_at, t.is_active, a.archived_at "
+            f"FROM stocktake_tables t LEFT JOIN table_archives a ON a.table_id = t.id {where} "
+            f"ORDER BY t.created_at DESC, t.id DESC {limit_clause}",
+            params
+        ),
+        TABLES_TTL
+    )
+
+def table_cursor(table):
+    return (table["created_at"], table["id"])
+
+def get_table_records(table_id, drug_ids=None):
+    """Records of one stocktake table with drug names, ordered by drug name."""
+    drug_filter, params = "", [table_id]
+    if drug_ids is not None:
+        drug_filter = f"AND {id_filter('sr.drug_id', drug_ids)}"
+        params.extend(drug_ids)
+    key = ("records", table_id, tuple(drug_ids) if drug_ids is not None else None)
+    return cache.get_or_load(
+        key,
+        lambda: fetch_all(f'''
+            SELECT sr.id, sr.drug_id, d.drug_name, sr.packs, sr.singles, sr.expiry_date, sr.last_updated
+            FROM stocktake_records sr
+            JOIN drugs d ON sr.drug_id = d.id
+            WHERE sr.table_id = %s {drug_filter}
+            ORDER BY d.drug_name
+        ''', params),
+        RECORDS_TTL
+    )
+
+def get_table_records_page(table_id, limit, after=None):
+    """One keyset page of a table's records ordered by (drug_name, id).
+
+    after is the (drug_name, id) of the last row of the previous page.
+    """
+    seek, params = "", [table_id]
+    if after:
+        seek = "AND (d.drug_name > %s OR (d.drug_name = %s AND sr.id > %s))"
+        params.extend([after[0], after[0], after[1]])
+    params.append(limit)
+    return cache.get_or_load(
+        ("records", table_id, "page", after, limit),
+        lambda: fetch_all(f'''
+            SELECT sr.id, sr.drug_id, d.drug_name, sr.packs, sr.singles, sr.expiry_date, sr.last_updated
+            FROM stocktake_records sr
+            JOIN drugs d ON sr.drug_id = d.id
+            WHERE sr.table_id = %s {seek}
+            ORDER BY d.drug_name, sr.id
+            LIMIT %s
+        ''', params),
+        RECORDS_TTL
+    )
+
+def record_cursor(record):
+    return (record["drug_name"], record["id"])
+
+# Compact record row: a plain tuple per record, with drug names looked up in
+# catalog_utils rather than joined in and copied onto every row
+RecordRow = namedtuple(
+    "RecordRow", ["id", "drug_id", "packs", "singles", "expiry_date", "last_updated", "updated_by", "session_id"]
+)
+
+def get_changed_records(table_id, since=None):
+    """RecordRows of a table changed since a watermark (all records when None), uncached.
+
+    since is the newest last_updated the caller holds; rows from
+    REFRESH_OVERLAP before it are returned again, so callers merge by id.
+    Rows are unordered and carry no drug name. Served by
+    idx_records_table_updated.
+    """
+    change_filter, params = "", [table_id]
+    if since is not None:
+        change_filter = "AND last_updated >= %s"
+        params.append(since - REFRESH_OVERLAP)
+    with db_cursor(dictionary=False) as (conn, cursor):
+        cursor.execute(
+            f"SELECT {', '.join(RecordRow._fields)} FROM stocktake_records WHERE table_id = %s {change_filter}",
+            params
+        )
+        # A handful of counters write a table, so their names and sessions are shared rather than copied per row
+        return [
+            RecordRow(*row[:-2], *(sys.intern(value) if value else None for value in row[-2:]))
+            for row in cursor.fetchall()
+        ]
+
+def find_table_by_access_code(access_code):
+    with db_cursor() as (conn, cursor):
+        cursor.execute(
+            "SELECT id, table_name, department, is_active FROM stocktake_tables WHERE access_code = %s",
+            (access_code,)
+        )
+        return cursor.fetchone()
+
+def find_user(username, password):
+    with db_cursor() as (conn, cursor):
+        cursor.execute("SELECT * FROM users WHERE username = %s AND password = %s", (username, password))
+        return cursor.fetchone()
+
+def get_expiring_items(days, department=None):
+    """Items in active tables expiring within days (already expired included)."""
+    department_filter, params = "", [days]
+    if department:
+        department_filter = "AND w.department = %s"
+        params.append(department)
+    return fetch_all(f'''
+        SELECT w.expiry_date, DATEDIFF(w.expiry_date, CURDATE()) AS days_left,
+               d.drug_name, w.department, t.table_name, w.packs, w.singles
+        FROM expiry_watch w
+        JOIN drugs d ON d.id = w.drug_id
+        JOIN stocktake_tables t ON t.id = w.table_id
+        WHERE w.expiry_date <= CURDATE() + INTERVAL %s DAY {department_filter}
+        ORDER BY w.expiry_date, d.drug_name
+    ''', params)
+
+def get_template(department):
+    """Drugs in a department's template in display order; empty when it has none."""
+    return cache.get_or_load(
+        ("templates", department),
+        lambda: fetch_all('''
+            SELECT t.drug_id, d.drug_name, d.department, t.position
+            FROM department_templates t
+            JOIN drugs d ON d.id = t.drug_id
+            WHERE t.department = %s
+            ORDER BY t.position, d.drug_name
+        ''', (department,)),
+        DRUGS_TTL
+    )
+
+def save_template(department, drug_ids):
+    """Replace a department's template with drug_ids, in that display order."""
+    drug_ids = list(dict.fromkeys(int(drug_id) for drug_id in drug_ids))
+    with db_cursor() as (conn, cursor):
+        cursor.execute("DELETE FROM department_templates WHERE department = %s", (department,))
+        if drug_ids:
+            cursor.executemany(
+                "INSERT INTO department_templates (department, drug_id, position) VALUES (%s, %s, %s)",
+                [(department, drug_id, position) for position, drug_id in enumerate(drug_ids, 1)]
+            )
+        conn.commit()
+    invalidate_cache("templates", department)
+    return len(drug_ids)
+
+def create_stocktake_table(table_name, department, access_code, created_by):
+    """Create a stocktake table seeded from the department's template.
+
+    Departments without a template get a record for every drug. The
+    table row and its records are written in one transaction with a
+    single INSERT ... SELECT, so a failure leaves nothing behind.
+    Returns (table_id, row_count, elapsed_seconds).
+    """
+    started = time.perf_counter()
+    with db_cursor() as (conn, cursor):
+        cursor.execute(
+            "INSERT INTO stocktake_tables (table_name, department, access_code, created_by) VALUES (%s, %s, %s, %s)",
+            (table_name, department, access_code, created_by)
+        )
+        table_id = cursor.lastrowid
+        
+        cursor.execute("SELECT COUNT(*) AS n FROM department_templates WHERE department = %s", (department,))
+        if cursor.fetchone()["n"]:
+            cursor.execute(
+                "INSERT INTO stocktake_records (table_id, drug_id) "
+                "SELECT %s, drug_id FROM department_templates WHERE department = %s ORDER BY position",
+                (table_id, department)
+            )
+        else:
+            cursor.execute(
+                "INSERT INTO stocktake_records (table_id, drug_id) SELECT %s, id FROM drugs",
+                (table_id,)
+            )
+        row_count = cursor.rowcount
+        cursor.execute("INSERT INTO table_progress (table_id, line_count) VALUES (%s, %s)", (table_id, row_count))
+        conn.commit()
+    invalidate_cache("tables")
+    invalidate_cache("progress")
+    
+    return table_id, row_count, time.perf_counter() - started
+
+def delete_table_records(table_id, batch_size=DELETE_BATCH_SIZE):
+    """Delete a table's records and count events batch_size rows per transaction.
+
+    Returns the number of records deleted.
+
+    Each batch commits and returns its connection, so row locks are held
+    briefly and counting on other tables carries on between batches.
+    """
+    deleted = 0
+    while True:
+        with db_cursor() as (conn, cursor):
+            cursor.execute(
+                f"SELECT id, packs, singles, {counted_sql()} AS touched FROM stocktake_records "
+                "WHERE table_id = %s ORDER BY id LIMIT %s FOR UPDATE",
+                (table_id, batch_size)
+            )
+            batch = cursor.fetchall()
+            if not batch:
+                break
+            ids = [row["id"] for row in batch]
+            cursor.execute(f"DELETE FROM stocktake_records WHERE {id_filter('id', ids)}", ids)
+            cursor.execute('''
+                UPDATE table_progress
+                SET line_count = line_count - %s, touched_lines = touched_lines - %s,
+                    total_packs = total_packs - %s, total_singles = total_singles - %s
+                WHERE table_id = %s
+            ''', (
+                len(batch), sum(row["touched"] for row in batch), sum(row["packs"] or 0 for row in batch),
+                sum(row["singles"] or 0 for row in batch), table_id
+            ))
+            conn.commit()
+        deleted += len(ids)
+    # The table's count history goes with its records
+    while True:
+        with db_cursor() as (conn, cursor):
+            cursor.execute("SELECT id FROM count_events WHERE table_id = %s ORDER BY id LIMIT %s", (table_id, batch_size))
+            ids = [row["id"] for row in cursor.fetchall()]
+            if not ids:
+                break
+            cursor.execute(f"DELETE FROM count_events WHERE {id_filter('id', ids)}", ids)
+            conn.commit()
+    invalidate_cache("records", table_id)
+    invalidate_cache("progress")
+    return deleted
+
+def delete_stocktake_table(table_id):
+    """Delete a table and its records; returns the number of records deleted."""
+    deleted = delete_table_records(table_id)
+    with db_cursor() as (conn, cursor):
+        cursor.execute("DELETE FROM stocktake_tables WHERE id = %s", (table_id,))
+        conn.commit()
+    invalidate_cache("tables")
+    return deleted
+
+def add_drugs_to_table(table_id, drug_ids):
+    """Add records for drugs a table does not have yet; returns how many were added.
+
+    The new rows get a fresh last_updated, so counters' incremental
+    refreshes pick them up without a full reload.
+    """
+    if not drug_ids:
+        return 0
+    with db_cursor() as (conn, cursor):
+        cursor.execute(f'''
+            INSERT INTO stocktake_records (table_id, drug_id)
+            SELECT %s, d.id FROM drugs d
+            WHERE {id_filter('d.id', drug_ids)}
+              AND NOT EXISTS (
+                  SELECT 1 FROM stocktake_records sr WHERE sr.table_id = %s AND sr.drug_id = d.id
+              )
+        ''', (table_id, *drug_ids, table_id))
+        added = cursor.rowcount
+        cursor.execute("UPDATE table_progress SET line_count = line_count + %s WHERE table_id = %s", (added, table_id))
+        conn.commit()
+    invalidate_cache("records", table_id)
+    invalidate_cache("progress")
+    return added
+
+def chunked(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+def parse_count(value):
+    count = int(value)
+    if count < 0:
+        raise ValueError("Counts cannot be negative")
+    return count
+
+def parse_expiry(value):
+    if value is None or value == "":
+        return None
+    if isinstance(value, datetime):
+        expiry = value.date()
+    elif isinstance(value, date):
+        expiry = value
+    else:
+        expiry = date.fromisoformat(str(value).strip())
+    # Catch typos such as 2205 or 1925 before they reach the expiry report
+    if not EXPIRY_MIN <= expiry <= date.today() + timedelta(days=365 * EXPIRY_MAX_YEARS):
+        raise ValueError(f"Expiry date {expiry} is out of range")
+    return expiry
+
+def refresh_expiry_watch(cursor, record_ids=None):
+    """Rebuild expiry_watch rows for the given records (all records when None).
+
+    expiry_watch holds only dated records of active tables, so the expiry
+    report scans a small, expiry-indexed table instead of every record.
+    """
+    if record_ids is None:
+        cursor.execute("DELETE FROM expiry_watch")
+        record_filter, params = "", []
+    else:
+        if not record_ids:
+            return
+        record_filter = f"AND {id_filter('sr.id', record_ids)}"
+        params = list(record_ids)
+        cursor.execute(f"DELETE FROM expiry_watch WHERE {id_filter('record_id', record_ids)}", params)
+    cursor.execute(f'''
+        INSERT INTO expiry_watch (record_id, table_id, drug_id, department, expiry_date, packs, singles)
+        SELECT sr.id, sr.table_id, sr.drug_id, t.department, sr.expiry_date, sr.packs, sr.singles
+        FROM stocktake_records sr
+        JOIN stocktake_tables t ON t.id = sr.table_id
+        WHERE sr.expiry_date IS NOT NULL AND t.is_active {record_filter}
+    ''', params)
+
+def refresh_table_progress(cursor, table_ids=None):
+    """Recompute table_progress rows from the records (every table when None).
+
+    Writes keep table_progress up to date by applying deltas; this is the
+    full rebuild for the migration and for data loaded behind their back.
+    """
+    if table_ids is None:
+        cursor.execute("DELETE FROM table_progress")
+        table_filter, progress_filter, params = "", "", []
+    else:
+        if not table_ids:
+            return
+        table_filter = f"WHERE {id_filter('t.id', table_ids)}"
+        progress_filter = f"AND {id_filter('p.table_id', table_ids)}"
+        params = list(table_ids)
+        cursor.execute(f"DELETE FROM table_progress WHERE {id_filter('table_id', table_ids)}", params)
+    cursor.execute(f'''
+        INSERT INTO table_progress (table_id, line_count, touched_lines, total_packs, total_singles, last_activity_at)
+        SELECT t.id, COUNT(sr.id), COALESCE(SUM({counted_sql('sr')}), 0),
+               COALESCE(SUM(sr.packs), 0), COALESCE(SUM(sr.singles), 0),
+               MAX(CASE WHEN {counted_sql('sr')} THEN sr.last_updated END)
+        FROM stocktake_tables t
+        LEFT JOIN stocktake_records sr ON sr.table_id = t.id
+        {table_filter}
+        GROUP BY t.id
+    ''', params)
+    # Credit the latest activity to whoever made it
+    cursor.execute(f'''
+        UPDATE table_progress p
+        JOIN stocktake_records sr ON sr.table_id = p.table_id AND sr.last_updated = p.last_activity_at
+        SET p.last_activity_by = sr.updated_by
+        WHERE {counted_sql('sr')} {progress_filter}
+    ''', params)
+
+def get_table_progress(department=None):
+    """Progress of every unarchived table, newest first, from table_progress alone."""
+    department_filter, params = "", []
+    if department:
+        department_filter = "AND t.department = %s"
+        params.append(department)
+    return cache.get_or_load(
+        ("progress", department),
+        lambda: fetch_all(f'''
+            SELECT t.id, t.table_name, t.department, t.created_at, t.is_active,
+                   p.line_count, p.touched_lines, p.total_packs, p.total_singles,
+                   p.last_activity_at, p.last_activity_by
+            FROM stocktake_tables t
+            JOIN table_progress p ON p.table_id = t.id
+            LEFT JOIN table_archives a ON a.table_id = t.id
+            WHERE a.table_id IS NULL {department_filter}
+            ORDER BY t.created_at DESC, t.id DESC
+        ''', params),
+        RECORDS_TTL
+    )
+
+def validate_count_rows(rows):
+    """Parse count rows into {id: (id, packs, singles, expiry)}; returns (values, failed).
+
+    Fields a row leaves out are KEEP; fill_kept() swaps in the stored values.
+    """
+    failed = {}
+    values = {}
+    for row in rows:
+        try:
+            values[int(row["id"])] = (
+                int(row["id"]),
+                parse_count(row["packs"]) if "packs" in row else KEEP,
+                parse_count(row["singles"]) if "singles" in row else KEEP,
+                parse_expiry(row["expiry_date"]) if "expiry_date" in row else KEEP
+            )
+        except (KeyError, TypeError, ValueError) as e:
+            failed[row.get("id")] = f"Invalid value: {e}"
+    return values, failed
+
+def fill_kept(value, stored):
+    """A validated count tuple with its KEEP fields taken from stored (packs, singles, expiry_date)."""
+    record_id, packs, singles, expiry = value
+    return (
+        record_id,
+        (stored["packs"] or 0) if packs is KEEP else packs,
+        (stored["singles"] or 0) if singles is KEEP else singles,
+        stored["expiry_date"] if expiry is KEEP else expiry
+    )
+
+def update_stocktake_records(table_id, rows, updated_by=None, session_id=None):
+    """Record buffered count edits for one stocktake table as count events.
+
+    rows are dicts with id, packs, singles and expiry_date (a date, an ISO
+    string or None); a field left out keeps its latest value. The save
+    takes a shared lock on the table row, so it cannot interleave with
+    archive_table, but locks no records: each valid row is appended to
+    count_events, and compact_events() (run by the background compactor
+    straight after) folds the events into stocktake_records.
+
+    A row that also carries last_updated fails with CONFLICT_REASON if
+    another session has an event for the record still waiting to be
+    compacted, or if the record has changed since then through events
+    from any other session. Returns (updated_ids, failed) where failed
+    maps a record id to the reason it was not recorded.
+    """
+    values, failed = validate_count_rows(rows)
+    if not values:
+        return [], failed
+    expected = {int(row["id"]): row["last_updated"] for row in rows
+                if "last_updated" in row and int(row["id"]) in values}
+    
+    record_ids = list(values)
+    now = datetime.now()
+    try:
+        with db_cursor() as (conn, cursor):
+            # The shared lock makes archive_table wait for this save, and this save
+            # see the table as closed once an archive has started
+            cursor.execute("SELECT is_active FROM stocktake_tables WHERE id = %s LOCK IN SHARE MODE", (table_id,))
+            table = cursor.fetchone()
+            if not table or not table["is_active"]:
+                failed.update((record_id, CLOSED_REASON) for record_id in values)
+                return [], failed
+            # Records outside this table are reported rather than silently skipped.
+            # Nothing is locked: events are only ever appended.
+            current = {}
+            for chunk in chunked(record_ids, UPDATE_BATCH_SIZE):
+                placeholders = ", ".join(["%s"] * len(chunk))
+                cursor.execute(
+                    f"SELECT id, packs, singles, expiry_date, last_updated, updated_by FROM stocktake_records "
+                    f"WHERE table_id = %s AND id IN ({placeholders})",
+                    (table_id, *chunk)
+                )
+                current.update((row["id"], row) for row in cursor.fetchall())
+            # Another session's events still waiting for compaction count as changes too
+            checked = [record_id for record_id in expected if record_id in current]
+            pending_by_others = set()
+            for chunk in chunked(checked, UPDATE_BATCH_SIZE):
+                cursor.execute(f'''
+                    SELECT record_id, session_id FROM count_events
+                    WHERE {id_filter('record_id', chunk)} AND compacted_at IS NULL
+                ''', chunk)
+                pending_by_others.update(
+                    row["record_id"] for row in cursor.fetchall()
+                    if session_id is None or row["session_id"] != session_id
+                )
+            # The session's own earlier saves are not conflicts: a changed version
+            # is let through when every event folded in since came from this session
+            own = set()
+            stale = [record_id for record_id in checked if current[record_id]["last_updated"] != expected[record_id]]
+            if session_id is not None:
+                since = {}
+                for chunk in chunked(stale, UPDATE_BATCH_SIZE):
+                    cursor.execute(f'''
+                        SELECT record_id, session_id, compacted_at FROM count_events
+                        WHERE {id_filter('record_id', chunk)} AND compacted_at IS NOT NULL
+                    ''', chunk)
+                    for row in cursor.fetchall():
+                        if expected[row["record_id"]] is None or row["compacted_at"] > expected[row["record_id"]]:
+                            since.setdefault(row["record_id"], []).append(row)
+                own = {
+                    record_id for record_id, events in since.items()
+                    if all(event["session_id"] == session_id for event in events)
+                    and max(event["compacted_at"] for event in events) == current[record_id]["last_updated"]
+                }
+            for record_id in record_ids:
+                if record_id not in current:
+                    failed[record_id] = "Record is not part of this stocktake table"
+                elif record_id in pending_by_others or (record_id in stale and record_id not in own):
+                    failed[record_id] = CONFLICT_REASON
+            
+            written = [record_id for record_id in record_ids if record_id not in failed]
+            # Left-out fields keep the latest value, which may still be waiting as an event
+            stored = {record_id: current[record_id] for record_id in written}
+            partial = [record_id for record_id in written if KEEP in values[record_id]]
+            for chunk in chunked(partial, UPDATE_BATCH_SIZE):
+                cursor.execute(f'''
+                    SELECT e.record_id, e.packs, e.singles, e.expiry_date
+                    FROM count_events e
+                    WHERE {id_filter('e.record_id', chunk)} AND e.compacted_at IS NULL
+                    ORDER BY e.id
+                ''', chunk)
+                stored.update((row["record_id"], row) for row in cursor.fetchall())
+            events = [
+                (table_id, *fill_kept(values[record_id], stored[record_id]), now, updated_by, session_id)
+                for record_id in written
+            ]
+            for chunk in chunked(events, UPDATE_BATCH_SIZE):
+                cursor.executemany('''
+                    INSERT INTO count_events (table_id, record_id, packs, singles, expiry_date, counted_at, counted_by, session_id)
+                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+                ''', chunk)
+            conn.commit()
+    except mysql.connector.Error as e:
+        for record_id in record_ids:
+            failed.setdefault(record_id, f"{DATABASE_ERROR_REASON}: {e}")
+        return [], failed
+    
+    if events:
+        wake_compactor()
+    return [record_id for record_id in record_ids if record_id not in failed], failed
+
+def apply_events(cursor, events, now):
+    """Write the latest event per record into stocktake_records, with expiry_watch and table_progress.
+
+    events are count_events rows, oldest first, and now becomes the
+    records' last_updated. The records are locked until the caller
+    commits, since their old counts feed the table_progress deltas.
+    """
+    latest = {}
+    for event in events:
+        latest[event["record_id"]] = event
+    by_table = {}
+    for event in latest.values():
+        by_table.setdefault(event["table_id"], []).append(event)
+    
+    for table_id, table_events in by_table.items():
+        for chunk in chunked(table_events, UPDATE_BATCH_SIZE):
+            ids = [event["record_id"] for event in chunk]
+            cursor.execute(
+                f"SELECT id, packs, singles, {counted_sql()} AS touched FROM stocktake_records "
+                f"WHERE {id_filter('id', ids)} FOR UPDATE",
+                ids
+            )
+            old = cursor.fetchall()
+            derived = " UNION ALL ".join(
+                ["SELECT %s AS id, %s AS packs, %s AS singles, %s AS expiry_date, %s AS updated_by, %s AS session_id"]
+                + ["SELECT %s, %s, %s, %s, %s, %s"] * (len(chunk) - 1)
+            )
+            cursor.execute(f'''
+                UPDATE stocktake_records sr
+                JOIN ({derived}) AS u ON sr.id = u.id
+                SET sr.packs = u.packs, sr.singles = u.singles, sr.expiry_date = u.expiry_date,
+                    sr.last_updated = %s, sr.updated_by = u.updated_by, sr.session_id = u.session_id
+                WHERE sr.table_id = %s
+            ''', [
+                value for event in chunk
+                for value in (event["record_id"], event["packs"], event["singles"], event["expiry_date"],
+                              event["counted_by"], event["session_id"])
+            ] + [now, table_id])
+            refresh_expiry_watch(cursor, ids)
+            # Events for records deleted since they were recorded have nothing to update
+            locked = {row["id"] for row in old}
+            applied = [event for event in chunk if event["record_id"] in locked]
+            if applied:
+                last = max(applied, key=lambda event: event["id"])
+                cursor.execute('''
+                    UPDATE table_progress
+                    SET touched_lines = touched_lines + %s, total_packs = total_packs + %s,
+                        total_singles = total_singles + %s, last_activity_at = %s, last_activity_by = %s
+                    WHERE table_id = %s
+                ''', (
+                    sum(is_counted(event["counted_by"]) for event in applied) - sum(row["touched"] for row in old),
+                    sum(event["packs"] for event in applied) - sum(row["packs"] or 0 for row in old),
+                    sum(event["singles"] for event in applied) - sum(row["singles"] or 0 for row in old),
+                    now, last["counted_by"], table_id
+                ))
+    return list(by_table)
+
+def compact_events(max_batches=None):
+    """Fold count events into stocktake_records, oldest first; returns the events folded.
+
+    Each batch of COMPACT_BATCH_SIZE events is one transaction that applies
+    them and stamps their compacted_at. Events are picked by that flag
+    rather than by id, since ids are handed out before a save commits and
+    a save can commit after events with higher ids. The event_compaction
+    row is locked for the batch, so compactors in other processes take
+    turns rather than applying an event twice.
+    """
+    folded = 0
+    batches = 0
+    while max_batches is None or batches < max_batches:
+        with db_cursor() as (conn, cursor):
+            cursor.execute("UPDATE event_compaction SET compacted_at = compacted_at WHERE id = 1")
+            cursor.execute('''
+                SELECT id, table_id, record_id, packs, singles, expiry_date, counted_at, counted_by, session_id
+                FROM count_events WHERE compacted_at IS NULL ORDER BY id LIMIT %s
+            ''', (COMPACT_BATCH_SIZE,))
+            events = cursor.fetchall()
+            if not events:
+                break
+            now = datetime.now()
+            table_ids = apply_events(cursor, events, now)
+            for chunk in chunked([event["id"] for event in events], UPDATE_BATCH_SIZE):
+                cursor.execute(
+                    f"UPDATE count_events SET compacted_at = %s WHERE {id_filter('id', chunk)}",
+                    (now, *chunk)
+                )
+            cursor.execute("UPDATE event_compaction SET compacted_at = %s WHERE id = 1", (now,))
+            conn.commit()
+        for table_id in table_ids:
+            invalidate_cache("records", table_id)
+        invalidate_cache("progress")
+        folded += len(events)
+        batches += 1
+    return folded
+
+def compactor_loop():
+    while True:
+        _compactor_wakeup.wait(COMPACT_INTERVAL)
+        _compactor_wakeup.clear()
+        try:
+            compact_events()
+        except mysql.connector.Error as e:
+            # Events stay in the log; the next pass picks them up
+            print(f"❌ Error compacting count events: {e}")
+
+def wake_compactor():
+    """Start this process's background compactor if needed and have it run now."""
+    global _compactor
+    if not BACKGROUND_COMPACTION:
+        return
+    if _compactor is None:
+        with _compactor_lock:
+            if _compactor is None:
+                _compactor = threading.Thread(target=compactor_loop, name="count-compactor", daemon=True)
+                _compactor.start()
+    _compactor_wakeup.set()
+
+def get_record_history(record_id):
+    """Every count event for a record, oldest first, flagged by whether it is compacted yet."""
+    return fetch_all('''
+        SELECT e.id, e.packs, e.singles, e.expiry_date, e.counted_at, e.counted_by,
+               e.compacted_at IS NOT NULL AS compacted
+        FROM count_events e
+        WHERE e.record_id = %s
+        ORDER BY e.id
+    ''', (record_id,))
+
+def compaction_status():
+    """Events waiting to be folded and when the last batch was."""
+    rows = fetch_all('''
+        SELECT (SELECT COUNT(*) FROM count_events WHERE compacted_at IS NULL) AS pending, compacted_at
+        FROM event_compaction
+        WHERE id = 1
+    ''')
+    return rows[0] if rows else {"pending": 0, "compacted_at": None}
+
+def create_tables(cursor):
+    # Base schema; indexes and later tables come from MIGRATIONS
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS drugs (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        drug_name VARCHAR(255) UNIQUE NOT NULL,
+        department VARCHAR(50),
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stocktake_tables (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        table_name VARCHAR(255) NOT NULL,
+        department VARCHAR(50) NOT NULL,
+        access_code VARCHAR(50) UNIQUE NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        created_by VARCHAR(100),
+        is_active BOOLEAN DEFAULT TRUE
+    )
+    ''')
+    
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stocktake_records (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        table_id INT NOT NULL,
+        drug_id INT NOT NULL,
+        packs INT DEFAULT 0,
+        singles INT DEFAULT 0,
+        expiry_date DATE,
+        last_updated TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        updated_by VARCHAR(100),
+        FOREIGN KEY (table_id) REFERENCES stocktake_tables(id),
+        FOREIGN KEY (drug_id) REFERENCES drugs(id)
+    )
+    ''')
+    
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS users (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        username VARCHAR(100) UNIQUE NOT NULL,
+        password VARCHAR(255) NOT NULL,
+        department VARCHAR(50) NOT NULL,
+        is_admin BOOLEAN DEFAULT FALSE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+
+def initialize_database():
+    with db_cursor() as (conn, cursor):
+        create_tables(cursor)
+        
+        # Insert admin users
+        admins = [
+            ("er_admin", "er_password123", "ER"),
+            ("admission_admin", "admission_password123", "ADMISSION"),
+            ("martenity_admin", "martenity_password123", "MARTENITY"),
+            ("theatre_admin", "theatre_password123", "THEATRE"),
+            ("lab_admin", "lab_password123", "LAB"),
+            ("radiology_admin", "radiology_password123", "RADIOLOGY"),
+            ("dentist_admin", "dentist_password123", "DENTIST"),
+            ("super_admin", "super_password123", "SUPER_ADMIN")
+        ]
+        
+        for username, password, department in admins:
+            try:
+                cursor.execute(
+                    "INSERT INTO users (username, password, department, is_admin) VALUES (%s, %s, %s, TRUE)",
+                    (username, password, department)
+                )
+            except mysql.connector.IntegrityError:
+                conn.rollback()
+        
+        conn.commit()
+    
+    # Migrations first: the import bumps catalog_version
+    run_migrations()
+    
+    # Import drug names from Excel; safe to re-run on a populated catalog
+    from import_drugs import import_drugs, print_summary
+    try:
+        print_summary(import_drugs('STOCK TAKE FILE.xlsx'))
+    except Exception as e:
+        print(f"❌ Error importing drug names: {e}")
+    print("✅ Database initialized successfully.")
+
+def index_exists(cursor, table, index):
+    if DB_BACKEND == "sqlite":
+        cursor.execute(
+            "SELECT COUNT(*) AS n FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND name = %s",
+            (table, index)
+        )
+        return cursor.fetchone()["n"] > 0
+    cursor.execute('''
+        SELECT COUNT(*) AS n FROM information_schema.statistics
+        WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+    ''', (table, index))
+    return cursor.fetchone()["n"] > 0
+
+def column_exists(cursor, table, column):
+    if DB_BACKEND == "sqlite":
+        cursor.execute("SELECT COUNT(*) AS n FROM pragma_table_info(%s) WHERE name = %s", (table, column))
+        return cursor.fetchone()["n"] > 0
+    cursor.execute('''
+        SELECT COUNT(*) AS n FROM information_schema.columns
+        WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+    ''', (table, column))
+    return cursor.fetchone()["n"] > 0
+
+def create_index(cursor, table, index, definition):
+    # MySQL has no CREATE INDEX IF NOT EXISTS, so check information_schema first
+    if not index_exists(cursor, table, index):
+        cursor.execute(f"ALTER TABLE {table} ADD {definition}")
+
+def migrate_unique_table_drug(cursor):
+    # Drop duplicate lines, keeping the most recently updated one per drug.
+    # The ids are wrapped in a derived table so MySQL can delete from the table it reads.
+    cursor.execute('''
+        DELETE FROM stocktake_records WHERE id IN (
+            SELECT id FROM (
+                SELECT sr.id FROM stocktake_records sr
+                JOIN stocktake_records newer
+                  ON newer.table_id = sr.table_id AND newer.drug_id = sr.drug_id
+                 AND (newer.last_updated > sr.last_updated
+                      OR (newer.last_updated = sr.last_updated AND newer.id > sr.id))
+            ) AS duplicates
+        )
+    ''')
+    create_index(cursor, "stocktake_records", "uq_records_table_drug",
+                 "UNIQUE KEY uq_records_table_drug (table_id, drug_id)")
+
+def migrate_records_covering_index(cursor):
+    # Serves WHERE table_id = ? for the record views without touching the base rows
+    create_index(cursor, "stocktake_records", "idx_records_table_cover",
+                 "INDEX idx_records_table_cover (table_id, drug_id, packs, singles, expiry_date, last_updated)")
+
+def migrate_tables_department_index(cursor):
+    create_index(cursor, "stocktake_tables", "idx_tables_department_created",
+                 "INDEX idx_tables_department_created (department, created_at)")
+
+def migrate_tables_created_index(cursor):
+    # Keyset pages over every department (SUPER_ADMIN) seek on (created_at, id)
+    create_index(cursor, "stocktake_tables", "idx_tables_created",
+                 "INDEX idx_tables_created (created_at, id)")
+
+def migrate_expiry_watch(cursor):
+    create_index(cursor, "stocktake_records", "idx_records_expiry",
+                 "INDEX idx_records_expiry (expiry_date, table_id)")
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS expiry_watch (
+        record_id INT PRIMARY KEY,
+        table_id INT NOT NULL,
+        drug_id INT NOT NULL,
+        department VARCHAR(50) NOT NULL,
+        expiry_date DATE NOT NULL,
+        packs INT DEFAULT 0,
+        singles INT DEFAULT 0,
+        INDEX idx_expiry_watch_date (expiry_date),
+        INDEX idx_expiry_watch_department (department, expiry_date),
+        INDEX idx_expiry_watch_table (table_id),
+        FOREIGN KEY (record_id) REFERENCES stocktake_records(id) ON DELETE CASCADE
+    )
+    ''')
+    refresh_expiry_watch(cursor)
+
+def migrate_records_updated_index(cursor):
+    # Incremental refreshes fetch rows of one table changed since a watermark
+    create_index(cursor, "stocktake_records", "idx_records_table_updated",
+                 "INDEX idx_records_table_updated (table_id, last_updated)")
+
+def migrate_table_archives(cursor):
+    # One row per archived table: where its records went and their totals
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS table_archives (
+        table_id INT PRIMARY KEY,
+        file_path VARCHAR(500) NOT NULL,
+        file_bytes BIGINT NOT NULL,
+        sha256 CHAR(64) NOT NULL,
+        line_count INT NOT NULL,
+        counted_lines INT NOT NULL,
+        total_packs BIGINT NOT NULL,
+        total_singles BIGINT NOT NULL,
+        archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        archived_by VARCHAR(100),
+        FOREIGN KEY (table_id) REFERENCES stocktake_tables(id) ON DELETE CASCADE
+    )
+    ''')
+
+def migrate_department_templates(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS department_templates (
+        department VARCHAR(50) NOT NULL,
+        drug_id INT NOT NULL,
+        position INT NOT NULL DEFAULT 0,
+        PRIMARY KEY (department, drug_id),
+        INDEX idx_templates_position (department, position),
+        FOREIGN KEY (drug_id) REFERENCES drugs(id) ON DELETE CASCADE
+    )
+    ''')
+
+def migrate_table_progress(cursor):
+    # Per-table totals kept current by each write, so overviews read one row per table
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS table_progress (
+        table_id INT PRIMARY KEY,
+        line_count INT NOT NULL DEFAULT 0,
+        touched_lines INT NOT NULL DEFAULT 0,
+        total_packs BIGINT NOT NULL DEFAULT 0,
+        total_singles BIGINT NOT NULL DEFAULT 0,
+        last_activity_at TIMESTAMP NULL,
+        last_activity_by VARCHAR(100),
+        FOREIGN KEY (table_id) REFERENCES stocktake_tables(id) ON DELETE CASCADE
+    )
+    ''')
+    refresh_table_progress(cursor)
+
+def migrate_catalog_version(cursor):
+    # Bumped by every write to drugs, so catalog caches notice renames and department changes
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS catalog_version (
+        id INT PRIMARY KEY,
+        version INT NOT NULL DEFAULT 0
+    )
+    ''')
+    cursor.execute("SELECT COUNT(*) AS n FROM catalog_version")
+    if not cursor.fetchone()["n"]:
+        cursor.execute("INSERT INTO catalog_version (id, version) VALUES (1, 0)")
+
+def bump_catalog_version(cursor):
+    """Mark the drug catalog as changed; call in the transaction that writes drugs."""
+    cursor.execute("UPDATE catalog_version SET version = version + 1 WHERE id = 1")
+
+def migrate_count_events(cursor):
+    # Saves append here; compact_events() folds them into stocktake_records
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS count_events (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        table_id INT NOT NULL,
+        record_id INT NOT NULL,
+        packs INT NOT NULL DEFAULT 0,
+        singles INT NOT NULL DEFAULT 0,
+        expiry_date DATE,
+        counted_at TIMESTAMP NOT NULL,
+        counted_by VARCHAR(100),
+        session_id CHAR(32),
+        compacted_at TIMESTAMP NULL,
+        INDEX idx_events_record (record_id, id),
+        INDEX idx_events_table (table_id, id),
+        INDEX idx_events_pending (compacted_at, id)
+    )
+    ''')
+    # A single row that compactors lock to take turns, with the last batch time
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS event_compaction (
+        id INT PRIMARY KEY,
+        compacted_at TIMESTAMP NULL
+    )
+    ''')
+    cursor.execute("SELECT COUNT(*) AS n FROM event_compaction")
+    if not cursor.fetchone()["n"]:
+        cursor.execute("INSERT INTO event_compaction (id) VALUES (1)")
+
+def migrate_records_session(cursor):
+    # The session whose save wrote the current counts, so clients can tell their own saves apart
+    if not column_exists(cursor, "stocktake_records", "session_id"):
+        cursor.execute("ALTER TABLE stocktake_records ADD COLUMN session_id CHAR(32)")
+
+# (version, description, up-step); up-steps must be safe to re-run
+MIGRATIONS = [
+    (1, "Unique stocktake record per table and drug", migrate_unique_table_drug),
+    (2, "Covering index for stocktake record views", migrate_records_covering_index),
+    (3, "Index stocktake tables by department and creation time", migrate_tables_department_index),
+    (4, "Index stocktake tables by creation time for keyset paging", migrate_tables_created_index),
+    (5, "Expiry index and precomputed expiry watchlist", migrate_expiry_watch),
+    (6, "Index stocktake records by table and last update", migrate_records_updated_index),
+    (7, "Archive metadata for tables moved to Parquet", migrate_table_archives),
+    (8, "Per-department drug templates for seeding tables", migrate_department_templates),
+    (9, "Incrementally maintained per-table progress", migrate_table_progress),
+    (10, "Append-only count event log with per-event compaction", migrate_count_events),
+    (11, "Catalog version bumped by drug writes", migrate_catalog_version),
+    (12, "Session of the save behind each record's counts", migrate_records_session),
+]
+
+def applied_migrations(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INT PRIMARY KEY,
+        description VARCHAR(255) NOT NULL,
+        applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    ''')
+    cursor.execute("SELECT version FROM schema_migrations")
+    return {row["version"] for row in cursor.fetchall()}
+
+def run_migrations(target=None):
+    """Apply pending migrations in order, up to target if given."""
+    with db_cursor() as (conn, cursor):
+        applied = applied_migrations(cursor)
+        for version, description, step in MIGRATIONS:
+            if version in applied or (target is not None and version > target):
+                continue
+            started = time.perf_counter()
+            step(cursor)
+            cursor.execute(
+                "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)",
+                (version, description)
+            )
+            conn.commit()
+            print(f"✅ Migration {version}: {description} ({time.perf_counter() - started:.2f}s)")
+    print("✅ Schema is up to date.")
+
+def migration_status():
+    with db_cursor() as (conn, cursor):
+        applied = applied_migrations(cursor)
+    return [(version, description, version in applied) for version, description, step in MIGRATIONS]
+
+# Hot queries and the indexes EXPLAIN should report for them
+HOT_QUERIES = [
+    (
+        "Stocktake record view",
+        '''
+        SELECT sr.id, d.drug_name, sr.packs, sr.singles, sr.expiry_date
+        FROM stocktake_records sr
+        JOIN drugs d ON sr.drug_id = d.id
+        WHERE sr.table_id = %s
+        ORDER BY d.drug_name
+        ''',
+        "sr",
+        {"uq_records_table_drug", "idx_records_table_cover"}
+    ),
+    (
+        "Department table listing",
+        "SELECT t.id, t.table_name, t.created_at, a.archived_at FROM stocktake_tables t "
+        "LEFT JOIN table_archives a ON a.table_id = t.id WHERE t.department = %s "
+        "ORDER BY t.created_at DESC, t.id DESC LIMIT 25",
+        "t",
+        {"idx_tables_department_created"}
+    ),
+    (
+        "Access code login",
+        "SELECT id, table_name, department FROM stocktake_tables WHERE access_code = %s",
+        "stocktake_tables",
+        {"access_code"}
+    ),
+    (
+        "Expiry report",
+        "SELECT w.record_id FROM expiry_watch w WHERE w.expiry_date <= CURDATE() + INTERVAL %s DAY",
+        "w",
+        {"idx_expiry_watch_date"}
+    ),
+    (
+        "Incremental refresh",
+        "SELECT sr.id FROM stocktake_records sr WHERE sr.table_id = %s AND sr.last_updated >= %s",
+        "sr",
+        {"idx_records_table_updated"}
+    ),
+    (
+        "Count history",
+        "SELECT e.id FROM count_events e WHERE e.record_id = %s ORDER BY e.id",
+        "e",
+        {"idx_events_record"}
+    ),
+]
+
+def explain_hot_queries(table_id=1, department="ER", access_code=""):
+    """EXPLAIN each hot query; returns (name, key used, expected keys, ok)."""
+    sample_params = [(table_id,), (department,), (access_code,), (90,), (table_id, datetime.now() - REFRESH_OVERLAP), (1,)]
+    results = []
+    with db_cursor() as (conn, cursor):
+        for (name, sql, alias, expected), params in zip(HOT_QUERIES, sample_params):
+            cursor.execute(f"EXPLAIN {sql}", params)
+            plan = [row for row in cursor.fetchall() if row["table"] == alias]
+            key = plan[0]["key"] if plan else None
+            results.append((name, key, expected, key in expected))
+    return results
+
+def main():
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Stocktake database management")
+    subparsers = parser.add_subparsers(dest="command")
+    subparsers.add_parser("init", help="Create tables, seed data and apply migrations (default)")
+    migrate_parser = subparsers.add_parser("migrate", help="Apply pending schema migrations")
+    migrate_parser.add_argument("--target", type=int, help="Stop after this version")
+    subparsers.add_parser("status", help="List migrations and whether they are applied")
+    explain_parser = subparsers.add_parser("explain", help="Check that hot queries use their indexes")
+    explain_parser.add_argument("--table-id", type=int, default=1)
+    explain_parser.add_argument("--department", default="ER")
+    subparsers.add_parser("compact", help="Fold pending count events into stocktake_records")
+    args = parser.parse_args()
+    
+    if args.command in (None, "init"):
+        initialize_database()
+    elif args.command == "migrate":
+        run_migrations(args.target)
+    elif args.command == "status":
+        for version, description, applied in migration_status():
+            print(f"{'✅' if applied else '⏳'} {version:>3}  {description}")
+    elif args.command == "compact":
+        started = time.perf_counter()
+        folded = compact_events()
+        print(f"✅ Compacted {folded} count events in {time.perf_counter() - started:.2f}s")
+    elif args.command == "explain" and DB_BACKEND != "mysql":
+        print("❌ Index checks read MySQL's EXPLAIN output; set DB_BACKEND=mysql")
+        raise SystemExit(1)
+    elif args.command == "explain":
+        failures = 0
+        for name, key, expected, ok in explain_hot_queries(args.table_id, args.department):
+            print(f"{'✅' if ok else '❌'} {name}: key={key} (expected one of {', '.join(sorted(expected))})")
+            failures += not ok
+        raise SystemExit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
\ No newline at end of file
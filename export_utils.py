@@ -0,0 +1,123 @@
+import csv
+import io
+import re
+from datetime import datetime
+from openpyxl import Workbook
+from db_utils import db_connection, db_cursor
+from archive_utils import read_archive
+
+# Rows pulled from the server per round trip while exporting
+EXPORT_CHUNK_SIZE = 2000
+
+RECORD_HEADER = ["drug_name", "packs", "singles", "expiry_date", "Last Updated"]
+RECORD_COLUMNS = ["drug_name", "packs", "singles", "expiry_date", "last_updated"]
+
+def stream_records(table_id, chunk_size=EXPORT_CHUNK_SIZE, columns=RECORD_COLUMNS):
+    """Yield tuples of columns (by default RECORD_COLUMNS) for a table's records.
+
+    Rows come from an unbuffered cursor in chunks, so only one chunk is
+    held in memory at a time. Archived tables are read from their file.
+    """
+    archived = read_archive(table_id)
+    if archived is not None:
+        yield from archived[columns].astype(object).itertuples(index=False, name=None)
+        return
+    select = ", ".join(("d." if column == "drug_name" else "sr.") + column for column in columns)
+    with db_connection() as conn:
+        cursor = conn.cursor(buffered=False)
+        try:
+            cursor.execute(f'''
+                SELECT {select}
+                FROM stocktake_records sr
+                JOIN drugs d ON sr.drug_id = d.id
+                WHERE sr.table_id = %s
+                ORDER BY d.drug_name
+            ''', (table_id,))
+            while True:
+                rows = cursor.fetchmany(chunk_size)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            cursor.close()
+
+def format_timestamp(value):
+    return value.strftime('%Y-%m-%d %H:%M') if value else None
+
+def write_csv(table_id, out):
+    """Stream a table's records as UTF-8 CSV into the binary file out."""
+    text = io.StringIO()
+    writer = csv.writer(text)
+    writer.writerow(RECORD_HEADER)
+    for count, (drug_name, packs, singles, expiry_date, last_updated) in enumerate(stream_records(table_id), 1):
+        writer.writerow([drug_name, packs, singles, expiry_date, format_timestamp(last_updated)])
+        if count % EXPORT_CHUNK_SIZE == 0:
+            out.write(text.getvalue().encode('utf-8'))
+            text.seek(0)
+            text.truncate()
+    out.write(text.getvalue().encode('utf-8'))
+
+def sheet_title(title, used):
+    # Excel sheet names: max 31 chars, no []:*?/\ and unique per workbook
+    base = re.sub(r"[\[\]:*?/\\]", "-", str(title))[:31] or "Sheet"
+    candidate, suffix = base, 2
+    while candidate.lower() in used:
+        candidate = f"{base[:31 - len(str(suffix)) - 1]}~{suffix}"
+        suffix += 1
+    used.add(candidate.lower())
+    return candidate
+
+def write_workbook(sheets, out):
+    """Write [(sheet title, table id)] as one sheet per table into out.
+
+    Uses openpyxl's write-only mode, which streams rows to disk instead of
+    building the whole workbook in memory.
+    """
+    workbook = Workbook(write_only=True)
+    used = set()
+    for title, table_id in sheets:
+        worksheet = workbook.create_sheet(sheet_title(title, used))
+        worksheet.append(RECORD_HEADER)
+        for drug_name, packs, singles, expiry_date, last_updated in stream_records(table_id):
+            worksheet.append([drug_name, packs, singles, expiry_date, format_timestamp(last_updated)])
+    if not sheets:
+        workbook.create_sheet("Empty")
+    workbook.save(out)
+
+def export_csv(table_id):
+    buffer = io.BytesIO()
+    write_csv(table_id, buffer)
+    buffer.seek(0)
+    return buffer
+
+def export_excel(table_id, title="Stocktake"):
+    buffer = io.BytesIO()
+    write_workbook([(title, table_id)], buffer)
+    buffer.seek(0)
+    return buffer
+
+def latest_department_tables(departments):
+    """Latest stocktake table per department, as dicts with id, table_name, department, created_at."""
+    tables = []
+    with db_cursor() as (conn, cursor):
+        for department in departments:
+            cursor.execute(
+                "SELECT id, table_name, department, created_at FROM stocktake_tables "
+                "WHERE department = %s ORDER BY created_at DESC, id DESC LIMIT 1",
+                (department,)
+            )
+            table = cursor.fetchone()
+            if table:
+                tables.append(table)
+    return tables
+
+def export_latest_workbook(departments):
+    """One workbook with each department's latest count on its own sheet."""
+    sheets = [(table["department"], table["id"]) for table in latest_department_tables(departments)]
+    buffer = io.BytesIO()
+    write_workbook(sheets, buffer)
+    buffer.seek(0)
+    return buffer
+
+def export_file_name(prefix, extension):
+    return f"{prefix}_{datetime.now():%Y%m%d_%H%M}.{extension}"
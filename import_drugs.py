@@ -0,0 +1,154 @@
+import argparse
+import csv
+import re
+import time
+from pathlib import Path
+from openpyxl import load_workbook
+from db_utils import db_cursor, chunked, invalidate_cache, bump_catalog_version
+from search_utils import invalidate_drug_index
+
+IMPORT_BATCH_SIZE = 1000
+
+NAME_COLUMNS = ["drug name", "drug_name", "name", "drug"]
+DEPARTMENT_COLUMNS = ["department", "dept"]
+
+def normalize_name(value):
+    if value is None:
+        return None
+    name = re.sub(r"\s+", " ", str(value)).strip()
+    return name or None
+
+def name_key(name):
+    # drugs.drug_name uses a case-insensitive collation, so dedupe the same way
+    return name.casefold()
+
+def find_column(header, candidates, required=True):
+    lookup = {str(column).strip().lower(): position for position, column in enumerate(header) if column is not None}
+    for candidate in candidates:
+        if candidate in lookup:
+            return lookup[candidate]
+    if required:
+        raise ValueError(f"None of the columns {candidates} found in header {header}")
+    return None
+
+def read_rows(path, sheet=None, name_column=None, department_column=None):
+    """Yield (name, department) tuples from a CSV or XLSX file, one row at a time."""
+    path = Path(path)
+    if path.suffix.lower() == ".csv":
+        handle = open(path, newline="", encoding="utf-8-sig")
+        rows = csv.reader(handle)
+    else:
+        # Read-only mode streams rows instead of loading the whole sheet
+        workbook = load_workbook(path, read_only=True, data_only=True)
+        worksheet = workbook[sheet] if sheet else workbook.worksheets[0]
+        rows = worksheet.iter_rows(values_only=True)
+
+    try:
+        header = next(rows, None)
+        if header is None:
+            return
+        name_at = find_column(header, [name_column.lower()] if name_column else NAME_COLUMNS)
+        department_at = find_column(
+            header, [department_column.lower()] if department_column else DEPARTMENT_COLUMNS,
+            required=bool(department_column)
+        )
+        for row in rows:
+            name = row[name_at] if name_at < len(row) else None
+            department = row[department_at] if department_at is not None and department_at < len(row) else None
+            yield name, department
+    finally:
+        if path.suffix.lower() == ".csv":
+            handle.close()
+        else:
+            workbook.close()
+
+def load_catalog(cursor):
+    cursor.execute("SELECT drug_name, department FROM drugs")
+    return {name_key(row["drug_name"]): (row["drug_name"], row["department"]) for row in cursor.fetchall()}
+
+def import_drugs(path, sheet=None, name_column=None, department_column=None,
+                 default_department=None, batch_size=IMPORT_BATCH_SIZE, dry_run=False):
+    """Upsert drug names (and departments) from a spreadsheet into the catalog.
+
+    Rows are compared with the current catalog first, so only new drugs
+    and department changes are written; re-importing the same file writes
+    nothing. Changes are sent as multi-row upserts, committed per batch.
+    Returns a summary dict.
+    """
+    started = time.perf_counter()
+    summary = {"rows": 0, "inserted": 0, "updated": 0, "unchanged": 0, "duplicates": 0, "blank": 0}
+    seen = set()
+    changes = []
+
+    with db_cursor() as (conn, cursor):
+        catalog = load_catalog(cursor)
+
+        for name, department in read_rows(path, sheet, name_column, department_column):
+            summary["rows"] += 1
+            name = normalize_name(name)
+            if not name:
+                summary["blank"] += 1
+                continue
+            key = name_key(name)
+            if key in seen:
+                summary["duplicates"] += 1
+                continue
+            seen.add(key)
+
+            department = (normalize_name(department) or default_department or "").upper() or None
+            existing = catalog.get(key)
+            if existing is None:
+                summary["inserted"] += 1
+                changes.append((name, department))
+            elif department and existing[1] != department:
+                summary["updated"] += 1
+                changes.append((existing[0], department))
+            else:
+                summary["unchanged"] += 1
+
+        if not dry_run:
+            for batch in chunked(changes, batch_size):
+                # executemany turns this into one multi-row INSERT per batch
+                cursor.executemany(
+                    "INSERT INTO drugs (drug_name, department) VALUES (%s, %s) "
+                    "ON DUPLICATE KEY UPDATE department = COALESCE(VALUES(department), department)",
+                    batch
+                )
+                bump_catalog_version(cursor)
+                conn.commit()
+
+    if changes and not dry_run:
+        invalidate_cache("drugs")
+        invalidate_drug_index()
+    summary["seconds"] = time.perf_counter() - started
+    summary["rows_per_second"] = summary["rows"] / summary["seconds"] if summary["seconds"] else 0.0
+    return summary
+
+def print_summary(summary, dry_run=False):
+    prefix = "🔎 Dry run: " if dry_run else "✅ "
+    print(
+        f"{prefix}{summary['rows']} rows read: {summary['inserted']} inserted, "
+        f"{summary['updated']} updated, {summary['unchanged']} unchanged, "
+        f"{summary['duplicates']} duplicates and {summary['blank']} blank rows skipped"
+    )
+    print(f"   {summary['seconds']:.2f}s ({summary['rows_per_second']:,.0f} rows/s)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Import the master drug list from CSV or XLSX")
+    parser.add_argument("path", help="CSV or XLSX file")
+    parser.add_argument("--sheet", help="Worksheet name (defaults to the first sheet)")
+    parser.add_argument("--name-column", help="Header of the drug name column (default: DRUG NAME)")
+    parser.add_argument("--department-column", help="Header of the department column, if any")
+    parser.add_argument("--department", help="Department for rows without one")
+    parser.add_argument("--batch-size", type=int, default=IMPORT_BATCH_SIZE)
+    parser.add_argument("--dry-run", action="store_true", help="Report what would change without writing")
+    args = parser.parse_args()
+
+    summary = import_drugs(
+        args.path, args.sheet, args.name_column, args.department_column,
+        args.department, args.batch_size, args.dry_run
+    )
+    print_summary(summary, args.dry_run)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,206 @@
+import os
+import re
+import threading
+import time
+import zlib
+from collections import deque
+from contextlib import contextmanager
+from pathlib import Path
+
+# Queries slower than this are printed to the server log
+SLOW_QUERY_MS = float(os.getenv('SLOW_QUERY_MS', '500'))
+# When set, a Prometheus-style text dump is written here for a file-based scraper
+METRICS_DIR = os.getenv('METRICS_DIR')
+METRICS_WRITE_SECONDS = 15
+# Timings kept per query / page for percentiles
+SAMPLE_SIZE = 500
+
+def normalize_sql(sql):
+    """SQL with literals and placeholder lists folded, so one statement shape is one key."""
+    sql = re.sub(r"'(?:[^'\\]|\\.|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+\b", "?", sql)
+    sql = sql.replace("%s", "?")
+    sql = re.sub(r"\(\s*\?(?:\s*,\s*\?)+\s*\)", "(?, ...)", sql)
+    sql = re.sub(r"(?:\(\?, \.\.\.\)\s*,\s*)+\(\?, \.\.\.\)", "(?, ...), ...", sql)
+    # Row lists sent as SELECT ... UNION ALL SELECT ... derived tables
+    sql = re.sub(r"(?:\s+UNION ALL\s+SELECT (?:\?, )*\?)+", " UNION ALL ...", sql)
+    return re.sub(r"\s+", " ", sql).strip()
+
+def query_id(sql):
+    return f"{zlib.crc32(sql.encode()):08x}"
+
+def percentile(samples, fraction):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    position = (len(ordered) - 1) * fraction
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+class Metrics:
+    """Process-wide query, page and connection counters, shared by every session."""
+
+    def __init__(self, app="app"):
+        self.app = app
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.collectors = []
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started_at = time.time()
+            self.queries = {}
+            self.pages = {}
+            self.slow_queries = deque(maxlen=50)
+            # Connections borrowed before a reset are still returned afterwards
+            in_use = getattr(self, "connections", {}).get("in_use", 0)
+            self.connections = {"checkouts": 0, "in_use": in_use, "peak_in_use": in_use, "waits": 0, "wait_seconds": 0.0, "errors": 0}
+            self._written_at = 0.0
+
+    @property
+    def current_page(self):
+        return getattr(self._local, "page", None)
+
+    def record_query(self, sql, seconds, rows):
+        key = normalize_sql(sql)
+        page = self.current_page
+        with self._lock:
+            stats = self.queries.get(key)
+            if stats is None:
+                stats = self.queries[key] = {
+                    "calls": 0, "total_seconds": 0.0, "max_seconds": 0.0, "rows": 0,
+                    "pages": set(), "samples": deque(maxlen=SAMPLE_SIZE)
+                }
+            stats["calls"] += 1
+            stats["total_seconds"] += seconds
+            stats["max_seconds"] = max(stats["max_seconds"], seconds)
+            stats["rows"] += rows
+            stats["samples"].append(seconds)
+            if page:
+                stats["pages"].add(page)
+            if seconds * 1000 >= SLOW_QUERY_MS:
+                self.slow_queries.append({
+                    "at": time.strftime("%Y-%m-%d %H:%M:%S"), "page": page,
+                    "ms": round(seconds * 1000, 1), "rows": rows, "sql": key
+                })
+        if seconds * 1000 >= SLOW_QUERY_MS:
+            print(f"⚠️ Slow query ({seconds * 1000:.0f} ms, {rows} rows, page {page}): {key[:300]}")
+
+    def record_checkout(self, wait_seconds, waited):
+        with self._lock:
+            connections = self.connections
+            connections["checkouts"] += 1
+            connections["in_use"] += 1
+            connections["peak_in_use"] = max(connections["peak_in_use"], connections["in_use"])
+            connections["wait_seconds"] += wait_seconds
+            if waited:
+                connections["waits"] += 1
+
+    def record_checkin(self):
+        with self._lock:
+            self.connections["in_use"] -= 1
+
+    def record_connection_error(self):
+        with self._lock:
+            self.connections["errors"] += 1
+
+    @contextmanager
+    def page_timer(self, page):
+        """Time a page render and tag the queries it runs with the page name."""
+        previous = self.current_page
+        self._local.page = page
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            # Also reached when st.rerun() or st.stop() end the render early
+            elapsed = time.perf_counter() - started
+            self._local.page = previous
+            with self._lock:
+                stats = self.pages.setdefault(page, {"renders": 0, "total_seconds": 0.0, "samples": deque(maxlen=SAMPLE_SIZE)})
+                stats["renders"] += 1
+                stats["total_seconds"] += elapsed
+                stats["samples"].append(elapsed)
+            self.write_text_file()
+
+    def top_queries(self, limit=20, by="total_seconds"):
+        with self._lock:
+            rows = [
+                {
+                    "id": query_id(sql),
+                    "sql": sql,
+                    "calls": stats["calls"],
+                    "total_ms": round(stats["total_seconds"] * 1000, 1),
+                    "mean_ms": round(stats["total_seconds"] / stats["calls"] * 1000, 2),
+                    "p95_ms": round(percentile(stats["samples"], 0.95) * 1000, 2),
+                    "max_ms": round(stats["max_seconds"] * 1000, 1),
+                    "rows": stats["rows"],
+                    "pages": ", ".join(sorted(stats["pages"]))
+                }
+                for sql, stats in self.queries.items()
+            ]
+        key = {"total_seconds": "total_ms", "calls": "calls", "max_seconds": "max_ms", "p95": "p95_ms"}[by]
+        return sorted(rows, key=lambda row: row[key], reverse=True)[:limit]
+
+    def page_percentiles(self):
+        with self._lock:
+            return [
+                {
+                    "page": page,
+                    "renders": stats["renders"],
+                    "p50_ms": round(percentile(stats["samples"], 0.5) * 1000, 1),
+                    "p95_ms": round(percentile(stats["samples"], 0.95) * 1000, 1),
+                    "p99_ms": round(percentile(stats["samples"], 0.99) * 1000, 1),
+                    "mean_ms": round(stats["total_seconds"] / stats["renders"] * 1000, 1)
+                }
+                for page, stats in sorted(self.pages.items())
+            ]
+
+    def connection_stats(self):
+        with self._lock:
+            return dict(self.connections)
+
+    def add_collector(self, collector):
+        # collector() returns {metric name: number} for the text dump
+        self.collectors.append(collector)
+
+    def text_dump(self):
+        """Metrics in the Prometheus text exposition format."""
+        label = f'app="{self.app}"'
+        lines = [f"stocktake_uptime_seconds{{{label}}} {time.time() - self.started_at:.0f}"]
+        for name, value in self.connection_stats().items():
+            lines.append(f"stocktake_connections_{name}{{{label}}} {value:g}")
+        for page in self.page_percentiles():
+            page_label = f'{label},page="{page["page"]}"'
+            lines.append(f"stocktake_page_renders_total{{{page_label}}} {page['renders']}")
+            for quantile in ("p50", "p95", "p99"):
+                lines.append(
+                    f'stocktake_page_render_seconds{{{page_label},quantile="0.{quantile[1:]}"}} {page[quantile + "_ms"] / 1000:g}'
+                )
+        for query in self.top_queries(limit=50):
+            # Statement text is too long for a label; the id is a hash of it
+            query_label = f'{label},query="{query["id"]}"'
+            lines.append(f"stocktake_query_calls_total{{{query_label}}} {query['calls']}")
+            lines.append(f"stocktake_query_seconds_total{{{query_label}}} {query['total_ms'] / 1000:g}")
+            lines.append(f"stocktake_query_rows_total{{{query_label}}} {query['rows']}")
+        lines.append(f"stocktake_slow_queries{{{label}}} {len(self.slow_queries)}")
+        for collector in self.collectors:
+            for name, value in collector().items():
+                lines.append(f"stocktake_{name}{{{label}}} {value:g}")
+        return "\n".join(lines) + "\n"
+
+    def write_text_file(self, force=False):
+        if not METRICS_DIR or (not force and time.monotonic() - self._written_at < METRICS_WRITE_SECONDS):
+            return
+        self._written_at = time.monotonic()
+        path = Path(METRICS_DIR) / f"stocktake_{self.app}.prom"
+        temporary = path.with_suffix(".tmp")
+        try:
+            temporary.write_text(self.text_dump())
+            temporary.replace(path)
+        except OSError as e:
+            print(f"❌ Error writing metrics to {path}: {e}")
+
+metrics = Metrics()
@@ -0,0 +1,322 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+import mysql.connector
+from db_utils import (
+    db_cursor, chunked, id_filter, validate_count_rows, fill_kept, update_stocktake_records, compact_events,
+    CONFLICT_REASON, UPDATE_BATCH_SIZE
+)
+from search_utils import DrugIndex, MAX_RESULTS
+from sqlite_utils import SqliteDatabase
+
+# Local store on the ward machine; one file holds every downloaded table
+OFFLINE_STORE = os.getenv('OFFLINE_STORE', 'ward_store.db')
+
+_store = None
+_store_lock = threading.Lock()
+_indexes = {}
+
+def create_local_tables(cursor):
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS local_tables (
+        id INTEGER PRIMARY KEY,
+        table_name TEXT NOT NULL,
+        department TEXT NOT NULL,
+        access_code TEXT NOT NULL,
+        downloaded_at TIMESTAMP NOT NULL,
+        synced_at TIMESTAMP
+    )
+    ''')
+    # last_updated is the server's value the local copy is based on; conflicts
+    # keep the server's newer values alongside the local ones until resolved
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS local_records (
+        id INTEGER PRIMARY KEY,
+        table_id INTEGER NOT NULL REFERENCES local_tables(id),
+        drug_id INTEGER NOT NULL,
+        drug_name TEXT NOT NULL COLLATE NOCASE,
+        department TEXT,
+        packs INTEGER DEFAULT 0,
+        singles INTEGER DEFAULT 0,
+        expiry_date DATE,
+        last_updated TIMESTAMP,
+        local_updated TIMESTAMP,
+        updated_by TEXT,
+        dirty INTEGER NOT NULL DEFAULT 0,
+        conflict INTEGER NOT NULL DEFAULT 0,
+        server_packs INTEGER,
+        server_singles INTEGER,
+        server_expiry_date DATE,
+        server_last_updated TIMESTAMP,
+        server_updated_by TEXT
+    )
+    ''')
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_local_records_name ON local_records (table_id, drug_name, id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_local_records_dirty ON local_records (table_id, dirty)")
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store = SqliteDatabase(OFFLINE_STORE)
+                conn = store.get_connection()
+                try:
+                    create_local_tables(conn.cursor())
+                    conn.commit()
+                finally:
+                    conn.close()
+                _store = store
+    return _store
+
+@contextmanager
+def local_cursor():
+    """Yield (conn, cursor) on the local store, rolled back on error."""
+    conn = get_store().get_connection()
+    cursor = conn.cursor(dictionary=True)
+    try:
+        yield conn, cursor
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cursor.close()
+        conn.close()
+
+def download_table(table_id):
+    """Copy a stocktake table from the server into the local store.
+
+    Rows with unsynced local changes are kept as they are; every other
+    row is replaced by the server's copy, so this also refreshes a table
+    downloaded earlier. Returns the number of records stored.
+    """
+    with db_cursor() as (conn, cursor):
+        cursor.execute(
+            "SELECT id, table_name, department, access_code FROM stocktake_tables WHERE id = %s",
+            (table_id,)
+        )
+        table = cursor.fetchone()
+        cursor.execute('''
+            SELECT sr.id, sr.drug_id, d.drug_name, d.department, sr.packs, sr.singles, sr.expiry_date, sr.last_updated
+            FROM stocktake_records sr
+            JOIN drugs d ON sr.drug_id = d.id
+            WHERE sr.table_id = %s
+        ''', (table_id,))
+        records = cursor.fetchall()
+    if table is None:
+        raise ValueError(f"Stocktake table {table_id} not found")
+
+    with local_cursor() as (conn, cursor):
+        cursor.execute('''
+            INSERT INTO local_tables (id, table_name, department, access_code, downloaded_at)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (id) DO UPDATE SET table_name = excluded.table_name, department = excluded.department,
+                access_code = excluded.access_code, downloaded_at = excluded.downloaded_at
+        ''', (table["id"], table["table_name"], table["department"], table["access_code"], datetime.now()))
+        cursor.executemany('''
+            INSERT INTO local_records (id, table_id, drug_id, drug_name, department, packs, singles, expiry_date, last_updated)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            ON CONFLICT (id) DO UPDATE SET drug_name = excluded.drug_name, department = excluded.department,
+                packs = excluded.packs, singles = excluded.singles, expiry_date = excluded.expiry_date,
+                last_updated = excluded.last_updated
+            WHERE NOT local_records.dirty
+        ''', [
+            (r["id"], table_id, r["drug_id"], r["drug_name"], r["department"], r["packs"], r["singles"],
+             r["expiry_date"], r["last_updated"])
+            for r in records
+        ])
+        conn.commit()
+    _indexes.pop(table_id, None)
+    return len(records)
+
+def find_local_table(access_code):
+    with local_cursor() as (conn, cursor):
+        cursor.execute(
+            "SELECT id, table_name, department FROM local_tables WHERE access_code = %s",
+            (access_code,)
+        )
+        return cursor.fetchone()
+
+def local_status(table_id):
+    """Record, unsynced and conflict counts plus download/sync times for a local table."""
+    with local_cursor() as (conn, cursor):
+        cursor.execute('''
+            SELECT t.downloaded_at, t.synced_at, COUNT(r.id) AS records,
+                   COALESCE(SUM(r.dirty), 0) AS unsynced, COALESCE(SUM(r.conflict), 0) AS conflicts
+            FROM local_tables t
+            LEFT JOIN local_records r ON r.table_id = t.id
+            WHERE t.id = %s
+            GROUP BY t.id
+        ''', (table_id,))
+        return cursor.fetchone()
+
+# Same row shape as db_utils.get_table_records; last_updated shows local edits
+LOCAL_RECORD_COLUMNS = '''
+    id, drug_id, drug_name, packs, singles, expiry_date,
+    COALESCE(local_updated, last_updated) AS "last_updated [TIMESTAMP]"
+'''
+
+def get_local_records(table_id, drug_ids=None):
+    drug_filter, params = "", [table_id]
+    if drug_ids is not None:
+        drug_filter = f"AND {id_filter('drug_id', drug_ids)}"
+        params.extend(drug_ids)
+    with local_cursor() as (conn, cursor):
+        cursor.execute(
+            f"SELECT {LOCAL_RECORD_COLUMNS} FROM local_records WHERE table_id = %s {drug_filter} ORDER BY drug_name",
+            params
+        )
+        return cursor.fetchall()
+
+def get_local_records_page(table_id, limit, after=None):
+    """Keyset page of local records ordered by (drug_name, id), like get_table_records_page."""
+    seek, params = "", [table_id]
+    if after:
+        seek = "AND (drug_name > %s OR (drug_name = %s AND id > %s))"
+        params.extend([after[0], after[0], after[1]])
+    params.append(limit)
+    with local_cursor() as (conn, cursor):
+        cursor.execute(
+            f"SELECT {LOCAL_RECORD_COLUMNS} FROM local_records WHERE table_id = %s {seek} ORDER BY drug_name, id LIMIT %s",
+            params
+        )
+        return cursor.fetchall()
+
+def search_local(table_id, query, limit=MAX_RESULTS):
+    """Drug ids in a local table matching query, ranked like search_drugs()."""
+    index = _indexes.get(table_id)
+    if index is None:
+        with local_cursor() as (conn, cursor):
+            cursor.execute("SELECT drug_id AS id, drug_name, department FROM local_records WHERE table_id = %s", (table_id,))
+            index = _indexes[table_id] = DrugIndex(cursor.fetchall())
+    return [drug_id for drug_id, rank, score in index.search(query, None, limit)]
+
+def save_local_counts(table_id, rows, updated_by=None, session_id=None):
+    """Write count edits to the local store; same arguments and result as update_stocktake_records."""
+    values, failed = validate_count_rows(rows)
+    if not values:
+        return [], failed
+
+    record_ids = list(values)
+    now = datetime.now()
+    with local_cursor() as (conn, cursor):
+        found = {}
+        for chunk in chunked(record_ids, UPDATE_BATCH_SIZE):
+            cursor.execute(
+                f"SELECT id, packs, singles, expiry_date FROM local_records WHERE table_id = %s AND {id_filter('id', chunk)}",
+                (table_id, *chunk)
+            )
+            found.update((row["id"], row) for row in cursor.fetchall())
+        for record_id in record_ids:
+            if record_id not in found:
+                failed[record_id] = "Record is not part of this stocktake table"
+        cursor.executemany(
+            "UPDATE local_records SET packs = %s, singles = %s, expiry_date = %s, "
+            "local_updated = %s, updated_by = %s, dirty = 1 WHERE id = %s",
+            [(packs, singles, expiry, now, updated_by, record_id)
+             for record_id, packs, singles, expiry in (fill_kept(values[i], found[i]) for i in record_ids if i in found)]
+        )
+        conn.commit()
+    return [record_id for record_id in record_ids if record_id not in failed], failed
+
+def fetch_server_rows(table_id, record_ids):
+    rows = {}
+    with db_cursor() as (conn, cursor):
+        for chunk in chunked(record_ids, UPDATE_BATCH_SIZE):
+            cursor.execute(
+                f"SELECT id, packs, singles, expiry_date, last_updated, updated_by FROM stocktake_records "
+                f"WHERE table_id = %s AND {id_filter('id', chunk)}",
+                (table_id, *chunk)
+            )
+            rows.update((row["id"], row) for row in cursor.fetchall())
+    return rows
+
+def sync_table(table_id):
+    """Upload unsynced local counts for a table to the server.
+
+    Each row is sent with the server last_updated it was based on, so rows
+    someone else changed in the meantime are not overwritten: they are
+    flagged as conflicts with the server's values kept for resolve_conflicts().
+    Returns a summary dict with synced, conflicts, failed (id -> reason),
+    error and seconds.
+    """
+    started = time.perf_counter()
+    summary = {"synced": 0, "conflicts": 0, "failed": {}, "error": None}
+    with local_cursor() as (conn, cursor):
+        cursor.execute('''
+            SELECT id, packs, singles, expiry_date, last_updated, local_updated, updated_by
+            FROM local_records WHERE table_id = %s AND dirty AND NOT conflict
+        ''', (table_id,))
+        dirty = cursor.fetchall()
+
+    # One batched upload per counter name, since updated_by is per call
+    by_counter = {}
+    for row in dirty:
+        by_counter.setdefault(row["updated_by"], []).append(row)
+    try:
+        synced, conflicts = [], []
+        for updated_by, rows in by_counter.items():
+            updated, failed = update_stocktake_records(table_id, rows, updated_by=updated_by)
+            synced.extend(updated)
+            for record_id, reason in failed.items():
+                if reason == CONFLICT_REASON:
+                    conflicts.append(record_id)
+                else:
+                    summary["failed"][record_id] = reason
+        # Fold the uploaded events in now, so the versions read back are the server's current ones
+        compact_events()
+        server = fetch_server_rows(table_id, synced + conflicts)
+    except mysql.connector.Error as e:
+        summary["error"] = str(e)
+        summary["seconds"] = time.perf_counter() - started
+        return summary
+
+    local_updated = {row["id"]: row["local_updated"] for row in dirty}
+    with local_cursor() as (conn, cursor):
+        # Rows edited again while the upload ran stay dirty for the next sync
+        cursor.executemany(
+            "UPDATE local_records SET dirty = 0, last_updated = %s WHERE id = %s AND local_updated = %s",
+            [(server[i]["last_updated"], i, local_updated[i]) for i in synced if i in server]
+        )
+        cursor.executemany('''
+            UPDATE local_records SET conflict = 1, server_packs = %s, server_singles = %s,
+                server_expiry_date = %s, server_last_updated = %s, server_updated_by = %s
+            WHERE id = %s
+        ''', [
+            (s["packs"], s["singles"], s["expiry_date"], s["last_updated"], s["updated_by"], i)
+            for i, s in ((i, server[i]) for i in conflicts if i in server)
+        ])
+        cursor.execute("UPDATE local_tables SET synced_at = %s WHERE id = %s", (datetime.now(), table_id))
+        conn.commit()
+
+    summary.update(synced=len(synced), conflicts=len(conflicts), seconds=time.perf_counter() - started)
+    return summary
+
+def get_conflicts(table_id):
+    with local_cursor() as (conn, cursor):
+        cursor.execute('''
+            SELECT id, drug_name, packs, singles, expiry_date, updated_by,
+                   server_packs, server_singles, server_expiry_date, server_updated_by
+            FROM local_records WHERE table_id = %s AND conflict
+            ORDER BY drug_name
+        ''', (table_id,))
+        return cursor.fetchall()
+
+def resolve_conflicts(table_id, record_ids, keep_local):
+    """Keep the local counts (sent on the next sync) or take the server's for these records."""
+    if not record_ids:
+        return
+    if keep_local:
+        update = "last_updated = server_last_updated"
+    else:
+        update = ('''packs = server_packs, singles = server_singles, expiry_date = server_expiry_date,
+                     last_updated = server_last_updated, local_updated = NULL, dirty = 0''')
+    with local_cursor() as (conn, cursor):
+        cursor.execute(f'''
+            UPDATE local_records SET {update}, conflict = 0, server_packs = NULL, server_singles = NULL,
+                server_expiry_date = NULL, server_last_updated = NULL, server_updated_by = NULL
+            WHERE table_id = %s AND conflict AND {id_filter('id', record_ids)}
+        ''', (table_id, *record_ids))
+        conn.commit()
@@ -0,0 +1,191 @@
+import io
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+import pandas as pd
+from db_utils import fetch_all, counted_sql, POOL_SIZE
+from archive_utils import get_archive, read_archive
+from export_utils import stream_records, sheet_title, RECORD_COLUMNS
+
+# Tables the department report fetches at once; each holds a pooled connection
+REPORT_WORKERS = int(os.getenv('REPORT_WORKERS', '7'))
+
+# Lines a department report shows; updated_by also tells which lines were counted
+REPORT_COLUMNS = RECORD_COLUMNS + ["updated_by"]
+COUNT_COLUMNS = ["base_packs", "base_singles", "current_packs", "current_singles"]
+LINE_COLUMNS = ["drug_id", "drug_name", "department", "packs", "singles"]
+
+def table_lines(table_id):
+    """(drug_id, drug_name, department, packs, singles) of a live or archived table."""
+    archived = read_archive(table_id)
+    if archived is not None:
+        return archived[LINE_COLUMNS]
+    return pd.DataFrame(fetch_all('''
+        SELECT sr.drug_id, d.drug_name, d.department, sr.packs, sr.singles
+        FROM stocktake_records sr
+        JOIN drugs d ON sr.drug_id = d.id
+        WHERE sr.table_id = %s
+    ''', (table_id,)), columns=LINE_COLUMNS)
+
+def merge_lines(base_id, current_id):
+    # Archived tables are read from their files, so the two sides are joined in pandas
+    base = table_lines(base_id).rename(columns={"packs": "base_packs", "singles": "base_singles"}).assign(in_base=1)
+    current = table_lines(current_id).rename(columns={"packs": "current_packs", "singles": "current_singles"}).assign(in_current=1)
+    df = current.merge(base, on="drug_id", how="outer", suffixes=("", "_base"))
+    # Names come from the current side, falling back to the base for missing lines
+    df["drug_name"] = df["drug_name"].fillna(df["drug_name_base"])
+    df["department"] = df["department"].fillna(df["department_base"])
+    df[["in_base", "in_current"]] = df[["in_base", "in_current"]].fillna(0)
+    return df.sort_values("drug_name", ignore_index=True)
+
+def compare_tables(base_id, current_id):
+    """Per-drug variance between two stocktake tables.
+
+    Live tables are read in one aggregate query (MySQL has no FULL OUTER
+    JOIN, so each side is pivoted with conditional SUMs); when either
+    table is archived the sides are merged in pandas instead. Deltas and
+    statuses are computed column-wise in pandas. Status is one of
+    new (only in the current table), missing (only in the base table),
+    changed or unchanged.
+    """
+    columns = ["drug_id", "drug_name", "department"] + COUNT_COLUMNS + ["in_base", "in_current"]
+    if get_archive(base_id) or get_archive(current_id):
+        return variance_columns(merge_lines(base_id, current_id)[columns])
+    rows = fetch_all('''
+        SELECT sr.drug_id, d.drug_name, d.department,
+               SUM(CASE WHEN sr.table_id = %s THEN sr.packs END) AS base_packs,
+               SUM(CASE WHEN sr.table_id = %s THEN sr.singles END) AS base_singles,
+               SUM(CASE WHEN sr.table_id = %s THEN sr.packs END) AS current_packs,
+               SUM(CASE WHEN sr.table_id = %s THEN sr.singles END) AS current_singles,
+               MAX(sr.table_id = %s) AS in_base,
+               MAX(sr.table_id = %s) AS in_current
+        FROM stocktake_records sr
+        JOIN drugs d ON sr.drug_id = d.id
+        WHERE sr.table_id IN (%s, %s)
+        GROUP BY sr.drug_id, d.drug_name, d.department
+        ORDER BY d.drug_name
+    ''', (base_id, base_id, current_id, current_id, base_id, current_id, base_id, current_id))
+
+    return variance_columns(pd.DataFrame(rows, columns=columns))
+
+def variance_columns(df):
+    for column in COUNT_COLUMNS:
+        df[column] = pd.to_numeric(df[column]).fillna(0).astype("int64")
+    in_base = df["in_base"].astype(bool)
+    in_current = df["in_current"].astype(bool)
+
+    df["packs_delta"] = df["current_packs"] - df["base_packs"]
+    df["singles_delta"] = df["current_singles"] - df["base_singles"]
+    df["department"] = df["department"].fillna("Unassigned")
+    df["status"] = "unchanged"
+    df.loc[(df["packs_delta"] != 0) | (df["singles_delta"] != 0), "status"] = "changed"
+    df.loc[in_current & ~in_base, "status"] = "new"
+    df.loc[in_base & ~in_current, "status"] = "missing"
+    return df.drop(columns=["in_base", "in_current"])
+
+def variance_rollup(comparison):
+    """Totals and line counts per drug department for a compare_tables() result."""
+    if comparison.empty:
+        return pd.DataFrame()
+    status_counts = pd.crosstab(comparison["department"], comparison["status"])
+    totals = comparison.groupby("department")[
+        COUNT_COLUMNS + ["packs_delta", "singles_delta"]
+    ].sum()
+    rollup = totals.join(status_counts).fillna(0).reset_index()
+    grand_total = rollup.drop(columns=["department"]).sum(numeric_only=True)
+    grand_total["department"] = "TOTAL"
+    return pd.concat([rollup, grand_total.to_frame().T], ignore_index=True)
+
+def department_series(table_ids):
+    """Totals per table in table_ids (oldest first) with change from the previous count."""
+    if not table_ids:
+        return pd.DataFrame()
+    placeholders = ", ".join(["%s"] * len(table_ids))
+    rows = fetch_all(f'''
+        SELECT t.id AS table_id, t.table_name, t.department, t.created_at,
+               COALESCE(a.line_count, COUNT(sr.id)) AS line_count,
+               COALESCE(a.counted_lines, SUM({counted_sql('sr')})) AS counted_lines,
+               COALESCE(a.total_packs, SUM(sr.packs)) AS total_packs,
+               COALESCE(a.total_singles, SUM(sr.singles)) AS total_singles
+        FROM stocktake_tables t
+        LEFT JOIN stocktake_records sr ON sr.table_id = t.id
+        LEFT JOIN table_archives a ON a.table_id = t.id
+        WHERE t.id IN ({placeholders})
+        GROUP BY t.id, t.table_name, t.department, t.created_at,
+                 a.line_count, a.counted_lines, a.total_packs, a.total_singles
+        ORDER BY t.created_at, t.id
+    ''', tuple(table_ids))
+    df = pd.DataFrame(rows)
+    df = df.rename(columns={"line_count": "lines"})
+    for column in ["lines", "counted_lines", "total_packs", "total_singles"]:
+        df[column] = pd.to_numeric(df[column]).fillna(0).astype("int64")
+    df["packs_change"] = df["total_packs"].diff()
+    df["singles_change"] = df["total_singles"].diff()
+    return df
+
+def variance_workbook(comparison, rollup):
+    buffer = io.BytesIO()
+    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+        comparison.to_excel(writer, sheet_name="Lines", index=False)
+        rollup.to_excel(writer, sheet_name="By department", index=False)
+    buffer.seek(0)
+    return buffer
+
+def table_report_lines(table):
+    started = time.perf_counter()
+    lines = pd.DataFrame(list(stream_records(table["id"], columns=REPORT_COLUMNS)), columns=REPORT_COLUMNS)
+    return lines, time.perf_counter() - started
+
+def department_report(tables):
+    """Records and totals for several tables, fetched concurrently.
+
+    tables are dicts with id, table_name, department and created_at, one
+    per department. Each table is read on its own pooled connection in a
+    thread, so the wall time is close to the slowest table rather than
+    the sum. Returns (summary with a row per table and a TOTAL row,
+    {department: lines DataFrame}).
+    """
+    if not tables:
+        return pd.DataFrame(), {}
+    workers = max(1, min(len(tables), REPORT_WORKERS, POOL_SIZE))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="department_report") as executor:
+        results = list(executor.map(table_report_lines, tables))
+
+    today = pd.Timestamp(date.today())
+    rows, lines = [], {}
+    for table, (records, seconds) in zip(tables, results):
+        # is_counted, vectorised: pandas reads a missing updated_by as NaN rather than None
+        counted = records["updated_by"].notna()
+        expired = pd.to_datetime(records["expiry_date"]) < today
+        rows.append({
+            "department": table["department"],
+            "table_name": table["table_name"],
+            "created_at": table["created_at"],
+            "lines": len(records),
+            "counted_lines": int(counted.sum()),
+            "counted_pct": round(100 * counted.mean(), 1) if len(records) else 0.0,
+            "total_packs": int(records["packs"].fillna(0).sum()),
+            "total_singles": int(records["singles"].fillna(0).sum()),
+            "expired_lines": int(expired.sum()),
+            "last_updated": records["last_updated"].max() if len(records) else None,
+            "fetch_ms": round(seconds * 1000, 1)
+        })
+        lines[table["department"]] = records
+
+    summary = pd.DataFrame(rows)
+    totals = summary[["lines", "counted_lines", "total_packs", "total_singles", "expired_lines"]].sum()
+    total_row = {"department": "TOTAL", **totals.to_dict()}
+    total_row["counted_pct"] = round(100 * totals["counted_lines"] / totals["lines"], 1) if totals["lines"] else 0.0
+    return pd.concat([summary, pd.DataFrame([total_row])], ignore_index=True), lines
+
+def department_workbook(summary, lines):
+    """A Summary sheet followed by one sheet of lines per department."""
+    buffer = io.BytesIO()
+    used = {"summary"}
+    with pd.ExcelWriter(buffer, engine="openpyxl") as writer:
+        summary.to_excel(writer, sheet_name="Summary", index=False)
+        for department, records in lines.items():
+            records.to_excel(writer, sheet_name=sheet_title(department, used), index=False)
+    buffer.seek(0)
+    return buffer
@@ -0,0 +1,175 @@
+import re
+import threading
+import heapq
+from bisect import bisect_left
+from collections import defaultdict
+from catalog_utils import get_catalog, invalidate_catalog
+
+# Candidates sharing fewer trigrams than this fraction of the query's are dropped
+FUZZY_THRESHOLD = 0.45
+# Fuzzy candidates are gathered from the rarest query trigrams up to about this many
+FUZZY_CANDIDATES = 1000
+MAX_RESULTS = 200
+
+# Match ranks, best first
+EXACT, PREFIX, WORD_PREFIX, SUBSTRING, FUZZY = range(5)
+
+def normalize(text):
+    return re.sub(r"[^a-z0-9]+", " ", str(text).lower()).strip()
+
+def trigrams(text):
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class DrugIndex:
+    """Sorted-prefix and trigram index over drug names."""
+
+    def __init__(self, drugs, signature=None):
+        self.signature = signature
+        self.names = {}
+        self.departments = {}
+        self.grams = {}
+        self.postings = defaultdict(set)
+        self.word_ids = defaultdict(list)
+
+        for drug in drugs:
+            drug_id = drug["id"]
+            name = normalize(drug["drug_name"])
+            self.names[drug_id] = name
+            self.departments[drug_id] = drug["department"]
+            self.grams[drug_id] = trigrams(name)
+            for gram in self.grams[drug_id]:
+                self.postings[gram].add(drug_id)
+            for word in set(name.split()):
+                self.word_ids[word].append(drug_id)
+
+        self.sorted_names = sorted((name, drug_id) for drug_id, name in self.names.items())
+        self.sorted_words = sorted((word,) for word in self.word_ids)
+        # Ids in name order, so equally ranked hits can be taken best first and cut off at the limit
+        self.position = {drug_id: position for position, (name, drug_id) in enumerate(self.sorted_names)}
+        for ids in self.word_ids.values():
+            ids.sort(key=self.position.__getitem__)
+
+    def __len__(self):
+        return len(self.names)
+
+    def _prefixed(self, entries, prefix):
+        position = bisect_left(entries, (prefix,))
+        while position < len(entries) and entries[position][0].startswith(prefix):
+            yield entries[position]
+            position += 1
+
+    def search(self, query, department=None, limit=MAX_RESULTS, drug_ids=None):
+        """Return [(drug_id, rank, score)] ordered best match first.
+
+        drug_ids, if given, is a collection the results must come from; it
+        is applied before the limit, so a small table is searched in full.
+        Exact, prefix, word-prefix and substring hits are visited in name
+        order and the search stops once limit of them are found.
+        """
+        query = normalize(query)
+        if not query:
+            return []
+
+        if department and drug_ids is not None:
+            allowed = lambda drug_id: drug_id in drug_ids and self.departments[drug_id] == department
+        elif department:
+            allowed = lambda drug_id: self.departments[drug_id] == department
+        elif drug_ids is not None:
+            allowed = lambda drug_id: drug_id in drug_ids
+        else:
+            allowed = lambda drug_id: True
+        matches = {}
+
+        # Names are visited in sorted order, so the first `limit` prefix hits are the best
+        for name, drug_id in self._prefixed(self.sorted_names, query):
+            if allowed(drug_id):
+                matches[drug_id] = (EXACT if name == query else PREFIX, 1.0)
+                if len(matches) >= limit:
+                    return [(drug_id, rank, score) for drug_id, (rank, score) in matches.items()]
+
+        words = query.split()
+        if len(words) == 1:
+            # Names with a word starting with the query, merged across the matching words
+            lists = [self.word_ids[word] for (word,) in self._prefixed(self.sorted_words, query)]
+            hits = heapq.merge(*lists, key=self.position.__getitem__)
+        else:
+            # Every word but the last must appear whole, so the rarest of them bounds the hits
+            whole = [self.word_ids.get(word, ()) for word in words[:-1]]
+            hits = (drug_id for drug_id in min(whole, key=len) if f" {query}" in f" {self.names[drug_id]}")
+        for drug_id in hits:
+            if len(matches) >= limit:
+                break
+            if drug_id not in matches and allowed(drug_id):
+                matches[drug_id] = (WORD_PREFIX, 1.0)
+
+        # Substring: a name containing the query contains all of its inner trigrams
+        inner = [query[i:i + 3] for i in range(len(query) - 2)]
+        if inner and len(matches) < limit:
+            inner.sort(key=lambda gram: len(self.postings.get(gram, ())))
+            candidates = set(self.postings.get(inner[0], ()))
+            for gram in inner[1:]:
+                if not candidates:
+                    break
+                candidates &= self.postings.get(gram, set())
+            hits = (drug_id for drug_id in sorted(candidates, key=self.position.__getitem__) if query in self.names[drug_id])
+            for drug_id in hits:
+                if len(matches) >= limit:
+                    break
+                if drug_id not in matches and allowed(drug_id):
+                    matches[drug_id] = (SUBSTRING, 1.0)
+
+        # Hits so far were added best rank first and in name order within a rank
+        ranked = [(drug_id, rank, score) for drug_id, (rank, score) in matches.items()]
+
+        # Fuzzy only when the better ranks leave room in the result list
+        if len(matches) < limit:
+            query_grams = trigrams(query)
+            needed = max(1, int(FUZZY_THRESHOLD * len(query_grams) + 0.999))
+            # Any candidate with enough shared trigrams has one of the rarest few. Queries
+            # made only of common trigrams stop at FUZZY_CANDIDATES rather than scan the catalog.
+            rarest = sorted(query_grams, key=lambda gram: len(self.postings.get(gram, ())))
+            candidates = set()
+            for gram in rarest[:len(query_grams) - needed + 1]:
+                posting = self.postings.get(gram, ())
+                if candidates and len(candidates) + len(posting) > FUZZY_CANDIDATES:
+                    break
+                candidates.update(posting)
+            candidates.difference_update(matches)
+            if drug_ids is not None and len(drug_ids) < len(candidates):
+                candidates = candidates.intersection(drug_ids)
+            grams, names, size = self.grams, self.names, len(query_grams)
+            fuzzy = []
+            for drug_id in candidates:
+                name_grams = grams[drug_id]
+                shared = len(query_grams & name_grams)
+                if shared >= needed and allowed(drug_id):
+                    # Dice coefficient over trigram sets
+                    fuzzy.append((-2 * shared / (size + len(name_grams)), names[drug_id], drug_id))
+            ranked += [(drug_id, FUZZY, -score) for score, name, drug_id in heapq.nsmallest(limit - len(matches), fuzzy)]
+        return ranked
+
+_index = None
+_index_lock = threading.Lock()
+
+def get_drug_index():
+    """Process-wide index, rebuilt when the shared drug catalog changes."""
+    global _index
+    catalog = get_catalog()
+    if _index is not None and _index.signature == catalog.signature:
+        return _index
+    with _index_lock:
+        if _index is None or _index.signature != catalog.signature:
+            _index = DrugIndex(catalog.drugs(), catalog.signature)
+    return _index
+
+def invalidate_drug_index():
+    # Called after writes to drugs so the next search rebuilds immediately
+    global _index
+    invalidate_catalog()
+    with _index_lock:
+        _index = None
+
+def search_drugs(query, department=None, limit=MAX_RESULTS, drug_ids=None):
+    """Ranked drug ids matching query: exact, prefix, substring, then fuzzy."""
+    return [drug_id for drug_id, rank, score in get_drug_index().search(query, department, limit, drug_ids)]
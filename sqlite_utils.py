@@ -0,0 +1,214 @@
+import queue
+import re
+import sqlite3
+from datetime import date, datetime
+from functools import lru_cache
+import mysql.connector
+
+# Seconds a writer waits for the WAL write lock before giving up
+BUSY_TIMEOUT = 10
+# Idle connections kept open per database file
+MAX_IDLE_CONNECTIONS = 8
+
+# Store dates as ISO text and read DATE/TIMESTAMP columns back as date/datetime,
+# matching what mysql-connector returns
+sqlite3.register_adapter(date, lambda value: value.isoformat())
+sqlite3.register_adapter(datetime, lambda value: value.isoformat(" "))
+sqlite3.register_converter("DATE", lambda value: date.fromisoformat(value.decode()[:10]))
+sqlite3.register_converter("TIMESTAMP", lambda value: datetime.fromisoformat(value.decode()))
+
+def translate_create_table(sql):
+    # Inline INDEX / UNIQUE KEY clauses become separate CREATE INDEX statements
+    table = re.search(r"CREATE TABLE (?:IF NOT EXISTS )?(\w+)", sql).group(1)
+    indexes = []
+    def extract(match):
+        unique = "UNIQUE " if match.group(1) else ""
+        indexes.append(f"CREATE {unique}INDEX IF NOT EXISTS {match.group(2)} ON {table} {match.group(3)}")
+        return ""
+    sql = re.sub(r",\s*(UNIQUE )?(?:KEY|INDEX) (\w+) (\([^)]*\))", extract, sql)
+    sql = re.sub(r"\bINT AUTO_INCREMENT PRIMARY KEY\b", "INTEGER PRIMARY KEY AUTOINCREMENT", sql)
+    # MySQL's default collation compares text case-insensitively
+    sql = re.sub(r"\bVARCHAR\(\d+\)", "TEXT COLLATE NOCASE", sql)
+    sql = re.sub(r"\bDEFAULT CURRENT_TIMESTAMP\b", "DEFAULT (datetime('now', 'localtime'))", sql)
+    sql = re.sub(r"\s+ON UPDATE CURRENT_TIMESTAMP\b", "", sql)
+    return (sql, *indexes)
+
+def translate_update_join(match):
+    table, alias, source, source_alias, condition, assignments, where = match.groups()
+    # SQLite's UPDATE ... FROM does not allow qualified column names on the left of SET
+    assignments = re.sub(rf"(^|,)\s*{alias}\.(\w+)\s*=", r"\1 \2 =", assignments)
+    conditions = condition if where is None else f"{condition} AND {where}"
+    return f"UPDATE {table} AS {alias} SET {assignments} FROM {source} AS {source_alias} WHERE {conditions}"
+
+@lru_cache(maxsize=512)
+def translate(sql):
+    """Rewrite the MySQL dialect used by the app into SQLite; returns a tuple of statements.
+
+    Covers the constructs the app uses, not MySQL in general. %s becomes
+    numbered ?N placeholders, so clauses can be reordered without
+    reordering the parameters.
+    """
+    counter = iter(range(1, 100000))
+    sql = re.sub(r"%s", lambda match: f"?{next(counter)}", sql)
+
+    if re.match(r"\s*CREATE TABLE", sql):
+        return translate_create_table(sql)
+    index = re.match(r"\s*ALTER TABLE (\w+) ADD (UNIQUE )?(?:KEY|INDEX) (\w+) (\(.*\))\s*$", sql, re.S)
+    if index:
+        table, unique, name, columns = index.groups()
+        return (f"CREATE {unique or ''}INDEX IF NOT EXISTS {name} ON {table} {columns}",)
+
+    sql = re.sub(
+        r"^\s*UPDATE (\w+) (?:AS )?(\w+)\s+JOIN (\(.*\)|\w+) (?:AS )?(\w+) ON (.+?)\s+SET (.+?)(?:\s+WHERE (.+?))?\s*$",
+        translate_update_join, sql, flags=re.S
+    )
+    duplicate = re.search(r"\bON DUPLICATE KEY UPDATE\b", sql)
+    if duplicate:
+        updates = re.sub(r"\bVALUES\((\w+)\)", r"excluded.\1", sql[duplicate.end():])
+        sql = f"{sql[:duplicate.start()]}ON CONFLICT DO UPDATE SET{updates}"
+    sql = re.sub(r"\bDATEDIFF\(([\w.]+(?:\(\))?), ([\w.]+(?:\(\))?)\)", r"CAST(julianday(\1) - julianday(\2) AS INTEGER)", sql)
+    sql = re.sub(r"([\w.]+(?:\(\))?) ([+-]) INTERVAL (\S+) (DAY|WEEK)\b",
+                 lambda m: f"date({m.group(1)}, '{m.group(2)}' || ({m.group(3)}{' * 7' if m.group(4) == 'WEEK' else ''}) || ' days')",
+                 sql)
+    sql = re.sub(r"\bCURDATE\(\)", "date('now', 'localtime')", sql)
+    sql = re.sub(r"\bNOW\(\)", "datetime('now', 'localtime')", sql)
+    sql = re.sub(r"\bIF\(", "iif(", sql)
+    sql = re.sub(r"\s+(?:FOR UPDATE|LOCK IN SHARE MODE)\b", "", sql)
+    return (sql,)
+
+def database_error(error):
+    # Raise the mysql.connector types the app already catches
+    if isinstance(error, sqlite3.IntegrityError):
+        return mysql.connector.IntegrityError(msg=str(error))
+    return mysql.connector.DatabaseError(msg=str(error))
+
+class SqliteCursor:
+    """mysql-connector style cursor over sqlite3: %s placeholders, dictionary rows."""
+
+    def __init__(self, cursor, dictionary=False):
+        self._cursor = cursor
+        self.dictionary = dictionary
+
+    def _rows(self, rows):
+        if not self.dictionary or self._cursor.description is None:
+            return rows
+        columns = [column[0] for column in self._cursor.description]
+        return [dict(zip(columns, row)) for row in rows]
+
+    def execute(self, operation, params=()):
+        try:
+            for statement in translate(operation):
+                self._cursor.execute(statement, tuple(params or ()))
+        except sqlite3.Error as e:
+            raise database_error(e) from e
+
+    def executemany(self, operation, seq_params):
+        try:
+            for statement in translate(operation):
+                self._cursor.executemany(statement, [tuple(params) for params in seq_params])
+        except sqlite3.Error as e:
+            raise database_error(e) from e
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        return row if row is None else self._rows([row])[0]
+
+    def fetchmany(self, size=1):
+        return self._rows(self._cursor.fetchmany(size))
+
+    def fetchall(self):
+        return self._rows(self._cursor.fetchall())
+
+    def __iter__(self):
+        return iter(self.fetchone, None)
+
+    @property
+    def with_rows(self):
+        return self._cursor.description is not None
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def close(self):
+        self._cursor.close()
+
+class SqliteConnection:
+    """Borrowed connection with the subset of the mysql-connector API the app uses."""
+
+    def __init__(self, raw, database):
+        self._raw = raw
+        self._database = database
+
+    def cursor(self, dictionary=False, **options):
+        # buffered and other MySQL cursor options do not apply
+        return SqliteCursor(self._raw.cursor(), dictionary)
+
+    def commit(self):
+        try:
+            self._raw.commit()
+        except sqlite3.Error as e:
+            raise database_error(e) from e
+
+    def rollback(self):
+        self._raw.rollback()
+
+    def ping(self, **options):
+        pass
+
+    @property
+    def in_transaction(self):
+        return self._raw.in_transaction
+
+    def close(self):
+        if self._raw is not None:
+            self._database.release(self._raw)
+            self._raw = None
+
+class SqliteDatabase:
+    """A SQLite file in WAL mode, handing out connections like the MySQL pool.
+
+    WAL lets readers carry on while one writer commits, and synchronous=NORMAL
+    only syncs at checkpoints, so small writes stay well under a millisecond.
+    """
+
+    def __init__(self, path, max_idle=MAX_IDLE_CONNECTIONS):
+        self.path = str(path)
+        self.max_idle = max_idle
+        self._idle = queue.LifoQueue()
+
+    def _open(self):
+        raw = sqlite3.connect(
+            self.path,
+            timeout=BUSY_TIMEOUT,
+            detect_types=sqlite3.PARSE_DECLTYPES | sqlite3.PARSE_COLNAMES,
+            # Connections are handed between Streamlit session threads, one at a time
+            check_same_thread=False
+        )
+        raw.execute("PRAGMA journal_mode = WAL")
+        raw.execute("PRAGMA synchronous = NORMAL")
+        raw.execute("PRAGMA foreign_keys = ON")
+        return raw
+
+    def get_connection(self):
+        try:
+            raw = self._idle.get_nowait()
+        except queue.Empty:
+            raw = self._open()
+        return SqliteConnection(raw, self)
+
+    def release(self, raw):
+        # Like pool_reset_session: nothing uncommitted survives a checkout
+        raw.rollback()
+        if self._idle.qsize() < self.max_idle:
+            self._idle.put(raw)
+        else:
+            raw.close()
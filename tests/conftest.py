@@ -0,0 +1,47 @@
+"""Run the suite on the SQLite stand-in, in a scratch directory: python -m pytest"""
+import itertools
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+
+# Must be set before db_utils is imported: it reads the backend and paths once
+SCRATCH = Path(tempfile.mkdtemp(prefix="stocktake_tests_"))
+os.environ['DB_BACKEND'] = 'sqlite'
+os.environ['SQLITE_PATH'] = str(SCRATCH / "stocktake.db")
+os.environ['OFFLINE_STORE'] = str(SCRATCH / "ward_store.db")
+os.environ['ARCHIVE_DIR'] = str(SCRATCH / "archive")
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import db_utils
+from db_utils import db_cursor, create_tables, run_migrations, create_stocktake_table
+
+DRUG_COUNT = 20
+_codes = itertools.count(1)
+
+@pytest.fixture(scope="session", autouse=True)
+def database():
+    with db_cursor() as (conn, cursor):
+        create_tables(cursor)
+        conn.commit()
+    run_migrations()
+    with db_cursor() as (conn, cursor):
+        cursor.executemany(
+            "INSERT INTO drugs (drug_name, department) VALUES (%s, %s)",
+            [(f"Test Drug {i:02d}", "ER") for i in range(DRUG_COUNT)]
+        )
+        conn.commit()
+
+@pytest.fixture(autouse=True)
+def no_background_compactor(monkeypatch):
+    # Tests fold events in themselves, so results do not depend on thread timing
+    monkeypatch.setattr(db_utils, "BACKGROUND_COMPACTION", False)
+
+@pytest.fixture
+def table():
+    """A fresh ER stocktake table with a record per drug; yields (table_id, access_code)."""
+    code = f"TEST{next(_codes):04d}"
+    table_id, _, _ = create_stocktake_table(f"Test table {code}", "ER", code, "tests")
+    return table_id, code
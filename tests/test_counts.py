@@ -0,0 +1,97 @@
+from datetime import date
+
+from db_utils import (
+    CONFLICT_REASON, db_cursor, get_table_records, update_stocktake_records, compact_events,
+    compaction_status, get_record_history, get_changed_records
+)
+
+def stored(table_id, record_id):
+    return next(r for r in get_changed_records(table_id) if r.id == record_id)
+
+def test_save_appends_and_compaction_applies(table):
+    table_id, _ = table
+    record = get_table_records(table_id)[0]
+    updated, failed = update_stocktake_records(
+        table_id, [{"id": record["id"], "packs": 5, "singles": 2, "expiry_date": "2030-01-31"}], updated_by="ann"
+    )
+    assert (updated, failed) == ([record["id"]], {})
+    assert compaction_status()["pending"] >= 1
+    assert stored(table_id, record["id"]).packs == record["packs"]
+
+    assert compact_events() >= 1
+    row = stored(table_id, record["id"])
+    assert (row.packs, row.singles, row.expiry_date, row.updated_by) == (5, 2, date(2030, 1, 31), "ann")
+    assert compaction_status()["pending"] == 0
+    assert [event["compacted"] for event in get_record_history(record["id"])] == [1]
+
+def test_left_out_fields_keep_pending_values(table):
+    table_id, _ = table
+    record = get_table_records(table_id)[0]
+    update_stocktake_records(table_id, [{"id": record["id"], "packs": 3, "singles": 4, "expiry_date": None}])
+    update_stocktake_records(table_id, [{"id": record["id"], "packs": 9}])
+    compact_events()
+    row = stored(table_id, record["id"])
+    assert (row.packs, row.singles) == (9, 4)
+
+def test_late_event_is_still_compacted(table):
+    table_id, _ = table
+    first, second = get_table_records(table_id)[:2]
+    update_stocktake_records(table_id, [{"id": first["id"], "packs": 1, "singles": 0, "expiry_date": None}])
+    update_stocktake_records(table_id, [{"id": second["id"], "packs": 2, "singles": 0, "expiry_date": None}])
+    with db_cursor() as (conn, cursor):
+        # Fold only the newer event, as if the older one had not committed yet
+        cursor.execute("SELECT MAX(id) AS id FROM count_events")
+        newest = cursor.fetchone()["id"]
+        cursor.execute("UPDATE count_events SET compacted_at = NOW() WHERE id = %s", (newest,))
+        conn.commit()
+    compact_events()
+    assert stored(table_id, first["id"]).packs == 1
+
+def test_stale_save_from_another_session_conflicts(table):
+    table_id, _ = table
+    record = get_table_records(table_id)[0]
+    seen = record["last_updated"]
+    update_stocktake_records(table_id, [{"id": record["id"], "packs": 7, "singles": 0, "last_updated": seen}],
+                             updated_by="ER", session_id="a" * 32)
+    # Pending and compacted changes both count
+    _, failed = update_stocktake_records(table_id, [{"id": record["id"], "packs": 3, "singles": 0, "last_updated": seen}],
+                                         updated_by="ER", session_id="b" * 32)
+    assert failed == {record["id"]: CONFLICT_REASON}
+    compact_events()
+    _, failed = update_stocktake_records(table_id, [{"id": record["id"], "packs": 3, "singles": 0, "last_updated": seen}],
+                                         updated_by="ER", session_id="b" * 32)
+    assert failed == {record["id"]: CONFLICT_REASON}
+    compact_events()
+    assert stored(table_id, record["id"]).packs == 7
+
+def test_stale_save_from_same_session_is_not_a_conflict(table):
+    table_id, _ = table
+    record = get_table_records(table_id)[0]
+    seen = record["last_updated"]
+    for packs in (1, 2):
+        updated, failed = update_stocktake_records(
+            table_id, [{"id": record["id"], "packs": packs, "singles": 0, "last_updated": seen}],
+            updated_by="ER", session_id="a" * 32
+        )
+        assert (updated, failed) == ([record["id"]], {})
+        compact_events()
+    assert stored(table_id, record["id"]).packs == 2
+
+def test_save_without_session_gets_no_exemption(table):
+    table_id, _ = table
+    record = get_table_records(table_id)[0]
+    seen = record["last_updated"]
+    update_stocktake_records(table_id, [{"id": record["id"], "packs": 1, "singles": 0, "last_updated": seen}], updated_by="ER")
+    compact_events()
+    _, failed = update_stocktake_records(table_id, [{"id": record["id"], "packs": 2, "singles": 0, "last_updated": seen}],
+                                         updated_by="ER")
+    assert failed == {record["id"]: CONFLICT_REASON}
+
+def test_closed_table_refuses_saves(table):
+    table_id, _ = table
+    record = get_table_records(table_id)[0]
+    with db_cursor() as (conn, cursor):
+        cursor.execute("UPDATE stocktake_tables SET is_active = FALSE WHERE id = %s", (table_id,))
+        conn.commit()
+    updated, failed = update_stocktake_records(table_id, [{"id": record["id"], "packs": 1, "singles": 0}])
+    assert updated == [] and record["id"] in failed
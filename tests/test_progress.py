@@ -0,0 +1,58 @@
+from archive_utils import archive_table, get_archive
+from db_utils import db_cursor, fetch_all, get_table_records, update_stocktake_records, compact_events, refresh_table_progress
+from report_utils import department_report, department_series
+
+PROGRESS_COLUMNS = "line_count, touched_lines, total_packs, total_singles, last_activity_at, last_activity_by"
+
+def progress(cursor, table_id):
+    cursor.execute(f"SELECT {PROGRESS_COLUMNS} FROM table_progress WHERE table_id = %s", (table_id,))
+    return cursor.fetchone()
+
+def test_deltas_match_a_full_rebuild(table):
+    table_id, _ = table
+    records = get_table_records(table_id)
+    update_stocktake_records(table_id, [
+        {"id": record["id"], "packs": i, "singles": i % 3, "expiry_date": None} for i, record in enumerate(records[:8])
+    ], updated_by="ann")
+    compact_events()
+    # Recount some lines, including down to zero, as someone else
+    update_stocktake_records(table_id, [
+        {"id": record["id"], "packs": 0, "singles": 0, "expiry_date": None} for record in records[2:5]
+    ] + [{"id": records[10]["id"], "packs": 4, "singles": 1, "expiry_date": None}], updated_by="bob")
+    compact_events()
+
+    with db_cursor() as (conn, cursor):
+        maintained = progress(cursor, table_id)
+        refresh_table_progress(cursor, [table_id])
+        rebuilt = progress(cursor, table_id)
+        conn.rollback()
+    assert maintained == rebuilt
+    assert maintained["touched_lines"] == 9
+    assert maintained["last_activity_by"] == "bob"
+
+def test_new_table_starts_empty(table):
+    table_id, _ = table
+    with db_cursor() as (conn, cursor):
+        row = progress(cursor, table_id)
+    assert row["line_count"] == len(get_table_records(table_id))
+    assert (row["touched_lines"], row["total_packs"], row["last_activity_at"]) == (0, 0, None)
+
+def test_zero_counts_are_counted_everywhere(table):
+    table_id, _ = table
+    records = get_table_records(table_id)
+    update_stocktake_records(table_id, [
+        {"id": record["id"], "packs": 0, "singles": 0, "expiry_date": None} for record in records[:2]
+    ] + [{"id": records[2]["id"], "packs": 5, "singles": 0, "expiry_date": None}], updated_by="ann")
+    compact_events()
+    details = fetch_all("SELECT id, table_name, department, created_at FROM stocktake_tables WHERE id = %s", (table_id,))
+
+    with db_cursor() as (conn, cursor):
+        assert progress(cursor, table_id)["touched_lines"] == 3
+    summary, _ = department_report(details)
+    assert summary.iloc[0]["counted_lines"] == 3
+    assert department_series([table_id]).iloc[0]["counted_lines"] == 3
+
+    archive_table(table_id, "tests")
+    assert get_archive(table_id)["counted_lines"] == 3
+    summary, _ = department_report(details)
+    assert summary.iloc[0]["counted_lines"] == 3
@@ -0,0 +1,35 @@
+from search_utils import DrugIndex, EXACT, PREFIX, WORD_PREFIX, SUBSTRING, FUZZY
+
+NAMES = [
+    "Amoxicillin 500mg Capsules", "Amoxicillin 250mg Capsules", "Amoxil Syrup", "Co-Amoxiclav 625mg Tablets",
+    "Cefalexin 500mg Capsules", "Ceftriaxone 1g Injection", "Paracetamol 500mg Tablets", "Amox",
+]
+INDEX = DrugIndex([
+    {"id": drug_id, "drug_name": name, "department": "ER" if drug_id % 2 else "LAB"}
+    for drug_id, name in enumerate(NAMES, 1)
+])
+
+def names(results):
+    return [NAMES[drug_id - 1] for drug_id, rank, score in results]
+
+def test_ranks_exact_prefix_word_substring():
+    results = INDEX.search("amox")
+    assert [rank for _, rank, _ in results] == [EXACT, PREFIX, PREFIX, PREFIX, WORD_PREFIX]
+    assert names(results)[:4] == ["Amox", "Amoxicillin 250mg Capsules", "Amoxicillin 500mg Capsules", "Amoxil Syrup"]
+    assert [rank for _, rank, _ in INDEX.search("moxicil")] == [SUBSTRING, SUBSTRING]
+
+def test_multi_word_query_matches_adjacent_words():
+    assert names(INDEX.search("500mg caps"))[:2] == ["Amoxicillin 500mg Capsules", "Cefalexin 500mg Capsules"]
+    assert all(rank < FUZZY for _, rank, _ in INDEX.search("500mg caps")[:2])
+
+def test_limit_keeps_best_in_name_order():
+    assert names(INDEX.search("capsules", limit=2)) == ["Amoxicillin 250mg Capsules", "Amoxicillin 500mg Capsules"]
+
+def test_filters_apply_before_the_limit():
+    assert names(INDEX.search("amox", limit=1, drug_ids={4})) == ["Co-Amoxiclav 625mg Tablets"]
+    assert all(drug_id % 2 for drug_id, _, _ in INDEX.search("500mg", department="ER"))
+
+def test_fuzzy_finds_misspellings():
+    results = INDEX.search("amoxcilin")
+    assert results[0][1] == FUZZY
+    assert names(results)[0].startswith("Amoxicillin")
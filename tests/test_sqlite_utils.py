@@ -0,0 +1,75 @@
+from datetime import date, timedelta
+
+import pytest
+
+from sqlite_utils import SqliteDatabase, translate
+
+@pytest.fixture
+def cursor(tmp_path):
+    conn = SqliteDatabase(tmp_path / "translate.db").get_connection()
+    cursor = conn.cursor(dictionary=True)
+    cursor.execute('''
+    CREATE TABLE items (
+        id INT AUTO_INCREMENT PRIMARY KEY,
+        name VARCHAR(50) UNIQUE NOT NULL,
+        qty INT NOT NULL DEFAULT 0,
+        due DATE,
+        INDEX idx_items_due (due)
+    )
+    ''')
+    cursor.executemany("INSERT INTO items (name, qty, due) VALUES (%s, %s, %s)",
+                       [("a", 1, date(2030, 1, 1)), ("b", 2, None)])
+    yield cursor
+    conn.close()
+
+def test_create_table_moves_inline_indexes_out():
+    statements = translate("CREATE TABLE t (id INT AUTO_INCREMENT PRIMARY KEY, x INT, INDEX idx_t_x (x))")
+    assert statements[0] == "CREATE TABLE t (id INTEGER PRIMARY KEY AUTOINCREMENT, x INT)"
+    assert statements[1] == "CREATE INDEX IF NOT EXISTS idx_t_x ON t (x)"
+
+def test_varchar_compares_case_insensitively(cursor):
+    cursor.execute("SELECT qty FROM items WHERE name = %s", ("A",))
+    assert cursor.fetchone()["qty"] == 1
+
+def test_update_join_derived_table(cursor):
+    cursor.execute('''
+        UPDATE items i
+        JOIN (SELECT %s AS name, %s AS qty UNION ALL SELECT %s, %s) AS u ON i.name = u.name
+        SET i.qty = u.qty
+        WHERE i.qty < %s
+    ''', ("a", 10, "b", 20, 2))
+    cursor.execute("SELECT name, qty FROM items ORDER BY name")
+    # b already had qty 2, so the WHERE keeps it out
+    assert [(row["name"], row["qty"]) for row in cursor.fetchall()] == [("a", 10), ("b", 2)]
+
+def test_on_duplicate_key_update(cursor):
+    cursor.executemany(
+        "INSERT INTO items (name, qty) VALUES (%s, %s) ON DUPLICATE KEY UPDATE qty = qty + VALUES(qty)",
+        [("a", 5), ("c", 3)]
+    )
+    cursor.execute("SELECT name, qty FROM items ORDER BY name")
+    assert [(row["name"], row["qty"]) for row in cursor.fetchall()] == [("a", 6), ("b", 2), ("c", 3)]
+
+def test_interval_arithmetic(cursor):
+    cursor.execute("SELECT CURDATE() + INTERVAL %s DAY AS later, CURDATE() - INTERVAL 2 WEEK AS earlier", (3,))
+    row = cursor.fetchone()
+    assert date.fromisoformat(row["later"]) == date.today() + timedelta(days=3)
+    assert date.fromisoformat(row["earlier"]) == date.today() - timedelta(days=14)
+
+def test_interval_in_where(cursor):
+    cursor.execute("UPDATE items SET due = CURDATE() + INTERVAL 5 DAY WHERE name = 'b'")
+    cursor.execute("SELECT name FROM items WHERE due <= CURDATE() + INTERVAL %s DAY", (7,))
+    assert [row["name"] for row in cursor.fetchall()] == ["b"]
+
+def test_datediff(cursor):
+    cursor.execute("SELECT DATEDIFF(due, CURDATE()) AS days FROM items WHERE name = 'a'")
+    assert cursor.fetchone()["days"] == (date(2030, 1, 1) - date.today()).days
+
+def test_locking_clauses_are_dropped(cursor):
+    assert translate("SELECT id FROM items WHERE id = %s FOR UPDATE") == ("SELECT id FROM items WHERE id = ?1",)
+    cursor.execute("SELECT qty FROM items WHERE name = %s LOCK IN SHARE MODE", ("b",))
+    assert cursor.fetchone()["qty"] == 2
+
+def test_dates_read_back_as_dates(cursor):
+    cursor.execute("SELECT due FROM items WHERE name = 'a'")
+    assert cursor.fetchone()["due"] == date(2030, 1, 1)
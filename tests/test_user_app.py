@@ -0,0 +1,104 @@
+from pathlib import Path
+
+from streamlit.testing.v1 import AppTest
+
+import db_utils
+from db_utils import get_table_records, get_changed_records, compact_events, invalidate_cache, DATABASE_ERROR_REASON
+
+APP = str(Path(__file__).resolve().parent.parent / "user_app.py")
+
+def open_table(access_code, counter_name=""):
+    at = AppTest.from_file(APP, default_timeout=30).run()
+    at.sidebar.selectbox[0].set_value("ER")
+    at.sidebar.text_input[0].set_value(access_code)
+    at.sidebar.text_input[1].set_value(counter_name)
+    at.sidebar.button[0].click().run()
+    at.sidebar.radio[0].set_value("Stocktake").run()
+    return at
+
+def show(at, record):
+    at.text_input[0].set_value(record["drug_name"]).run()
+
+def count(at, record, packs):
+    at.number_input(key=f"packs_{record['id']}").set_value(packs)
+    at.button(key=f"update_{record['id']}").click().run()
+    # Let auto-save flush on the next run; AppTest cannot rerun the fragment alone
+    at.session_state["pending_since"] = 0
+    at.run()
+    assert not at.exception
+
+def test_unnamed_counters_do_not_overwrite_each_other(table):
+    table_id, code = table
+    record = get_table_records(table_id)[0]
+    first, second = open_table(code), open_table(code)
+    # Both have the line on screen before either saves
+    show(first, record)
+    show(second, record)
+    count(second, record, 7)
+    compact_events()
+    invalidate_cache()
+    count(first, record, 3)
+
+    assert record["id"] in first.session_state["conflicts"]
+    assert first.session_state["flush_report"]["updated"] == 0
+    compact_events()
+    assert next(r for r in get_changed_records(table_id) if r.id == record["id"]).packs == 7
+
+def test_counter_can_recount_own_line(table):
+    table_id, code = table
+    record = get_table_records(table_id)[0]
+    at = open_table(code)
+    show(at, record)
+    count(at, record, 2)
+    compact_events()
+    invalidate_cache()
+    count(at, record, 5)
+
+    assert at.session_state["conflicts"] == {}
+    compact_events()
+    assert next(r for r in get_changed_records(table_id) if r.id == record["id"]).packs == 5
+
+def others_notice(at):
+    return [caption.value for caption in at.caption if "updated by others" in caption.value]
+
+def test_changes_by_same_named_colleague_are_flagged(table):
+    table_id, code = table
+    record = get_table_records(table_id)[0]
+    first, second = open_table(code, "Sam"), open_table(code, "Sam")
+    count(second, record, 4)
+    compact_events()
+    invalidate_cache()
+    first.run()
+    assert others_notice(first) == ["🔄 1 row(s) updated by others since your last refresh"]
+    assert first.session_state["snapshot"]["others_changed"] == [record["id"]]
+
+def test_own_saves_are_not_flagged(table):
+    table_id, code = table
+    record = get_table_records(table_id)[0]
+    at = open_table(code)
+    show(at, record)
+    count(at, record, 6)
+    compact_events()
+    invalidate_cache()
+    at.run()
+    assert others_notice(at) == []
+
+def test_database_error_keeps_counts_queued(table, monkeypatch):
+    table_id, code = table
+    record = get_table_records(table_id)[0]
+    at = open_table(code)
+    show(at, record)
+    with monkeypatch.context() as patched:
+        patched.setattr(db_utils, "update_stocktake_records", lambda table_id, rows, **options: (
+            [], {int(row["id"]): f"{DATABASE_ERROR_REASON}: Lost connection" for row in rows}
+        ))
+        count(at, record, 8)
+    assert list(at.session_state["pending_updates"]) == [record["id"]]
+    assert at.session_state["flush_report"]["failed"] == []
+    assert any("still queued" in warning.value for warning in at.warning)
+
+    at.session_state["pending_since"] = 0
+    at.run()
+    assert at.session_state["pending_updates"] == {}
+    compact_events()
+    assert next(r for r in get_changed_records(table_id) if r.id == record["id"]).packs == 8
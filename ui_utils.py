@@ -0,0 +1,61 @@
+import streamlit as st
+from upload_utils import read_count_sheet, apply_count_upload
+
+PAGE_SIZES = [25, 50, 100, 250, 500]
+
+def page_size_selector(key, default=50, label="Rows per page"):
+    return st.selectbox(label, PAGE_SIZES, index=PAGE_SIZES.index(default), key=f"{key}_page_size")
+
+def keyset_pager(key, fetch, cursor_of, page_size):
+    """Render Previous/Next controls for keyset pagination and return the current page.
+
+    fetch(cursor, limit) loads rows after cursor (None for the first page);
+    cursor_of(row) gives the seek key of a row. One extra row is requested
+    to tell whether a next page exists. The cursor stack lives in session
+    state under key, so include anything that changes the result set (table
+    id, filters, page size) in key.
+    """
+    state_key = f"{key}_cursors"
+    if state_key not in st.session_state:
+        st.session_state[state_key] = [None]
+    cursors = st.session_state[state_key]
+
+    rows = fetch(cursors[-1], page_size + 1)
+    has_more = len(rows) > page_size
+    rows = rows[:page_size]
+
+    if len(cursors) > 1 or has_more:
+        col1, col2, col3 = st.columns([1, 1, 4])
+        with col1:
+            if st.button("◀ Previous", key=f"{key}_previous", disabled=len(cursors) == 1):
+                cursors.pop()
+                st.rerun()
+        with col2:
+            if st.button("Next ▶", key=f"{key}_next", disabled=not has_more):
+                cursors.append(cursor_of(rows[-1]))
+                st.rerun()
+        with col3:
+            st.caption(f"Page {len(cursors)}")
+    return rows
+
+def count_upload_form(table_id, updated_by, key):
+    """Upload a CSV/XLSX of counts into a stocktake table and show the report."""
+    st.caption("Columns: Drug Name, Packs, Singles, Expiry (YYYY-MM-DD or DD/MM/YYYY). Blank counts are read as 0; columns left out keep their stored values.")
+    uploaded = st.file_uploader("Count sheet", type=["csv", "xlsx"], key=f"{key}_file")
+    if uploaded is None:
+        return
+    
+    try:
+        sheet = read_count_sheet(uploaded)
+    except ValueError as e:
+        st.error(str(e))
+        return
+    st.write(f"{len(sheet)} rows read from {uploaded.name}")
+    
+    if st.button("Apply counts", key=f"{key}_apply", type="primary"):
+        with st.spinner("Applying counts..."):
+            result = apply_count_upload(sheet, table_id, updated_by)
+        st.success(f"Updated {result['updated']} of {result['rows']} rows in {result['seconds']:.2f}s")
+        if len(result["problems"]):
+            st.warning(f"{len(result['problems'])} row(s) were not applied")
+            st.dataframe(result["problems"], hide_index=True)
@@ -0,0 +1,130 @@
+import time
+from pathlib import Path
+import pandas as pd
+from db_utils import get_table_records, update_stocktake_records
+
+# Accepted headers for each field, compared case-insensitively
+COLUMN_ALIASES = {
+    "drug_name": ["drug name", "drug_name", "drug", "name"],
+    "packs": ["packs", "pack"],
+    "singles": ["singles", "single", "units"],
+    "expiry_date": ["expiry", "expiry date", "expiry_date", "exp"],
+}
+COUNT_FIELDS = ["packs", "singles", "expiry_date"]
+
+def normalized_names(names):
+    return (
+        names.astype(str).str.lower()
+        .str.replace(r"[^a-z0-9]+", " ", regex=True)
+        .str.strip()
+    )
+
+def parse_dates(values):
+    # ISO dates (and Excel cells read as text) first, then day-first local formats
+    parsed = pd.to_datetime(values, errors="coerce", format="ISO8601")
+    remaining = parsed.isna() & values.notna()
+    parsed[remaining] = pd.to_datetime(values[remaining], errors="coerce", format="mixed", dayfirst=True)
+    return parsed
+
+def read_count_sheet(uploaded_file, file_name=None):
+    """Load an uploaded CSV/XLSX into a DataFrame with drug_name, packs, singles, expiry_date.
+
+    Count columns missing from the sheet are left out of the frame, so the
+    stored values for those fields are kept.
+    """
+    file_name = file_name or getattr(uploaded_file, "name", "")
+    if Path(file_name).suffix.lower() == ".csv":
+        df = pd.read_csv(uploaded_file, dtype=str, keep_default_na=False)
+    else:
+        df = pd.read_excel(uploaded_file, dtype=str, keep_default_na=False)
+
+    headers = {str(column).strip().lower(): column for column in df.columns}
+    columns = {}
+    for field, aliases in COLUMN_ALIASES.items():
+        match = next((headers[alias] for alias in aliases if alias in headers), None)
+        if match is None and field == "drug_name":
+            raise ValueError("The sheet needs a drug name column (e.g. 'Drug Name')")
+        columns[field] = match
+
+    sheet = pd.DataFrame({field: df[column] for field, column in columns.items() if column is not None})
+    # Spreadsheet row numbers (header is row 1) for the report
+    sheet.index = pd.RangeIndex(2, len(sheet) + 2, name="row")
+    return sheet
+
+def match_counts(sheet, table_id):
+    """Match sheet rows to the table's records and validate the counts.
+
+    Names are matched exactly first, then on a normalized form (case,
+    punctuation and spacing ignored), each as one DataFrame merge.
+    Returns (updates DataFrame, problems DataFrame).
+    """
+    records = pd.DataFrame(get_table_records(table_id), columns=["id", "drug_id", "drug_name"])[["id", "drug_name"]]
+    sheet = sheet.copy()
+    sheet["drug_name"] = sheet["drug_name"].astype(str).str.strip()
+    sheet = sheet[sheet["drug_name"] != ""]
+    sheet["row"] = sheet.index
+
+    exact = sheet.merge(records, on="drug_name", how="left")
+
+    # Names that normalize to the same key in the catalog are ambiguous, so drop them
+    records["key"] = normalized_names(records["drug_name"])
+    by_key = records.drop_duplicates("key", keep=False)[["key", "id"]]
+    unmatched = exact["id"].isna()
+    fallback = exact.loc[unmatched, ["row"]].assign(key=normalized_names(exact.loc[unmatched, "drug_name"]))
+    fallback = fallback.merge(by_key, on="key", how="left").set_index("row")["id"]
+    exact = exact.set_index("row")
+    exact.loc[fallback.index, "id"] = fallback
+
+    # Blank cells count as 0; a missing column is validated as blank but never written
+    blank = pd.Series("", index=exact.index)
+    packs = pd.to_numeric(exact.get("packs", blank).replace("", "0"), errors="coerce")
+    singles = pd.to_numeric(exact.get("singles", blank).replace("", "0"), errors="coerce")
+    expiry_text = exact.get("expiry_date", blank).astype(str).str.strip()
+    expiry = parse_dates(expiry_text.where(expiry_text != ""))
+
+    problems = pd.Series("", index=exact.index)
+    problems[exact["id"].isna()] = "Drug not found in this table"
+    bad_count = packs.isna() | singles.isna() | (packs < 0) | (singles < 0) | (packs % 1 != 0) | (singles % 1 != 0)
+    problems[(problems == "") & bad_count] = "Packs and singles must be whole numbers of 0 or more"
+    problems[(problems == "") & expiry.isna() & (expiry_text != "")] = "Expiry date not recognised"
+    duplicated = exact["id"].duplicated(keep="last") & exact["id"].notna()
+    problems[(problems == "") & duplicated] = "Drug listed again further down; later row used"
+
+    valid = problems == ""
+    updates = pd.DataFrame({
+        "id": exact.loc[valid, "id"].astype(int),
+        "drug_name": exact.loc[valid, "drug_name"],
+        "packs": packs[valid].astype(int),
+        "singles": singles[valid].astype(int),
+        "expiry_date": expiry[valid].dt.date.where(expiry[valid].notna(), None),
+    })[["id", "drug_name", *(field for field in COUNT_FIELDS if field in sheet)]]
+    report = exact.loc[~valid].reindex(columns=["drug_name", *COUNT_FIELDS]).assign(problem=problems[~valid])
+    return updates, report.reset_index()
+
+def apply_count_upload(sheet, table_id, updated_by=None):
+    """Match and write an uploaded count sheet in one transaction; returns a summary dict."""
+    started = time.perf_counter()
+    updates, report = match_counts(sheet, table_id)
+    # Only the fields the sheet has are sent; update_stocktake_records keeps the rest
+    rows = []
+    for row in updates.to_dict("records"):
+        values = {"id": int(row["id"])}
+        for field in ("packs", "singles"):
+            if field in row:
+                values[field] = int(row[field])
+        if "expiry_date" in row:
+            values["expiry_date"] = None if pd.isna(row["expiry_date"]) else row["expiry_date"]
+        rows.append(values)
+    updated, failed = update_stocktake_records(table_id, rows, updated_by=updated_by)
+    if failed:
+        names = dict(zip(updates["id"], updates["drug_name"]))
+        report = pd.concat([report, pd.DataFrame([
+            {"drug_name": names.get(record_id, record_id), "problem": reason}
+            for record_id, reason in failed.items()
+        ])], ignore_index=True)
+    return {
+        "rows": len(sheet),
+        "updated": len(updated),
+        "problems": report,
+        "seconds": time.perf_counter() - started
+    }
@@ -1,186 +1,536 @@
-import streamlit as st
-from db_utils import get_db_connection
-import pandas as pd
-from datetime import datetime
-import time
-
-# Page configuration
-st.set_page_config(
-    page_title="Hospital Stocktake - User",
-    page_icon="🏥",
-    layout="wide",
-    initial_sidebar_state="expanded"
-)
-
-DEPARTMENTS = [
-    "ER", "ADMISSION", "MARTENITY", "THEATRE", 
-    "LAB", "RADIOLOGY", "DENTIST"
-]
-
-def home_page():
-    st.title("🏥 Hospital Stocktake System")
-    st.markdown("### Welcome to the Stocktake Portal")
-    if st.session_state.authenticated:
-        st.info(f"Currently working in: {st.session_state.department}")
-
-def stocktake_page():
-    if not st.session_state.authenticated:
-        st.warning("Please select a department first")
-        return
-    
-    st.title("📝 Stocktake Entry")
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    
-    search_term = st.text_input("Search Drugs")
-    
-    cursor.execute('''
-        SELECT sr.id, d.drug_name, sr.packs, sr.singles, sr.expiry_date
-        FROM stocktake_records sr
-        JOIN drugs d ON sr.drug_id = d.id
-        WHERE sr.table_id = %s
-        ORDER BY d.drug_name
-    ''', (st.session_state.current_table_id,))
-    records = cursor.fetchall()
-    
-    if search_term:
-        records = [r for r in records if search_term.lower() in r["drug_name"].lower()]
-    
-    if not records:
-        st.info("No drugs found")
-    else:
-        for record in records:
-            cols = st.columns([3, 1, 1, 1, 2])
-            with cols[0]:
-                st.markdown(f"**{record['drug_name']}**")
-            with cols[1]:
-                packs = st.number_input("Packs", min_value=0, value=record["packs"], key=f"packs_{record['id']}")
-            with cols[2]:
-                singles = st.number_input("Singles", min_value=0, value=record["singles"], key=f"singles_{record['id']}")
-            with cols[3]:
-                expiry = st.text_input("Expiry", value=record["expiry_date"] or "", key=f"expiry_{record['id']}")
-            with cols[4]:
-                if st.button("Update", key=f"update_{record['id']}"):
-                    cursor.execute('''
-                        UPDATE stocktake_records 
-                        SET packs = %s, singles = %s, expiry_date = %s, last_updated = %s
-                        WHERE id = %s
-                    ''', (packs, singles, expiry if expiry else None, datetime.now(), record["id"]))
-                    conn.commit()
-                    st.success("Updated!")
-                    time.sleep(1)
-                    st.rerun()
-    
-    cursor.close()
-    conn.close()
-
-def data_page():
-    if not st.session_state.authenticated:
-        st.warning("Please select a department first")
-        return
-    
-    st.title("📊 View Stocktake Data")
-    conn = get_db_connection()
-    cursor = conn.cursor(dictionary=True)
-    
-    cursor.execute(
-        "SELECT id, table_name, created_at FROM stocktake_tables WHERE department = %s ORDER BY created_at DESC",
-        (st.session_state.department,)
-    )
-    tables = cursor.fetchall()
-    
-    if tables:
-        table_options = {f"{t['table_name']} ({t['created_at']})": t['id'] for t in tables}
-        selected_table = st.selectbox("Select Table", list(table_options.keys()))
-        
-        if selected_table:
-            cursor.execute('''
-                SELECT d.drug_name, sr.packs, sr.singles, sr.expiry_date, sr.last_updated
-                FROM stocktake_records sr
-                JOIN drugs d ON sr.drug_id = d.id
-                WHERE sr.table_id = %s
-                ORDER BY d.drug_name
-            ''', (table_options[selected_table],))
-            records = cursor.fetchall()
-            
-            if records:
-                df = pd.DataFrame(records)
-                df["Last Updated"] = pd.to_datetime(df["last_updated"]).dt.strftime('%Y-%m-%d %H:%M')
-                st.dataframe(df.drop(columns=["last_updated"]), hide_index=True)
-            else:
-                st.info("No records found")
-    else:
-        st.info("No tables available")
-    
-    cursor.close()
-    conn.close()
-
-def about_page():
-    st.title("ℹ️ About")
-    st.markdown("""
-    ### Hospital Stocktake System
-    **Version:** 1.0  
-    **Developed by:** Corporate 24 Healthcare
-    """)
-
-def main():
-    if 'authenticated' not in st.session_state:
-        st.session_state.update({
-            'authenticated': False,
-            'department': None,
-            'current_table': None,
-            'current_table_id': None
-        })
-
-    st.sidebar.title("Stocktake System")
-    
-    if not st.session_state.authenticated:
-        department = st.sidebar.selectbox("Department", DEPARTMENTS)
-        access_code = st.sidebar.text_input("Access Code", type="password")
-        
-        if st.sidebar.button("Start Stocktake"):
-            conn = get_db_connection()
-            cursor = conn.cursor(dictionary=True)
-            cursor.execute(
-                "SELECT id, table_name, department FROM stocktake_tables WHERE access_code = %s",
-                (access_code,)
-            )
-            table = cursor.fetchone()
-            cursor.close()
-            conn.close()
-            
-            if table:
-                if table["department"] == department:
-                    st.session_state.update({
-                        'authenticated': True,
-                        'department': department,
-                        'current_table': table["table_name"],
-                        'current_table_id': table["id"]
-                    })
-                    st.sidebar.success(f"Access granted to {table['table_name']}")
-                    st.rerun()
-                else:
-                    st.sidebar.error("Code doesn't match department")
-            else:
-                st.sidebar.error("Invalid access code")
-    
-    if st.session_state.authenticated:
-        st.sidebar.success(f"Department: {st.session_state.department}")
-        st.sidebar.info(f"Table: {st.session_state.current_table}")
-        
-        if st.sidebar.button("Switch Department"):
-            st.session_state.authenticated = False
-            st.rerun()
-    
-    pages = {
-        "Home": home_page,
-        "Stocktake": stocktake_page,
-        "Data": data_page,
-        "About": about_page
-    }
-    
-    selected_page = st.sidebar.radio("Go to", list(pages.keys()))
-    pages[selected_page]()
-
-if __name__ == "__main__":
+import streamlit as st
+from db_utils import (
+    find_table_by_access_code, update_stocktake_records, get_stocktake_tables, get_changed_records,
+    get_table_records_page, table_cursor, record_cursor, EXPIRY_MIN, EXPIRY_MAX_YEARS, CONFLICT_REASON,
+    DATABASE_ERROR_REASON
+)
+from ui_utils import page_size_selector, keyset_pager, count_upload_form
+from search_utils import search_drugs
+from offline_utils import (
+    download_table, find_local_table, local_status, get_local_records, get_local_records_page,
+    search_local, save_local_counts, sync_table, get_conflicts, resolve_conflicts
+)
+from archive_utils import get_archived_records_page
+from catalog_utils import get_catalog, with_names
+from metrics_utils import metrics
+import pandas as pd
+import time
+import uuid
+import mysql.connector
+from datetime import date, timedelta
+
+# Page configuration
+st.set_page_config(
+    page_title="Hospital Stocktake - User",
+    page_icon="🏥",
+    layout="wide",
+    initial_sidebar_state="expanded"
+)
+metrics.app = "user"
+
+DEPARTMENTS = [
+    "ER", "ADMISSION", "MARTENITY", "THEATRE", 
+    "LAB", "RADIOLOGY", "DENTIST"
+]
+
+# Stocktake entry: pages longer than this open in the grid editor
+GRID_THRESHOLD = 50
+# Queued edits older than this are written when auto-save is on
+AUTO_SAVE_SECONDS = 30
+
+def home_page():
+    st.title("🏥 Hospital Stocktake System")
+    st.markdown("### Welcome to the Stocktake Portal")
+    if st.session_state.authenticated:
+        st.info(f"Currently working in: {st.session_state.department}")
+
+def stocktake_page():
+    if not st.session_state.authenticated:
+        st.warning("Please select a department first")
+        return
+    
+    st.title("📝 Stocktake Entry")
+    offline_panel()
+    pending_panel()
+    search_term = st.text_input("Search Drugs")
+    
+    page_size = page_size_selector("stocktake", 100)
+    table_id = st.session_state.current_table_id
+    offline = st.session_state.offline
+    
+    if offline:
+        if search_term:
+            matched_ids = search_local(table_id, search_term)
+            rank = {drug_id: position for position, drug_id in enumerate(matched_ids)}
+            records = sorted(get_local_records(table_id, matched_ids), key=lambda r: rank[r["drug_id"]])[:page_size]
+        else:
+            records = keyset_pager(
+                f"stocktake_{table_id}_{page_size}_offline",
+                lambda cursor, limit: get_local_records_page(table_id, limit, cursor),
+                record_cursor,
+                page_size
+            )
+    else:
+        snapshot = refresh_snapshot(table_id)
+        if snapshot["others_changed"]:
+            st.caption(f"🔄 {len(snapshot['others_changed'])} row(s) updated by others since your last refresh")
+        if search_term:
+            # Search runs against the shared name index, limited to this table's drugs
+            # before the result cap, then picks rows from the local copy
+            by_drug = snapshot["by_drug"]
+            records = [snapshot["records"][by_drug[drug_id]]
+                       for drug_id in search_drugs(search_term, limit=page_size, drug_ids=by_drug)]
+            records = with_names(records)
+        else:
+            records = keyset_pager(
+                f"stocktake_{table_id}_{page_size}",
+                lambda cursor, limit: snapshot_page(snapshot, cursor, limit),
+                lambda record: record["id"],
+                page_size
+            )
+    
+    if not records:
+        st.info("No drugs found")
+        return
+    
+    # Show queued edits in place of the stored values until they are flushed
+    pending = st.session_state.pending_updates
+    records = [{**r, **pending[r["id"]]} if r["id"] in pending else r for r in records]
+    
+    # Large tables default to the grid; the per-row form is kept for short lists
+    modes = ["Grid", "Per row"]
+    mode = st.radio("Entry mode", modes, index=0 if len(records) > GRID_THRESHOLD else 1, horizontal=True)
+    if mode == "Grid":
+        grid_editor(records)
+    else:
+        row_editor(records)
+
+def refresh_snapshot(table_id):
+    """Bring the session's copy of a table up to date and return it.
+
+    The first call loads every record; later calls fetch only rows whose
+    last_updated is at or after the newest one held, so a rerun costs in
+    proportion to what changed rather than to the table size. Records
+    are held as compact RecordRow tuples; names are added per page from
+    the shared catalog.
+    """
+    snapshot = st.session_state.snapshot
+    if snapshot is None or snapshot["table_id"] != table_id:
+        rows = get_changed_records(table_id)
+        snapshot = {"table_id": table_id, "records": {}, "order": [], "position": {}, "by_drug": {},
+                    "replaced": {}, "others_changed": []}
+        changed = rows
+    else:
+        rows = get_changed_records(table_id, snapshot["watermark"])
+        held = snapshot["records"]
+        changed = [r for r in rows if r.id not in held or r.last_updated != held[r.id].last_updated]
+        # Edits submitted in this run were made against the versions shown before
+        # it, so rows another session changed meanwhile keep their old version here.
+        # Counter names can be blank or shared, so sessions are compared instead.
+        me = st.session_state.session_id
+        snapshot["replaced"] = {
+            r.id: held[r.id].last_updated for r in changed if r.id in held and r.session_id != me
+        }
+        snapshot["others_changed"] = list(snapshot["replaced"])
+    
+    new_rows = [r for r in changed if r.id not in snapshot["records"]]
+    snapshot["records"].update((r.id, r) for r in changed)
+    if new_rows:
+        records = snapshot["records"]
+        catalog = get_catalog({r.drug_id for r in new_rows})
+        snapshot["order"] = sorted(records, key=lambda i: (catalog.name(records[i].drug_id).casefold(), i))
+        snapshot["position"] = {record_id: position for position, record_id in enumerate(snapshot["order"])}
+        snapshot["by_drug"] = {record.drug_id: record_id for record_id, record in records.items()}
+    if rows:
+        snapshot["watermark"] = max(r.last_updated for r in rows)
+    st.session_state.snapshot = snapshot
+    return snapshot
+
+def seen_version(record_id, last_updated):
+    # The last_updated the counter was looking at when they made an edit
+    snapshot = st.session_state.snapshot
+    return snapshot["replaced"].get(record_id, last_updated) if snapshot else last_updated
+
+def snapshot_page(snapshot, after_id, limit):
+    start = snapshot["position"][after_id] + 1 if after_id else 0
+    return with_names([snapshot["records"][record_id] for record_id in snapshot["order"][start:start + limit]])
+
+def grid_editor(records):
+    original = pd.DataFrame(records).set_index("id")
+    page_key = f"{st.session_state.current_table_id}_{records[0]['id']}_{len(records)}"
+    
+    # Cell edits stay in the browser until the form is submitted
+    with st.form(f"grid_form_{page_key}"):
+        edited = st.data_editor(
+            original,
+            column_order=["drug_name", "packs", "singles", "expiry_date"],
+            column_config={
+                "drug_name": st.column_config.TextColumn("Drug"),
+                "packs": st.column_config.NumberColumn("Packs", min_value=0, step=1),
+                "singles": st.column_config.NumberColumn("Singles", min_value=0, step=1),
+                "expiry_date": st.column_config.DateColumn(
+                    "Expiry", min_value=EXPIRY_MIN,
+                    max_value=date.today() + timedelta(days=365 * EXPIRY_MAX_YEARS)
+                )
+            },
+            disabled=["drug_name"],
+            hide_index=True,
+            width="stretch",
+            key=f"grid_{page_key}_{st.session_state.grid_revision}"
+        )
+        submitted = st.form_submit_button("Queue changes")
+    
+    if submitted:
+        changes = changed_rows(original, edited)
+        queue_updates(changes)
+        st.session_state.grid_revision += 1
+        st.rerun()
+
+def changed_rows(original, edited):
+    # Only rows whose editable cells differ from what was loaded are queued
+    columns = ["packs", "singles", "expiry_date"]
+    before, after = original[columns], edited[columns]
+    differs = (before != after) & ~(before.isna() & after.isna())
+    rows = []
+    for record_id, row in after[differs.any(axis=1)].iterrows():
+        rows.append({
+            "id": int(record_id),
+            "drug_name": edited.at[record_id, "drug_name"],
+            "packs": 0 if pd.isna(row["packs"]) else int(row["packs"]),
+            "singles": 0 if pd.isna(row["singles"]) else int(row["singles"]),
+            "expiry_date": None if pd.isna(row["expiry_date"]) else row["expiry_date"],
+            # The version the counter saw; the save is refused if it changed since
+            "last_updated": seen_version(int(record_id), original.at[record_id, "last_updated"].to_pydatetime())
+        })
+    return rows
+
+def row_editor(records):
+    for record in records:
+        cols = st.columns([3, 1, 1, 1, 2])
+        with cols[0]:
+            st.markdown(f"**{record['drug_name']}**")
+        with cols[1]:
+            packs = st.number_input("Packs", min_value=0, value=record["packs"], key=f"packs_{record['id']}")
+        with cols[2]:
+            singles = st.number_input("Singles", min_value=0, value=record["singles"], key=f"singles_{record['id']}")
+        with cols[3]:
+            expiry = st.date_input("Expiry", value=record["expiry_date"], min_value=EXPIRY_MIN,
+                                   max_value=date.today() + timedelta(days=365 * EXPIRY_MAX_YEARS),
+                                   key=f"expiry_{record['id']}")
+        with cols[4]:
+            if st.button("Update", key=f"update_{record['id']}"):
+                queue_updates([{
+                    "id": record["id"],
+                    "drug_name": record["drug_name"],
+                    "packs": packs,
+                    "singles": singles,
+                    "expiry_date": expiry,
+                    "last_updated": seen_version(record["id"], record["last_updated"])
+                }])
+                st.rerun()
+
+def queue_updates(rows):
+    # Later edits to the same record replace earlier ones, so each row is written once
+    if rows and not st.session_state.pending_updates:
+        st.session_state.pending_since = time.monotonic()
+    for row in rows:
+        st.session_state.pending_updates[row["id"]] = row
+    # Local writes are cheap, so offline edits are saved straight away
+    if st.session_state.offline:
+        flush_updates()
+
+def flush_updates():
+    pending = st.session_state.pending_updates
+    if not pending:
+        return
+    
+    save = save_local_counts if st.session_state.offline else update_stocktake_records
+    updated, failed = save(
+        st.session_state.current_table_id,
+        list(pending.values()),
+        updated_by=st.session_state.counter_name or st.session_state.department,
+        session_id=st.session_state.session_id
+    )
+    # Edits to rows someone else changed first are held back for the counter to decide
+    for record_id, reason in failed.items():
+        if reason == CONFLICT_REASON and record_id in pending:
+            st.session_state.conflicts[record_id] = pending[record_id]
+    # Rows the database could not take stay queued for the next flush
+    retry = {
+        record_id: pending[record_id] for record_id, reason in failed.items()
+        if reason.startswith(DATABASE_ERROR_REASON) and record_id in pending
+    }
+    st.session_state.flush_report = {
+        'updated': len(updated),
+        'failed': [
+            {"Drug": pending.get(record_id, {}).get("drug_name", record_id), "Error": reason}
+            for record_id, reason in failed.items() if reason != CONFLICT_REASON and record_id not in retry
+        ],
+        'retry': {"rows": len(retry), "error": failed[next(iter(retry))]} if retry else None,
+        'at': time.strftime('%H:%M:%S')
+    }
+    st.session_state.pending_updates = retry
+    st.session_state.pending_since = time.monotonic() if retry else None
+
+@st.fragment(run_every=AUTO_SAVE_SECONDS)
+def pending_panel():
+    pending = st.session_state.pending_updates
+    if (pending and st.session_state.auto_save
+            and time.monotonic() - st.session_state.pending_since >= AUTO_SAVE_SECONDS):
+        flush_updates()
+        pending = st.session_state.pending_updates
+    
+    col1, col2, col3 = st.columns([2, 1, 1])
+    with col1:
+        st.markdown(f"**{len(pending)}** unsaved change(s)")
+    with col2:
+        st.session_state.auto_save = st.toggle(
+            "Auto-save", value=st.session_state.auto_save,
+            help=f"Save queued changes every {AUTO_SAVE_SECONDS}s"
+        )
+    with col3:
+        if st.button("Save now", disabled=not pending, type="primary"):
+            flush_updates()
+            st.rerun(scope="fragment")
+    
+    report = st.session_state.flush_report
+    if report:
+        if report['updated']:
+            st.success(f"Saved {report['updated']} row(s) at {report['at']}")
+        if report['failed']:
+            st.error(f"{len(report['failed'])} row(s) were not saved")
+            st.dataframe(pd.DataFrame(report['failed']), hide_index=True)
+        if report['retry']:
+            st.warning(f"⚠️ {report['retry']['rows']} row(s) could not be saved and are still queued: "
+                       f"{report['retry']['error']}")
+
+    conflicts = st.session_state.conflicts
+    if conflicts:
+        st.warning(f"{len(conflicts)} row(s) were changed by someone else before your edit was saved")
+        held = (st.session_state.snapshot or {}).get("records", {})
+        saved = {record_id: held[record_id] for record_id in conflicts if record_id in held}
+        st.dataframe(pd.DataFrame([
+            {"Drug": row["drug_name"], "Your packs": row["packs"], "Your singles": row["singles"],
+             "Your expiry": row["expiry_date"],
+             "Saved packs": saved[record_id].packs if record_id in saved else None,
+             "Saved singles": saved[record_id].singles if record_id in saved else None,
+             "Changed by": saved[record_id].updated_by if record_id in saved else None}
+            for record_id, row in conflicts.items()
+        ]), hide_index=True)
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("Save mine anyway"):
+                # Queued without last_updated, so they overwrite the other change
+                queue_updates([{k: v for k, v in row.items() if k != "last_updated"} for row in conflicts.values()])
+                st.session_state.conflicts = {}
+                st.rerun()
+        with col2:
+            if st.button("Discard mine"):
+                st.session_state.conflicts = {}
+                st.rerun()
+
+def offline_panel():
+    table_id = st.session_state.current_table_id
+    status = local_status(table_id)
+    label = "📴 Offline counting (on)" if st.session_state.offline else "📴 Offline counting"
+    
+    with st.expander(label, expanded=st.session_state.offline and bool(status and status["conflicts"])):
+        if not st.session_state.offline:
+            st.caption("Download this table to count on this machine without the server, then sync when the network is back.")
+            if st.button("Download for offline counting"):
+                flush_updates()
+                try:
+                    count = download_table(table_id)
+                except mysql.connector.Error as e:
+                    st.error(f"Could not reach the server: {e}")
+                    return
+                st.session_state.offline = True
+                st.success(f"Downloaded {count} records")
+                st.rerun()
+            return
+        
+        col1, col2, col3 = st.columns(3)
+        col1.metric("Unsynced rows", status["unsynced"])
+        col2.metric("Conflicts", status["conflicts"])
+        col3.metric("Last sync", status["synced_at"].strftime('%H:%M') if status["synced_at"] else "Never")
+        
+        col1, col2 = st.columns(2)
+        with col1:
+            if st.button("Sync to server", type="primary", disabled=not status["unsynced"]):
+                result = sync_table(table_id)
+                if result["error"]:
+                    st.error(f"Sync failed, nothing was lost: {result['error']}")
+                else:
+                    st.success(f"Synced {result['synced']} row(s) in {result['seconds']:.2f}s")
+                    if result["conflicts"]:
+                        st.warning(f"{result['conflicts']} row(s) were changed by someone else; choose which counts to keep below")
+                    if result["failed"]:
+                        st.error(f"{len(result['failed'])} row(s) were rejected by the server")
+        with col2:
+            if st.button("Go back online", disabled=bool(status["unsynced"])):
+                st.session_state.offline = False
+                st.rerun()
+        
+        conflicts = get_conflicts(table_id)
+        if conflicts:
+            st.dataframe(pd.DataFrame(conflicts).drop(columns=["id"]), hide_index=True)
+            ids = [row["id"] for row in conflicts]
+            col1, col2 = st.columns(2)
+            with col1:
+                if st.button("Keep my counts"):
+                    resolve_conflicts(table_id, ids, keep_local=True)
+                    st.rerun()
+            with col2:
+                if st.button("Take the server's counts"):
+                    resolve_conflicts(table_id, ids, keep_local=False)
+                    st.rerun()
+
+def upload_page():
+    if not st.session_state.authenticated:
+        st.warning("Please select a department first")
+        return
+    
+    st.title("📤 Upload Counts")
+    st.markdown(f"Apply counts recorded on paper or in a spreadsheet to **{st.session_state.current_table}**.")
+    count_upload_form(
+        st.session_state.current_table_id,
+        st.session_state.counter_name or st.session_state.department,
+        key="user_upload"
+    )
+
+def data_page():
+    if not st.session_state.authenticated:
+        st.warning("Please select a department first")
+        return
+    
+    st.title("📊 View Stocktake Data")
+    col1, col2 = st.columns(2)
+    with col1:
+        table_page_size = page_size_selector("data_tables", 25, "Tables per page")
+    with col2:
+        record_page_size = page_size_selector("data_records", 100)
+    
+    tables = keyset_pager(
+        f"data_tables_{table_page_size}",
+        lambda cursor, limit: get_stocktake_tables(st.session_state.department, limit, cursor),
+        table_cursor,
+        table_page_size
+    )
+    
+    if tables:
+        table_options = {
+            f"{t['table_name']} ({t['created_at']}){' - archived' if t['archived_at'] else ''}": t
+            for t in tables
+        }
+        selected_table = st.selectbox("Select Table", list(table_options.keys()))
+        
+        if selected_table:
+            table_id = table_options[selected_table]["id"]
+            # Archived tables are read from their Parquet file
+            load_page = get_archived_records_page if table_options[selected_table]["archived_at"] else get_table_records_page
+            records = keyset_pager(
+                f"data_records_{table_id}_{record_page_size}",
+                lambda cursor, limit: load_page(table_id, limit, cursor),
+                record_cursor,
+                record_page_size
+            )
+            
+            if records:
+                df = pd.DataFrame(records).drop(columns=["id", "drug_id"])
+                df["Last Updated"] = pd.to_datetime(df["last_updated"]).dt.strftime('%Y-%m-%d %H:%M')
+                st.dataframe(df.drop(columns=["last_updated"]), hide_index=True)
+            else:
+                st.info("No records found")
+    else:
+        st.info("No tables available")
+
+def about_page():
+    st.title("ℹ️ About")
+    st.markdown("""
+    ### Hospital Stocktake System
+    **Version:** 1.0  
+    **Developed by:** Corporate 24 Healthcare
+    """)
+
+def main():
+    if 'authenticated' not in st.session_state:
+        st.session_state.update({
+            'authenticated': False,
+            'department': None,
+            'current_table': None,
+            'current_table_id': None,
+            'counter_name': None,
+            'grid_revision': 0,
+            'pending_updates': {},
+            'pending_since': None,
+            'flush_report': None,
+            'auto_save': True,
+            'offline': False,
+            'snapshot': None,
+            'conflicts': {},
+            # Tells this session's own saves apart from other counters with the same name
+            'session_id': uuid.uuid4().hex
+        })
+
+    st.sidebar.title("Stocktake System")
+    
+    if not st.session_state.authenticated:
+        department = st.sidebar.selectbox("Department", DEPARTMENTS)
+        access_code = st.sidebar.text_input("Access Code", type="password")
+        counter_name = st.sidebar.text_input("Your Name")
+        
+        if st.sidebar.button("Start Stocktake"):
+            offline = False
+            try:
+                table = find_table_by_access_code(access_code)
+            except mysql.connector.Error:
+                # Server unreachable: tables downloaded earlier can still be counted
+                table = find_local_table(access_code)
+                offline = table is not None
+            else:
+                # Pick up counts left unsynced on this machine by an earlier offline session
+                status = local_status(table["id"]) if table else None
+                offline = bool(status and status["unsynced"])
+            
+            if table:
+                if not table.get("is_active", True):
+                    st.sidebar.error("This stocktake has been closed")
+                elif table["department"] == department:
+                    st.session_state.update({
+                        'authenticated': True,
+                        'department': department,
+                        'current_table': table["table_name"],
+                        'current_table_id': table["id"],
+                        'counter_name': counter_name.strip() or None,
+                        'offline': offline
+                    })
+                    st.sidebar.success(f"Access granted to {table['table_name']}")
+                    st.rerun()
+                else:
+                    st.sidebar.error("Code doesn't match department")
+            else:
+                st.sidebar.error("Invalid access code")
+    
+    if st.session_state.authenticated:
+        st.sidebar.success(f"Department: {st.session_state.department}")
+        st.sidebar.info(f"Table: {st.session_state.current_table}")
+        
+        if st.sidebar.button("Switch Department"):
+            flush_updates()
+            st.session_state.authenticated = False
+            st.rerun()
+    
+    pages = {
+        "Home": home_page,
+        "Stocktake": stocktake_page,
+        "Upload": upload_page,
+        "Data": data_page,
+        "About": about_page
+    }
+    
+    selected_page = st.sidebar.radio("Go to", list(pages.keys()))
+    with metrics.page_timer(selected_page):
+        pages[selected_page]()
+
+if __name__ == "__main__":
     main()
\ No newline at end of file